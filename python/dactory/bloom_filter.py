@@ -1,3 +1,5 @@
+from pathlib import Path
+
 from dactory import BloomFilter
 from dactory.download_models import download_if_necessary
 
@@ -6,3 +8,17 @@ def load_bloom_filter(bloom_filter_path_or_url: str) -> BloomFilter | None:
     if bloom_filter_path_or_url.lower() == "none":
         return None
     return BloomFilter.py_load(str(download_if_necessary(bloom_filter_path_or_url)))
+
+
+def merge_bloom_filters(paths: list[Path], output: Path):
+    """Union of bloom filters with the same shape, like the states saved by several runs
+    started from the same bloom filter."""
+    bloom_filter = BloomFilter.py_load(str(paths[0]))
+    for path in paths[1:]:
+        bloom_filter.merge(BloomFilter.py_load(str(path)))
+    bloom_filter.save(str(output))
+
+
+def create_blocked_bloom_filter(size: int, num_hashes: int, output: Path):
+    """All the bits of a line are in the same cache line, so a lookup reads memory once."""
+    BloomFilter.new_blocked(size, num_hashes).save(str(output))
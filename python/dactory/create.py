@@ -1,49 +1,119 @@
 import multiprocessing
 import random
 import time
-from dataclasses import dataclass
+from collections import Counter
+from contextlib import ExitStack
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterator
+from typing import Callable, Iterator
 
-import requests
 from fasttext.FastText import _FastText as FastTextModel
 from fastwarc.warc import ArchiveIterator, WarcRecord
-from requests.exceptions import RequestException
 from resiliparse.extract.html2text import extract_plain_text
 from resiliparse.parse.encoding import detect_encoding
-from retry import retry
 from tqdm import tqdm
 
-from dactory import compute_long_words, compute_repetitions_rolling, dedup_document
+from dactory import (
+    compute_document_metrics,
+    dedup_document,
+    document_metric_names,
+    gopher_metric_names,
+)
 from dactory.bloom_filter import load_bloom_filter
-from dactory.gopher import GopherConfig, passes_gopher_filters
+from dactory.fetcher import WarcFetcher
+from dactory.gopher import GOPHER_REPETITION_THRESHOLDS, GopherConfig, check_gopher_metrics
+from dactory.language_detector import LanguageSampling, predict_language
 from dactory.minhash_dedup import MinHashDeduplicator
+from dactory.parquet_writer import write_parquet
+from dactory.prefilter import RecordPrefilter
 from dactory.scoring import QualityClassifier, ScoringModels
-from dactory.zstd_writer import zstd_writer
+from dactory.zstd_writer import (
+    FramedZstdWriter,
+    OutputFormat,
+    OutputOptions,
+    write_group_shards,
+)
 
 from .document import Document
-from .rewinding import GroupProgress, rewind_old_file
+from .rewinding import WarcProgress, resume_framed_file, rewind_old_file
+from .transport import (
+    TRANSPORT_BATCH_SIZE,
+    DocumentBatch,
+    SharedDocumentBatch,
+    start_resource_tracker,
+)
 
 NO_MORE_INPUT = "NO_MORE_INPUT"
+# The download workers start at random times within this many seconds, to spread the requests.
+MAX_WORKER_START_DELAY = 10
+# How many batches of documents can wait in the filter stage for each filter worker.
+FILTER_QUEUE_SIZE_PER_WORKER = 4
+# Groups written at the same time, when the WARCs of a group are finishing. Each of them has
+# its own copy of the bloom filter, so the peak memory is this many times its size.
+MAX_GROUPS_IN_PROGRESS = 2
+# How often the deduplication state of a group (bloom filter, MinHash index) is saved, for
+# resuming.
+DEDUP_CHECKPOINT_SECONDS = 600
+# How many times we try to stream a WARC, resuming where the previous attempt stopped.
+DOWNLOAD_ATTEMPTS = 3
+# Documents whose language has a lower score are rejected.
+MIN_LANGUAGE_SCORE = 0.8
+# Order of the values of `compute_document_metrics`.
+DOCUMENT_METRIC_NAMES = document_metric_names()
+# The metrics kept without `enable_gopher_repetition_filters`.
+GOPHER_METRIC_NAMES = set(gopher_metric_names())
 
 
 class UnwantedWarcRecord(Exception):
-    pass
+    """`reason` is a short name of the filter, the rejected records are counted by reason."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
 
 
 @dataclass
 class WarcResults:
     warc_url: str
+    group_idx: int
     success: bool
     processed_records: int
     failed_records: int
     error_msg: str | None = None
+    # Where to start again if the WARC wasn't fully read, see WarcProgress.
+    resume_offset: int = 0
+    resume_record_idx: int = 0
+    # The number of failed records for each reason, see UnwantedWarcRecord.
+    rejected_records: dict[str, int] = field(default_factory=dict)
+    # The decisions of the language sampling compared to the whole text, see
+    # `identify_language`.
+    lid_audit: dict[str, int] = field(default_factory=dict)
 
     @property
     def total_records(self) -> int:
         return self.processed_records + self.failed_records
 
 
+@dataclass
+class DedupCheckpoint:
+    """Sent after the deduplication state of a group was saved. When it comes out of the
+    filter stage, all the documents deduplicated before are written, see `GroupWriter`."""
+
+    group_idx: int
+
+
+@dataclass
+class FilteredBatch:
+    """Documents of one WARC that went through all the filters, ready to be written."""
+
+    group_idx: int
+    warc_file: str
+    last_record_idx: int
+    num_documents: int
+    text_length: int
+    json_lines: bytes
+
+
 @dataclass
 class LoadedArgs:
     """Same as CreateArgs, but after loading and parsing the arguments."""
@@ -51,6 +121,7 @@ class LoadedArgs:
     destination_directory: Path
     corpus: str
     workers: int
+    filter_workers: int
     groups: list[int]
     warc_paths: list[list[str]]
     min_length: int
@@ -58,22 +129,76 @@ class LoadedArgs:
     languages: list[str]
     bloom_filter: str
     min_bloom_threshold: float
+    save_bloom_filters: bool
     scoring_models: ScoringModels | None
     max_rand_score: float
     enable_gopher_filters: bool
+    # With the Gopher filters, also filter on the repetitions of word n-grams.
+    enable_gopher_repetition_filters: bool
     enable_minhash_dedup: bool
     minhash_threshold: float
     minhash_num_perm: int
+    minhash_ngram_size: int
+    minhash_words: bool
+    minhash_max_memory: int
     quality_classifier: QualityClassifier | None
     max_dclm_low_score: float
+    output: OutputOptions
+    fetcher: WarcFetcher | None
+    # Checks the headers of the records before extracting their text.
+    prefilter: RecordPrefilter | None
+    # None to identify the language on the whole text.
+    lid_sampling: LanguageSampling | None
+    # Only download and extract the documents, to run the filters later with `dactory refilter`.
+    extract_only: bool
     quiet: bool
 
 
+# Yields the documents of a task (a WARC), then its WarcResults.
+DocumentGenerator = Callable[..., Iterator[Document | WarcResults]]
+
+
+def identify_language(args: LoadedArgs, text: str, lid_audit: Counter) -> tuple[str, float]:
+    """The language of the text and its score, raises UnwantedWarcRecord if it isn't kept.
+
+    With `args.lid_sampling`, the decision can be taken on a sample of a long text, when its
+    score is at least both the decision score and MIN_LANGUAGE_SCORE. Each decision audited
+    adds `agree`, `wrong_accept` or `wrong_reject` to `lid_audit`.
+    """
+    sampling = args.lid_sampling
+    if sampling is not None and len(text) > sampling.num_chars:
+        lid = predict_language(args.lang_detection_model, sampling.sample(text))
+        if lid[1] >= max(sampling.decision_score, MIN_LANGUAGE_SCORE):
+            keep = lid[0] in args.languages
+            if random.random() < sampling.audit_rate:
+                full_lid = predict_language(args.lang_detection_model, text)
+                if (
+                    full_lid[0] in args.languages and full_lid[1] >= MIN_LANGUAGE_SCORE
+                ) == keep:
+                    lid_audit["agree"] += 1
+                else:
+                    lid_audit["wrong_accept" if keep else "wrong_reject"] += 1
+            if not keep:
+                raise UnwantedWarcRecord("language_sample")
+            return lid
+    lid = predict_language(args.lang_detection_model, text)
+    if lid[0] not in args.languages:
+        raise UnwantedWarcRecord("language")
+    if lid[1] < MIN_LANGUAGE_SCORE:
+        raise UnwantedWarcRecord("language_score")
+    return lid
+
+
 def get_record_dict(
-    args: LoadedArgs, record: WarcRecord, group_idx: int, warc_file: str, record_idx: int
+    args: LoadedArgs,
+    record: WarcRecord,
+    group_idx: int,
+    warc_file: str,
+    record_idx: int,
+    lid_audit: Counter,
 ) -> Document:
-    if record.headers["WARC-Type"] != "response":
-        raise UnwantedWarcRecord("Not a response record")
+    if (reason := args.prefilter.rejection_reason(record)) is not None:
+        raise UnwantedWarcRecord(reason)
     html = record.reader.read()
     try:
         # Most of the time, the encoding is utf-8, so we try it first then fallback to detect the encoding
@@ -83,15 +208,8 @@ def get_record_dict(
         html_decoded = html.decode(detect_encoding(html), errors="ignore")
     text = extract_plain_text(html_decoded, main_content=True)
     if len(text) <= args.min_length:
-        raise UnwantedWarcRecord("Text too short")
-    lid = args.lang_detection_model.predict(text.replace("\n", " "))
-    lid = (lid[0][0].removeprefix("__label__"), lid[1][0])
-    if lid[0] == "hr":
-        lid = (lid[0], 2 * lid[1])
-    if lid[0] not in args.languages:
-        raise UnwantedWarcRecord("Language not in the list")
-    if lid[1] < 0.8:
-        raise UnwantedWarcRecord("Confidence too low")
+        raise UnwantedWarcRecord("too_short")
+    lid = identify_language(args, text, lid_audit)
     return Document(
         text=text,
         date=record.headers["WARC-Date"],
@@ -108,253 +226,711 @@ def get_record_dict(
     )
 
 
-@retry(RequestException, tries=3, delay=5)
-def get_response(warc_url: str) -> requests.Response:
-    # connect timeout: 30s, read timeout: 60s
-    response = requests.get(warc_url, stream=True, timeout=(30, 60))
-    response.raise_for_status()
-    return response
+def get_warc_url(warc_path: str) -> str:
+    return f"https://data.commoncrawl.org/{warc_path}"
 
 
 def document_generator(
-    args: LoadedArgs, warc_url: str, group_idx: int, work_already_done: GroupProgress
+    args: LoadedArgs, warc_url: str, group_idx: int, previous_work: WarcProgress
 ) -> Iterator[Document | WarcResults]:
-    previous_work = work_already_done[warc_url]
     failed_records = 0
     processed_records = 0
+    rejected_records = Counter()
+    lid_audit = Counter()
 
     if previous_work.done:
         yield WarcResults(
-            warc_url=warc_url, success=True, processed_records=0, failed_records=0
+            warc_url=warc_url,
+            group_idx=group_idx,
+            success=True,
+            processed_records=0,
+            failed_records=0,
         )
         return
 
-    try:
-        response = get_response(warc_url)
-        for record_idx, record in enumerate(ArchiveIterator(response.raw)):
-            if record_idx <= previous_work.last_record_seen:
-                processed_records += 1
-                continue
-            try:
-                yield get_record_dict(args, record, group_idx, warc_url, record_idx)
-                processed_records += 1
-            except UnwantedWarcRecord:
-                failed_records += 1
-                continue
+    # Each gzip member of a WARC holds one record. When we start reading a record, all the
+    # previous ones are handled, so its offset is a safe place to resume from.
+    resume_offset = previous_work.resume_offset
+    resume_record_idx = previous_work.resume_record_idx
+    last_record_seen = previous_work.last_record_seen
+    error_msg = None
+    for _ in range(DOWNLOAD_ATTEMPTS):
+        try:
+            with args.fetcher.open(warc_url, resume_offset) as stream:
+                if resume_offset > 0 and stream.status_code != 206:
+                    # The server ignored the range, we are reading the whole file.
+                    resume_offset = resume_record_idx = 0
+                records = ArchiveIterator(stream.reader)
+                for record_idx, record in enumerate(records, start=resume_record_idx):
+                    resume_offset = record.stream_pos
+                    resume_record_idx = record_idx
+                    if record_idx <= last_record_seen:
+                        continue
+                    try:
+                        yield get_record_dict(
+                            args, record, group_idx, warc_url, record_idx, lid_audit
+                        )
+                        processed_records += 1
+                    except UnwantedWarcRecord as e:
+                        failed_records += 1
+                        rejected_records[e.reason] += 1
+                    last_record_seen = record_idx
+
+            yield WarcResults(
+                warc_url=warc_url,
+                group_idx=group_idx,
+                success=True,
+                processed_records=processed_records,
+                failed_records=failed_records,
+                rejected_records=dict(rejected_records),
+                lid_audit=dict(lid_audit),
+            )
+            return
+        except Exception as e:
+            # Either an error occured whiling getting the WARC URL or during the streaming.
+            # Try again from the last record we started to read.
+            error_msg = str(e)
+
+    # This URL won't be mark as done yet and will be retried on next run, starting from the
+    # last gzip member we started to read.
+    yield WarcResults(
+        warc_url=warc_url,
+        group_idx=group_idx,
+        success=False,
+        processed_records=processed_records,
+        failed_records=failed_records,
+        error_msg=error_msg,
+        rejected_records=dict(rejected_records),
+        lid_audit=dict(lid_audit),
+        resume_offset=resume_offset,
+        resume_record_idx=resume_record_idx,
+    )
 
-        yield WarcResults(
-            warc_url=warc_url,
-            success=True,
-            processed_records=processed_records,
-            failed_records=failed_records,
-        )
-    except Exception as e:
-        # Either an error occured whiling getting the WARC URL or during the streaming
-        # This URL won't be mark as done yet and will be retry on next run starting from last_record_seen
-        yield WarcResults(
-            warc_url=warc_url,
-            success=False,
-            processed_records=processed_records,
-            failed_records=failed_records,
-            error_msg=str(e),
-        )
+
+def warc_tasks(group: "GroupWriter") -> list[tuple[str, WarcProgress]]:
+    """The WARCs to download for a group, with the work already done for each of them."""
+    tasks = []
+    for warc_path in group.args.warc_paths[group.group_idx]:
+        warc_url = get_warc_url(warc_path)
+        tasks.append((warc_url, group.work_already_done[warc_url]))
+    return tasks
 
 
 def document_generator_queue(
-    args: LoadedArgs,
-    input_queue,
-    results_queue,
-    group_idx: int,
-    work_already_done: GroupProgress,
+    args: LoadedArgs, generator: DocumentGenerator, input_queue, results_queue
 ):
-    time.sleep(random.uniform(0, 10))
-    for warc_path in iter(input_queue.get, NO_MORE_INPUT):
-        warc_url = f"https://data.commoncrawl.org/{warc_path}"
-        for result in document_generator(args, warc_url, group_idx, work_already_done):
-            results_queue.put(result)
+    time.sleep(random.uniform(0, MAX_WORKER_START_DELAY))
+    for group_idx, source, previous_work in iter(input_queue.get, NO_MORE_INPUT):
+        documents = []
+        for result in generator(args, source, group_idx, previous_work):
+            # The documents of a batch come from the same WARC, and are sent before its results.
+            if documents and (
+                isinstance(result, WarcResults)
+                or result.warc_file != documents[0].warc_file
+                or len(documents) == TRANSPORT_BATCH_SIZE
+            ):
+                batch = DocumentBatch.from_documents(documents)
+                results_queue.put(batch.to_shared_memory())
+                documents = []
+            if isinstance(result, WarcResults):
+                results_queue.put(result)
+            else:
+                documents.append(result)
 
 
-def document_generator_group(
-    args: LoadedArgs, warc_paths: list[str], group_idx: int, work_already_done: GroupProgress
-) -> Iterator[Document | WarcResults]:
-    # Since we mutate it in another function, to be sure
-    work_already_done = work_already_done.copy()
+def stop_workers(processes: list[multiprocessing.Process]):
+    """If a stage is left before its end, its workers are still waiting for work."""
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+def document_generator_groups(
+    args: LoadedArgs,
+    groups: dict[int, "GroupWriter"],
+    generator: DocumentGenerator,
+    get_tasks: Callable[["GroupWriter"], list[tuple[str, object]]],
+) -> Iterator[SharedDocumentBatch | WarcResults]:
+    """Downloads all the groups with the same pool of workers. Each task of a group, usually a
+    WARC, is given to `generator` in a worker, which yields its documents then its results.
+
+    The tasks of the next group are queued as soon as the workers are about to run out of work,
+    so they don't wait for the slowest WARC of a group. Each group opened is added to `groups`.
+    """
     input_queue = multiprocessing.Queue()
     results_queue = multiprocessing.SimpleQueue()
 
-    # Tracking stats
-    total_warc_files = len(warc_paths)
-    failed_warc_files = 0
-    total_records_seen = 0
-    total_records_processed = 0
-    total_records_failed = 0
-
     processes = []
     for _ in range(args.workers):
         p = multiprocessing.Process(
-            target=document_generator_queue,
-            args=(args, input_queue, results_queue, group_idx, work_already_done),
+            target=document_generator_queue, args=(args, generator, input_queue, results_queue)
         )
         p.start()
         processes.append(p)
 
-    for warc_path in warc_paths:
-        input_queue.put(warc_path)
-    for _ in range(args.workers):
-        input_queue.put(NO_MORE_INPUT)
-
-    progress_bar = tqdm(
-        total=len(warc_paths),
-        desc="Warc paths processed in group",
-        position=1,
-        leave=False,
-        disable=args.quiet,
-    )
-    while True:
-        result = results_queue.get()
-        if isinstance(result, WarcResults):
-            total_records_seen += result.total_records
-            total_records_processed += result.processed_records
-            total_records_failed += result.failed_records
-            if not result.success:
-                failed_warc_files += 1
-                if not args.quiet:
-                    tqdm.write(
-                        f"Failed to download WARC: {result.warc_url}, error: {result.error_msg}"
-                    )
-            progress_bar.update()
+    groups_to_open = iter(args.groups)
+    warcs_in_progress = 0  # queued or being downloaded
+    slots_used = set()  # for the position of the progress bars
+
+    def open_next_group() -> bool:
+        nonlocal warcs_in_progress
+        for group_idx in groups_to_open:
+            slot = min(set(range(len(slots_used) + 1)) - slots_used)
+            group = GroupWriter(args, group_idx, slot)
+            if group.is_finished():
+                tqdm.write(f"Group {group_idx} already exists, skipping it")
+                continue
+            group.open()
+            groups[group_idx] = group
+            slots_used.add(slot)
+            tasks = get_tasks(group)
+            for source, previous_work in tasks:
+                input_queue.put((group_idx, source, previous_work))
+            warcs_in_progress += len(tasks)
+            return True
+        return False
 
-            # Log summary stats every 10 files or at the end
-            if not args.quiet and (
-                progress_bar.n % 10 == 0 or progress_bar.n == len(warc_paths)
+    try:
+        has_more_groups = True
+        while True:
+            slots_used &= {group.slot for group in groups.values()}
+            while has_more_groups and (
+                warcs_in_progress == 0
+                or (warcs_in_progress <= args.workers and len(groups) < MAX_GROUPS_IN_PROGRESS)
             ):
-                failed_records_pct = (
-                    (total_records_failed / total_records_seen * 100)
-                    if total_records_seen > 0
-                    else 0
-                )
-                failed_warc_pct = failed_warc_files / total_warc_files * 100
-                tqdm.write(
-                    f"WARC progress: {progress_bar.n}/{total_warc_files} files "
-                    f"({failed_warc_files} failed, {failed_warc_pct:.1f}%) | "
-                    f"Records: {total_records_processed} processed, "
-                    f"{total_records_failed} failed ({failed_records_pct:.1f}%)"
-                )
-
-            if progress_bar.n == len(warc_paths):
+                has_more_groups = open_next_group()
+            if warcs_in_progress == 0:
                 break
-        yield result
+            result = results_queue.get()
+            if isinstance(result, WarcResults):
+                warcs_in_progress -= 1
+            yield result
 
-    for process in processes:
-        process.join()
-    for process in processes:
-        process.terminate()
+        for _ in processes:
+            input_queue.put(NO_MORE_INPUT)
+        for process in processes:
+            process.join()
+    finally:
+        stop_workers(processes)
 
 
-def download_warcs_for_group(args: LoadedArgs, group_idx: int, warc_paths: list[str]):
-    bloom_filter = load_bloom_filter(args.bloom_filter)
-    minhash_dedup = (
-        MinHashDeduplicator(threshold=args.minhash_threshold, num_perm=args.minhash_num_perm)
-        if args.enable_minhash_dedup
-        else None
-    )
-    if args.languages == []:
-        raise ValueError("Language list is empty")
-
-    progress_bar_bytes = tqdm(
-        unit_scale=True,
-        unit="B",
-        desc=f"Amount of text saved in the group {group_idx}",
-        position=2,
-        leave=False,
-        disable=args.quiet,
+def deduplicate_documents(
+    args: LoadedArgs,
+    batches: Iterator[SharedDocumentBatch | WarcResults],
+    groups: dict[int, "GroupWriter"],
+) -> Iterator[SharedDocumentBatch | WarcResults | DedupCheckpoint]:
+    """The deduplication depends on the documents seen before, so it must happen in a single process.
+
+    From time to time, the state of a group is saved and a DedupCheckpoint follows the batch."""
+    for batch in batches:
+        if isinstance(batch, WarcResults):
+            yield batch
+            continue
+        group = groups[batch.group_idx]
+        bloom_filter = group.bloom_filter
+        minhash_dedup = group.minhash_dedup
+        if bloom_filter is None and minhash_dedup is None:
+            yield batch
+            continue
+
+        # Only the text is decoded, the other columns go to the filter workers as they are.
+        text = batch.load_text()
+        keep = [True] * len(text)
+        if bloom_filter is not None:
+            for i, document_text in enumerate(text):
+                text[i] = dedup_document(document_text, bloom_filter, args.min_bloom_threshold)
+                keep[i] = len(text[i]) >= args.min_length
+        if minhash_dedup is not None:
+            # The signatures of the whole batch are computed at once, in parallel.
+            indices = [i for i, k in enumerate(keep) if k]
+            duplicates = minhash_dedup.are_duplicates([text[i] for i in indices])
+            for i, duplicate in zip(indices, duplicates):
+                keep[i] = not duplicate
+        if any(keep):
+            yield batch.replace_text(text if bloom_filter is not None else None, keep)
+        else:
+            batch.unlink()
+        if group.dedup_checkpoint_due():
+            group.save_dedup_state()
+            yield DedupCheckpoint(group_idx=batch.group_idx)
+
+
+def filter_document(args: LoadedArgs, document: Document) -> Document | None:
+    """Filters that only depend on the document itself. Returns None if the document is filtered out."""
+    # All the metrics in one pass over the text, the Gopher ones only if they are needed.
+    values = compute_document_metrics(
+        document.text,
+        document.language,
+        n=20,
+        min_length=15,
+        gopher=args.enable_gopher_filters,
+        repetition_metrics=args.enable_gopher_repetition_filters,
     )
-    progress_bar_records = tqdm(
-        unit=" Records",
-        desc=f"Records seen in group {group_idx}",
-        position=3,
-        leave=False,
-        disable=args.quiet,
+    metrics = dict(zip(DOCUMENT_METRIC_NAMES, values))
+    document.repetitions = metrics.pop("repetitions")
+    document.long_words = metrics.pop("long_words")
+
+    if args.enable_gopher_filters:
+        if args.enable_gopher_repetition_filters:
+            config = GopherConfig(**GOPHER_REPETITION_THRESHOLDS)
+        else:
+            # The metrics of the n-grams are not computed, their values are NaN.
+            metrics = {k: v for k, v in metrics.items() if k in GOPHER_METRIC_NAMES}
+            config = GopherConfig()
+        document.gopher_metrics = {k: round(v, 3) for k, v in metrics.items()}
+        if not check_gopher_metrics(metrics, config):
+            return None
+
+    if args.scoring_models is not None:
+        scores = args.scoring_models.get_doc_scores(document.text, document.language)
+        if scores["rand"] > args.max_rand_score:
+            return None
+        document.scores = {k: round(v, 3) for k, v in scores.items()}
+
+    if args.quality_classifier is not None:
+        quality_scores = args.quality_classifier.get_quality_score(document.text)
+        for k, v in quality_scores.items():
+            document.scores[f"dclm_{k}"] = round(v, 3)
+        dclm_low = document.scores.get("dclm_low", 0.0)
+        if dclm_low > args.max_dclm_low_score:
+            return None
+
+    return document
+
+
+def filter_batch(args: LoadedArgs, batch: SharedDocumentBatch) -> FilteredBatch | None:
+    """Filter and serialize a batch of documents, all coming from the same WARC."""
+    json_lines = []
+    text_length = 0
+    last_record_idx = -1
+    warc_file = None
+    for document in batch.load().to_documents():
+        if not args.extract_only and filter_document(args, document) is None:
+            continue
+        json_lines.append(document.model_dump_json(by_alias=True) + "\n")
+        text_length += len(document.text)
+        last_record_idx = max(last_record_idx, document.record_idx)
+        warc_file = document.warc_file
+    if not json_lines:
+        return None
+    return FilteredBatch(
+        group_idx=batch.group_idx,
+        warc_file=warc_file,
+        last_record_idx=last_record_idx,
+        num_documents=len(json_lines),
+        text_length=text_length,
+        json_lines="".join(json_lines).encode("utf-8"),
     )
-    # fmt: off
-    destination =          args.destination_directory / f"{group_idx}.jsonl.zstd"          # atomic
-    destination_tmp =      args.destination_directory / f"{group_idx}.jsonl.zstd.tmp"      # for writing
-    destination_tmp_old =  args.destination_directory / f"{group_idx}.jsonl.zstd.tmp.old"  # for rewinding
-    destination_progress = args.destination_directory / f"{group_idx}.progress.json"       # for saving progress
-    # fmt: on
-
-    if destination.exists():
-        tqdm.write(f"File {destination} already exists, skipping group {group_idx}")
+
+
+def report_score_caches(args: LoadedArgs):
+    """Shows the hit rate of the line caches of the fastText models, if they were used."""
+    if args.quiet:
         return
+    for name, model in (
+        ("scoring models", args.scoring_models),
+        ("quality classifier", args.quality_classifier),
+    ):
+        if model is None:
+            continue
+        hits, misses = model.cache_stats()
+        if hits + misses > 0:
+            tqdm.write(
+                f"Line cache of the {name}: {hits / (hits + misses):.1%} hits "
+                f"over {hits + misses} lines"
+            )
 
-    if destination_tmp.exists():
-        destination_tmp.rename(destination_tmp_old)
 
-    with zstd_writer(destination_tmp) as out_f:
-        work_already_done = rewind_old_file(
-            destination_tmp_old, out_f, group_idx, destination_progress
+def filter_batches_queue(args: LoadedArgs, input_queue, results_queue):
+    for seq, batch in iter(input_queue.get, NO_MORE_INPUT):
+        results_queue.put((seq, filter_batch(args, batch)))
+    report_score_caches(args)
+
+
+def filter_stage(
+    args: LoadedArgs, batches: Iterator[SharedDocumentBatch | WarcResults | DedupCheckpoint]
+) -> Iterator[FilteredBatch | WarcResults | DedupCheckpoint]:
+    """Runs `filter_batch` in a pool of processes.
+
+    The results are yielded in the same order as the input, so that a WarcResults always comes
+    after all the documents of its WARC, and the progress saved stays correct. The same goes
+    for the DedupCheckpoints.
+    """
+    if args.filter_workers == 0:
+        for batch in batches:
+            if not isinstance(batch, SharedDocumentBatch):
+                yield batch
+            elif (filtered := filter_batch(args, batch)) is not None:
+                yield filtered
+        report_score_caches(args)
+        return
+
+    input_queue = multiprocessing.Queue()
+    results_queue = multiprocessing.SimpleQueue()
+    processes = []
+    for _ in range(args.filter_workers):
+        p = multiprocessing.Process(
+            target=filter_batches_queue, args=(args, input_queue, results_queue)
         )
+        p.start()
+        processes.append(p)
 
-        for document in document_generator_group(
-            args, warc_paths, group_idx, work_already_done
-        ):
-            if isinstance(document, WarcResults):
-                # This is a WARC completion result, mark it as done if successful
-                work_already_done[document.warc_url].done = document.success
-                work_already_done.save()
-                continue
-            if bloom_filter is not None:
-                document.text = dedup_document(
-                    document.text, bloom_filter, args.min_bloom_threshold
-                )
-                if len(document.text) < args.min_length:
-                    continue
+    max_in_flight = FILTER_QUEUE_SIZE_PER_WORKER * args.filter_workers
+    in_flight = 0
+    ready = {}  # seq -> result, results can come back out of order
+    next_seq = 0
+
+    def receive_result():
+        nonlocal in_flight
+        seq, result = results_queue.get()
+        ready[seq] = result
+        in_flight -= 1
+
+    def pop_ready_results() -> Iterator[FilteredBatch | WarcResults | DedupCheckpoint]:
+        nonlocal next_seq
+        while next_seq in ready:
+            result = ready.pop(next_seq)
+            next_seq += 1
+            if result is not None:
+                yield result
 
-            if minhash_dedup is not None and minhash_dedup.is_duplicate(document.text):
-                continue
+    try:
+        for seq, batch in enumerate(batches):
+            if not isinstance(batch, SharedDocumentBatch):
+                ready[seq] = batch
+            else:
+                input_queue.put((seq, batch))
+                in_flight += 1
+            # We collect what is available right away, so the workers never wait on a full pipe.
+            while in_flight >= max_in_flight or (in_flight > 0 and not results_queue.empty()):
+                receive_result()
+            yield from pop_ready_results()
+
+        for _ in processes:
+            input_queue.put(NO_MORE_INPUT)
+        while in_flight > 0:
+            receive_result()
+        yield from pop_ready_results()
+
+        for process in processes:
+            process.join()
+    finally:
+        stop_workers(processes)
+
+
+class GroupWriter:
+    """Everything needed to write the output of a group: the files, the progress, and the
+    deduplication state, which is not shared between groups.
+
+    The deduplication runs ahead of the filters and of the writing. A state saved for resuming
+    must not contain documents that were not written yet, or they would be seen as duplicates
+    and lost. So the state is first saved as pending, and only replaces the previous one when
+    its DedupCheckpoint comes out of the filter stage, with all the documents before it.
+    """
+
+    def __init__(self, args: LoadedArgs, group_idx: int, slot: int):
+        self.args = args
+        self.group_idx = group_idx
+        self.slot = slot  # Several groups can be in progress at the same time
+        self.nb_warcs = len(args.warc_paths[group_idx])
+        # fmt: off
+        self.destination =          args.destination_directory / f"{group_idx}.jsonl.zstd"          # atomic
+        self.destination_tmp =      args.destination_directory / f"{group_idx}.jsonl.zstd.tmp"      # for writing
+        self.destination_tmp_old =  args.destination_directory / f"{group_idx}.jsonl.zstd.tmp.old"  # for rewinding
+        self.destination_index =    args.destination_directory / f"{group_idx}.jsonl.zstd.tmp.index"  # for resuming
+        self.destination_manifest = args.destination_directory / f"{group_idx}.manifest.json"       # atomic, with shards
+        self.destination_parquet =  args.destination_directory / f"{group_idx}.parquet"             # atomic, with parquet
+        self.destination_progress = args.destination_directory / f"{group_idx}.progress.json"       # for saving progress
+        self.destination_bloom =    args.destination_directory / f"{group_idx}.bloom.bin"           # for resuming the dedup
+        self.pending_bloom =        args.destination_directory / f"{group_idx}.bloom.bin.pending"   # until it is written
+        self.destination_minhash =  args.destination_directory / f"{group_idx}.minhash.bin"         # for resuming the dedup
+        self.pending_minhash =      args.destination_directory / f"{group_idx}.minhash.bin.pending" # until it is written
+        # fmt: on
+
+        # Tracking stats
+        self.warcs_finished = 0
+        self.failed_warc_files = 0
+        self.total_records_seen = 0
+        self.total_records_processed = 0
+        self.total_records_failed = 0
+        self.rejected_records = Counter()
+        self.lid_audit = Counter()
+
+    def open(self):
+        # A state saved before documents that were not written, it can't be used.
+        self.pending_bloom.unlink(missing_ok=True)
+        self.pending_minhash.unlink(missing_ok=True)
+        # Start from the lines seen before the interruption, if any.
+        if self.args.bloom_filter.lower() != "none" and self.destination_bloom.exists():
+            self.bloom_filter = load_bloom_filter(str(self.destination_bloom))
+        else:
+            self.bloom_filter = load_bloom_filter(self.args.bloom_filter)
+        self.minhash_dedup = None
+        if self.args.enable_minhash_dedup:
+            # Same as the bloom filter, start from the documents seen before.
+            snapshot = self.destination_minhash if self.destination_minhash.exists() else None
+            self.minhash_dedup = MinHashDeduplicator(
+                threshold=self.args.minhash_threshold,
+                num_perm=self.args.minhash_num_perm,
+                ngram_size=self.args.minhash_ngram_size,
+                words=self.args.minhash_words,
+                max_memory=self.args.minhash_max_memory,
+                snapshot=snapshot,
+            )
+        self.last_dedup_checkpoint = time.monotonic()
+        self.dedup_state_pending = False
+
+        position = 1 + 3 * self.slot
+        self.progress_bar_warcs = tqdm(
+            total=self.nb_warcs,
+            desc=f"Warc paths processed in group {self.group_idx}",
+            position=position,
+            leave=False,
+            disable=self.args.quiet,
+        )
+        self.progress_bar_bytes = tqdm(
+            unit_scale=True,
+            unit="B",
+            desc=f"Amount of text saved in the group {self.group_idx}",
+            position=position + 1,
+            leave=False,
+            disable=self.args.quiet,
+        )
+        self.progress_bar_records = tqdm(
+            unit=" Records",
+            desc=f"Records seen in group {self.group_idx}",
+            position=position + 2,
+            leave=False,
+            disable=self.args.quiet,
+        )
 
-            document.repetitions = compute_repetitions_rolling(document.text, 20)
-            document.long_words = compute_long_words(document.text, min_length=15)
+        if self.destination_tmp.exists() and self.destination_index.exists():
+            # Written in frames, we can continue where the last complete frame ends.
+            self.work_already_done = resume_framed_file(
+                self.destination_tmp,
+                self.destination_index,
+                self.group_idx,
+                self.destination_progress,
+            )
+            self.out_f = FramedZstdWriter(
+                self.destination_tmp, self.destination_index, options=self.args.output
+            )
+        else:
+            # Written as a single frame by an older version, we copy what can be read.
+            if self.destination_tmp.exists():
+                self.destination_tmp.rename(self.destination_tmp_old)
+            self.destination_index.unlink(missing_ok=True)
+            self.out_f = FramedZstdWriter(
+                self.destination_tmp, self.destination_index, options=self.args.output
+            )
+            self.work_already_done = rewind_old_file(
+                self.destination_tmp_old, self.out_f, self.group_idx, self.destination_progress
+            )
+        self.exit_stack = ExitStack()
+        self.exit_stack.enter_context(self.out_f)
+
+    def write(self, batch: FilteredBatch):
+        self.progress_bar_bytes.update(batch.text_length)
+        self.work_already_done.set_last_record_seen(batch.warc_file, batch.last_record_idx)
+        self.progress_bar_records.update(
+            self.work_already_done.nb_records_seen() - self.progress_bar_records.n
+        )
+        self.out_f.write(batch.json_lines, batch.warc_file, batch.last_record_idx)
+
+    def warc_done(self, result: WarcResults):
+        # This is a WARC completion result, mark it as done if successful
+        progress = self.work_already_done[result.warc_url]
+        progress.done = result.success
+        if not result.success:
+            progress.resume_offset = result.resume_offset
+            progress.resume_record_idx = result.resume_record_idx
+        # The documents of the WARC must be in the file before it is saved as done.
+        self.out_f.flush()
+        self.work_already_done.save(result.warc_url)
+
+        self.warcs_finished += 1
+        self.total_records_seen += result.total_records
+        self.total_records_processed += result.processed_records
+        self.total_records_failed += result.failed_records
+        self.rejected_records.update(result.rejected_records)
+        self.lid_audit.update(result.lid_audit)
+        if not result.success:
+            self.failed_warc_files += 1
+            if not self.args.quiet:
+                tqdm.write(
+                    f"Failed to download WARC: {result.warc_url}, error: {result.error_msg}"
+                )
+        self.progress_bar_warcs.update()
 
-            if args.enable_gopher_filters:
-                passes, gopher_metrics = passes_gopher_filters(
-                    document.text, document.language, GopherConfig()
+        # Log summary stats every 10 files or at the end
+        if not self.args.quiet and (
+            self.warcs_finished % 10 == 0 or self.warcs_finished == self.nb_warcs
+        ):
+            failed_records_pct = (
+                (self.total_records_failed / self.total_records_seen * 100)
+                if self.total_records_seen > 0
+                else 0
+            )
+            failed_warc_pct = self.failed_warc_files / self.nb_warcs * 100
+            tqdm.write(
+                f"WARC progress in group {self.group_idx}: {self.warcs_finished}/{self.nb_warcs} files "
+                f"({self.failed_warc_files} failed, {failed_warc_pct:.1f}%) | "
+                f"Records: {self.total_records_processed} processed, "
+                f"{self.total_records_failed} failed ({failed_records_pct:.1f}%)"
+            )
+            if self.rejected_records:
+                tqdm.write(
+                    "Failed records by reason: "
+                    + ", ".join(
+                        f"{reason} {count}"
+                        for reason, count in self.rejected_records.most_common()
+                    )
                 )
-                document.gopher_metrics = {k: round(v, 3) for k, v in gopher_metrics.items()}
-                if not passes:
-                    continue
-
-            if args.scoring_models is not None:
-                scores = args.scoring_models.get_doc_scores(document.text, document.language)
-                if scores["rand"] > args.max_rand_score:
-                    continue
-                document.scores = {k: round(v, 3) for k, v in scores.items()}
-
-            if args.quality_classifier is not None:
-                quality_scores = args.quality_classifier.get_quality_score(document.text)
-                for k, v in quality_scores.items():
-                    document.scores[f"dclm_{k}"] = round(v, 3)
-                dclm_low = document.scores.get("dclm_low", 0.0)
-                if dclm_low > args.max_dclm_low_score:
-                    continue
-
-            progress_bar_bytes.update(len(document.text))
-            work_already_done[document.warc_file].last_record_seen = document.record_idx
-            progress_bar_records.update(
-                work_already_done.nb_records_seen() - progress_bar_records.n
+            if audited := self.lid_audit.total():
+                tqdm.write(
+                    f"Language decisions on samples audited: {audited}, "
+                    f"{self.lid_audit['agree'] / audited:.1%} agree with the whole text "
+                    f"({self.lid_audit['wrong_accept']} wrongly kept, "
+                    f"{self.lid_audit['wrong_reject']} wrongly rejected)"
+                )
+
+    @property
+    def finished(self) -> bool:
+        return self.warcs_finished == self.nb_warcs
+
+    def dedup_checkpoint_due(self) -> bool:
+        # A single state can be pending, it would be replaced before being committed.
+        return (
+            not self.dedup_state_pending
+            and time.monotonic() - self.last_dedup_checkpoint > DEDUP_CHECKPOINT_SECONDS
+        )
+
+    def save_dedup_state(self):
+        """Called by the deduplication, which is ahead of the documents written."""
+        if self.bloom_filter is not None:
+            self.bloom_filter.save(str(self.pending_bloom))
+        if self.minhash_dedup is not None:
+            self.minhash_dedup.save(self.pending_minhash)
+        self.dedup_state_pending = True
+        self.last_dedup_checkpoint = time.monotonic()
+
+    def commit_dedup_state(self):
+        """All the documents seen by the pending state are written, it can be used to resume."""
+        self.out_f.flush()
+        if self.pending_bloom.exists():
+            self.pending_bloom.rename(self.destination_bloom)
+        if self.pending_minhash.exists():
+            self.pending_minhash.rename(self.destination_minhash)
+        self.dedup_state_pending = False
+
+    def close(self):
+        # The deduplication state is not saved here: the documents still in the filter stage
+        # are not written, they will be downloaded again when resuming.
+        self.exit_stack.close()
+        for progress_bar in (
+            self.progress_bar_warcs,
+            self.progress_bar_bytes,
+            self.progress_bar_records,
+        ):
+            progress_bar.close()
+
+    def is_finished(self) -> bool:
+        """The group was finished by a previous run, in one of the output formats."""
+        destinations = (self.destination, self.destination_manifest, self.destination_parquet)
+        return any(path.exists() for path in destinations)
+
+    def finish(self):
+        self.close()
+        if self.args.output.format == OutputFormat.parquet:
+            self.write_parquet()
+        elif self.args.output.shard_size > 0:
+            self.write_shards()
+        else:
+            self.destination_tmp.rename(self.destination)
+        self.destination_index.unlink(missing_ok=True)
+        self.work_already_done.unlink()
+        self.pending_bloom.unlink(missing_ok=True)
+        if self.args.save_bloom_filters and self.bloom_filter is not None:
+            # All the documents of the group are written.
+            self.bloom_filter.save(str(self.destination_bloom))
+        else:
+            self.destination_bloom.unlink(missing_ok=True)
+        self.destination_minhash.unlink(missing_ok=True)
+        self.pending_minhash.unlink(missing_ok=True)
+        if self.minhash_dedup is not None and self.minhash_dedup.index.num_skipped > 0:
+            tqdm.write(
+                f"The MinHash index of group {self.group_idx} was full, "
+                f"{self.minhash_dedup.index.num_skipped} documents were not indexed"
             )
-            json_string = document.model_dump_json(by_alias=True)
-            out_f.write((json_string + "\n").encode("utf-8"))
+        tqdm.write(f"Finished group {self.group_idx}")
+
+    def write_shards(self):
+        """Splits the group in `<group>.<shard>.jsonl.zstd` files, listed in the manifest. The
+        group is finished once the manifest is written."""
+        write_group_shards(
+            self.destination_tmp,
+            self.destination_index,
+            self.args.output.shard_size,
+            self.args.destination_directory,
+            self.group_idx,
+        )
 
-    destination_tmp.rename(destination)
-    destination_progress.unlink(missing_ok=True)
-    tqdm.write(f"Finished group {group_idx}")
+    def write_parquet(self):
+        """Converts the group to `<group>.parquet`, with its documents in row groups."""
+        tmp_parquet = self.destination_parquet.with_name(
+            self.destination_parquet.name + ".tmp"
+        )
+        write_parquet(self.destination_tmp, tmp_parquet, self.args.output.level)
+        tmp_parquet.rename(self.destination_parquet)
+        self.destination_tmp.unlink()
 
 
-def create_dataset(args: LoadedArgs):
+def create_dataset(
+    args: LoadedArgs,
+    generator: DocumentGenerator = document_generator,
+    get_tasks: Callable[[GroupWriter], list[tuple[str, object]]] = warc_tasks,
+):
+    """Download, filter and write the groups. With another `generator` and `get_tasks`,
+    the documents can come from somewhere else than the WARCs, see `dactory refilter`."""
+    if args.languages == []:
+        raise ValueError("Language list is empty")
     tqdm.write(f"Groups to do: {args.groups}")
-    for group_idx in tqdm(
-        args.groups, desc="Warc groups done", position=0, disable=args.quiet
-    ):
-        download_warcs_for_group(args, group_idx, args.warc_paths[group_idx])
+    # The groups already finished are skipped, they count as done from the start.
+    already_done = sum(
+        GroupWriter(args, group_idx, 0).is_finished() for group_idx in args.groups
+    )
+    progress_bar_groups = tqdm(
+        total=len(args.groups),
+        initial=already_done,
+        desc="Warc groups done",
+        position=0,
+        disable=args.quiet,
+    )
+
+    start_resource_tracker()
+    groups: dict[int, GroupWriter] = {}  # The groups in progress
+    batches = document_generator_groups(args, groups, generator, get_tasks)
+    batches = filter_stage(args, deduplicate_documents(args, batches, groups))
+    try:
+        for batch in batches:
+            group = groups[batch.group_idx]
+            if isinstance(batch, FilteredBatch):
+                group.write(batch)
+                continue
+            if isinstance(batch, DedupCheckpoint):
+                group.commit_dedup_state()
+                continue
+            group.warc_done(batch)
+            if group.finished:
+                group.finish()
+                del groups[batch.group_idx]
+                progress_bar_groups.update()
+    finally:
+        # Stops the workers if we were interrupted.
+        batches.close()
+        # Flush what was written, so it can be recovered when resuming
+        for group in groups.values():
+            group.close()
+    progress_bar_groups.close()
     print(f"Groups {args.groups} done.")
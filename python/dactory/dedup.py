@@ -0,0 +1,296 @@
+"""Removing the near duplicates across all the groups, once they are written by `dactory create`.
+
+The MinHash deduplication of `dactory create` only compares the documents of a group. Here,
+it runs on the whole dataset in three stages. Each stage is split between several tasks, for
+example slurm tasks, and writes each of its outputs to a temporary file renamed once complete,
+so a stage that was stopped can be started again and skips what is already done:
+1. `signatures`: the band hashes of the MinHash signatures of the documents, one file per group.
+2. `bands`: for each band, the documents with the same hash as a document before them, in the
+   order of the groups then of the documents in the groups. Each band is split in `num_parts`
+   ranges of hashes, a task only holds the hashes of one of them in memory. One file per part
+   of a band.
+3. `filter`: the groups without the documents found by any band, written like by
+   `dactory create`, in frames, and split into shards listed in a manifest with `shard_size`.
+
+Since a document is removed whether the document before it was removed or not, the bands are
+independent from each other, unlike with the LSH index of `dactory create`.
+"""
+
+import io
+import json
+import os
+import tempfile
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from enum import Enum
+from pathlib import Path
+from typing import BinaryIO
+
+import numpy as np
+import zstandard as zstd
+from pydantic import BaseModel
+from tqdm import tqdm
+
+from dactory import compute_band_hashes, compute_minhash_signature_batch
+from dactory.minhash_dedup import optimal_lsh_param
+from dactory.refilter import group_shard_paths, source_group_files
+from dactory.zstd_writer import FramedZstdWriter, write_group_shards
+
+# Documents whose signatures are computed at the same time.
+SIGNATURE_BATCH_SIZE = 4096
+
+
+class DedupStage(str, Enum):
+    signatures = "signatures"
+    bands = "bands"
+    filter = "filter"
+    all = "all"
+
+
+class DedupParams(BaseModel):
+    """Saved with the intermediate files, all the tasks and stages must use the same."""
+
+    threshold: float
+    num_perm: int
+    ngram_size: int
+    words: bool
+    num_bands: int
+    rows: int
+    num_parts: int
+
+
+class CorpusDeduplicator:
+    def __init__(
+        self,
+        source_directory: Path,
+        destination_directory: Path,
+        params: DedupParams,
+        task: int = 0,
+        num_tasks: int = 1,
+        shard_size: int = 0,
+        quiet: bool = False,
+    ):
+        self.source_directory = source_directory
+        self.destination_directory = destination_directory
+        self.work_directory = destination_directory / "minhash"
+        self.params = params
+        self.task = task
+        self.num_tasks = num_tasks
+        self.shard_size = shard_size
+        self.quiet = quiet
+        self.group_files = source_group_files(source_directory)
+        self.groups = [i for i, files in enumerate(self.group_files) if files]
+        (self.work_directory / "signatures").mkdir(parents=True, exist_ok=True)
+        (self.work_directory / "bands").mkdir(exist_ok=True)
+        self.check_params()
+
+    def check_params(self):
+        path = self.work_directory / "params.json"
+        if path.exists():
+            saved = DedupParams.model_validate_json(path.read_text())
+            if saved != self.params:
+                raise ValueError(
+                    f"{self.work_directory} was created with other parameters: {saved}. "
+                    "Delete it to start again with the new ones."
+                )
+        else:
+            write_atomically(path, lambda f: f.write(self.params.model_dump_json().encode()))
+
+    def read_group(self, group_idx: int) -> Iterator[str]:
+        """The lines of the group, from its shards in order if it was split."""
+        for path in self.group_files[group_idx]:
+            for shard_path in group_shard_paths(Path(path)):
+                yield from read_lines(shard_path)
+
+    def signatures_path(self, group_idx: int) -> Path:
+        return self.work_directory / "signatures" / f"{group_idx}.npy"
+
+    def band_path(self, band: int, part: int) -> Path:
+        return self.work_directory / "bands" / f"{band}.{part}.npz"
+
+    def band_parts(self) -> list[tuple[int, int]]:
+        return [
+            (b, p) for b in range(self.params.num_bands) for p in range(self.params.num_parts)
+        ]
+
+    def my_share(self, items: list[int]) -> list[int]:
+        return [item for i, item in enumerate(items) if i % self.num_tasks == self.task]
+
+    def run(self, stage: DedupStage):
+        if stage in (DedupStage.signatures, DedupStage.all):
+            self.compute_signatures()
+        if stage in (DedupStage.bands, DedupStage.all):
+            self.find_duplicates()
+        if stage in (DedupStage.filter, DedupStage.all):
+            self.filter_groups()
+
+    def compute_signatures(self):
+        for group_idx in tqdm(
+            self.my_share(self.groups), desc="Signatures of the groups", disable=self.quiet
+        ):
+            path = self.signatures_path(group_idx)
+            if path.exists():
+                continue
+            band_hashes = [np.zeros((0, self.params.num_bands), dtype=np.uint64)]
+            texts = []
+            for line in self.read_group(group_idx):
+                texts.append(json.loads(line)["text"])
+                if len(texts) == SIGNATURE_BATCH_SIZE:
+                    band_hashes.append(self.band_hashes(texts))
+                    texts = []
+            band_hashes.append(self.band_hashes(texts))
+            # One row per band, the next stage reads a band of every group.
+            band_hashes = np.ascontiguousarray(np.concatenate(band_hashes).T)
+            write_atomically(path, lambda f: np.save(f, band_hashes))
+
+    def band_hashes(self, texts: list[str]) -> np.ndarray:
+        signatures = compute_minhash_signature_batch(
+            texts, self.params.num_perm, self.params.ngram_size, self.params.words
+        )
+        return compute_band_hashes(signatures, self.params.num_bands, self.params.rows)
+
+    def find_duplicates(self):
+        missing = [g for g in self.groups if not self.signatures_path(g).exists()]
+        if missing:
+            raise ValueError(
+                f"The signatures of the groups {missing} are missing, run the `signatures` stage first"
+            )
+        band_parts = self.band_parts()
+        for i in tqdm(
+            self.my_share(list(range(len(band_parts)))),
+            desc="Duplicates in the bands",
+            disable=self.quiet,
+        ):
+            band, part = band_parts[i]
+            path = self.band_path(band, part)
+            if path.exists():
+                continue
+            hashes, group_ids, indices = [], [], []
+            for group_idx in self.groups:
+                group_hashes = np.load(self.signatures_path(group_idx), mmap_mode="r")[band]
+                # The documents with a hash in the range of the part, in order.
+                index = np.flatnonzero(hash_parts(group_hashes, self.params.num_parts) == part)
+                hashes.append(group_hashes[index])
+                group_ids.append(np.full(len(index), group_idx, dtype=np.int32))
+                indices.append(index.astype(np.int64))
+            hashes = np.concatenate(hashes)
+            # `np.unique` gives the first occurrence of each hash, the others are duplicates.
+            _, first = np.unique(hashes, return_index=True)
+            duplicate = np.ones(len(hashes), dtype=bool)
+            duplicate[first] = False
+            group_ids = np.concatenate(group_ids)[duplicate]
+            indices = np.concatenate(indices)[duplicate]
+            write_atomically(path, lambda f: np.savez(f, group=group_ids, index=indices))
+
+    def duplicates_of_my_groups(self) -> dict[int, set[int]]:
+        missing = sorted(
+            {b for b, p in self.band_parts() if not self.band_path(b, p).exists()}
+        )
+        if missing:
+            raise ValueError(f"The bands {missing} are missing, run the `bands` stage first")
+        my_groups = set(self.my_share(self.groups))
+        duplicates = defaultdict(set)
+        for band, part in self.band_parts():
+            with np.load(self.band_path(band, part)) as data:
+                group_ids, indices = data["group"], data["index"]
+            mine = np.isin(group_ids, list(my_groups))
+            for group_idx, index in zip(group_ids[mine].tolist(), indices[mine].tolist()):
+                duplicates[group_idx].add(index)
+        return duplicates
+
+    def filter_groups(self):
+        duplicates = self.duplicates_of_my_groups()
+        for group_idx in tqdm(
+            self.my_share(self.groups), desc="Filtering the groups", disable=self.quiet
+        ):
+            path = self.destination_directory / f"{group_idx}.jsonl.zstd"
+            manifest_path = self.destination_directory / f"{group_idx}.manifest.json"
+            if path.exists() or manifest_path.exists():
+                continue
+            tmp_path = path.with_name(path.name + ".tmp")
+            index_path = tmp_path.with_name(tmp_path.name + ".index")
+            # Left by an interrupted task, the group is filtered again from the start.
+            tmp_path.unlink(missing_ok=True)
+            index_path.unlink(missing_ok=True)
+            kept = 0
+            with FramedZstdWriter(tmp_path, index_path) as out_f:
+                for i, line in enumerate(self.read_group(group_idx)):
+                    if i not in duplicates[group_idx]:
+                        out_f.write(line.encode("utf-8"))
+                        kept += 1
+            if self.shard_size > 0:
+                write_group_shards(
+                    tmp_path,
+                    index_path,
+                    self.shard_size,
+                    self.destination_directory,
+                    group_idx,
+                )
+            else:
+                tmp_path.rename(path)
+            index_path.unlink()
+            if not self.quiet:
+                tqdm.write(
+                    f"Group {group_idx}: kept {kept} documents, "
+                    f"removed {len(duplicates[group_idx])} near duplicates"
+                )
+
+
+def read_lines(path: Path) -> Iterator[str]:
+    with path.open("rb") as in_f:
+        with zstd.ZstdDecompressor().stream_reader(
+            in_f, read_across_frames=True
+        ) as in_f_decompressed:
+            yield from io.TextIOWrapper(in_f_decompressed, encoding="utf-8")
+
+
+def hash_parts(hashes: np.ndarray, num_parts: int) -> np.ndarray:
+    """The part of each hash, when the range of the hashes is split in `num_parts` equal
+    ranges."""
+    return ((hashes >> np.uint64(32)) * np.uint64(num_parts)) >> np.uint64(32)
+
+
+def write_atomically(path: Path, write: Callable[[BinaryIO], object]):
+    """Several tasks can write the same file at the same time, each has its own temporary file."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        write(f)
+    Path(tmp_path).rename(path)
+
+
+def dedup_dataset(
+    source_directory: Path,
+    destination_directory: Path,
+    stage: DedupStage,
+    threshold: float,
+    num_perm: int,
+    ngram_size: int,
+    words: bool,
+    task: int = 0,
+    num_tasks: int = 1,
+    num_parts: int = 16,
+    shard_size: int = 0,
+    quiet: bool = False,
+):
+    if stage == DedupStage.all and num_tasks > 1:
+        raise ValueError(
+            "With several tasks, run each stage once all the tasks finished the previous one"
+        )
+    if source_directory.resolve() == destination_directory.resolve():
+        raise ValueError(
+            "The destination directory must be different from the source directory"
+        )
+    num_bands, rows = optimal_lsh_param(threshold, num_perm)
+    params = DedupParams(
+        threshold=threshold,
+        num_perm=num_perm,
+        ngram_size=ngram_size,
+        words=words,
+        num_bands=num_bands,
+        rows=rows,
+        num_parts=num_parts,
+    )
+    deduplicator = CorpusDeduplicator(
+        source_directory, destination_directory, params, task, num_tasks, shard_size, quiet
+    )
+    deduplicator.run(stage)
@@ -0,0 +1,278 @@
+"""Downloading the WARC files.
+
+The response is read by a background thread into a bounded buffer, so a slow network doesn't
+stall the parsing of the records, and the other way around. The number of downloads running
+at the same time is shared by all the download workers, and adapts to the measured
+throughput and to the 503 (SlowDown) answers of the server.
+"""
+
+import io
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import BinaryIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from retry.api import retry_call
+
+from .warc_cache import WarcCache
+
+READ_CHUNK_SIZE = 1 << 20
+# The throughput is reported to the limiter each time this amount of data has been read.
+REPORT_SIZE = 32 << 20
+# After the server asked us to slow down, don't add downloads for this many seconds.
+SLOW_DOWN_COOLDOWN = 30.0
+
+
+class SlowDown(RequestException):
+    """The server is asking us to send fewer requests."""
+
+
+class ConcurrencyLimiter:
+    """Limit on the number of downloads at the same time, shared between processes.
+    Must be created before forking the workers.
+
+    The limit is halved when the server answers 503, and increases by one when the downloads
+    are about as fast as the best one seen recently. It goes down by one when they become
+    much slower, which means we are sharing the bandwidth between too many connections.
+    """
+
+    def __init__(self, max_concurrency: int, initial_concurrency: int | None = None):
+        self.max_concurrency = max_concurrency
+        self._condition = multiprocessing.Condition()
+        self._limit = multiprocessing.RawValue("i", initial_concurrency or max_concurrency)
+        self._active = multiprocessing.RawValue("i", 0)
+        # Best throughput of a single download, in bytes per second. Slowly decays.
+        self._reference = multiprocessing.RawValue("d", 0.0)
+        self._cooldown_until = multiprocessing.RawValue("d", 0.0)
+
+    @property
+    def limit(self) -> int:
+        return self._limit.value
+
+    def acquire(self):
+        with self._condition:
+            while self._active.value >= self._limit.value:
+                self._condition.wait()
+            self._active.value += 1
+
+    def release(self):
+        with self._condition:
+            self._active.value -= 1
+            self._condition.notify_all()
+
+    def slow_down(self):
+        with self._condition:
+            self._limit.value = max(1, self._limit.value // 2)
+            self._cooldown_until.value = time.monotonic() + SLOW_DOWN_COOLDOWN
+
+    def report(self, num_bytes: int, seconds: float):
+        """Throughput of one download, only counting the time spent waiting on the network."""
+        if seconds <= 0:
+            return
+        throughput = num_bytes / seconds
+        with self._condition:
+            reference = max(throughput, 0.95 * self._reference.value)
+            self._reference.value = reference
+            if throughput < 0.5 * reference:
+                self._limit.value = max(1, self._limit.value - 1)
+            elif (
+                throughput >= 0.75 * reference
+                and time.monotonic() >= self._cooldown_until.value
+                and self._limit.value < self.max_concurrency
+            ):
+                self._limit.value += 1
+                self._condition.notify_all()
+
+
+class PrefetchingReader:
+    """File-like object reading ahead from `raw` in a background thread, keeping at most
+    `buffer_size` bytes in memory. Errors of the thread are raised by `read`.
+    `start` is the position of `raw` in the file, `tell` gives positions in the whole file.
+    Everything read is also written to `sink` if given, `complete` tells if it got it all.
+
+    The reader holds a slot of `limiter`, acquired by the caller, and releases it as soon as
+    the download stops, while the end of the file can still be parsed from the buffer."""
+
+    def __init__(
+        self,
+        raw: io.IOBase,
+        buffer_size: int,
+        limiter: ConcurrencyLimiter | None,
+        sink: BinaryIO | None = None,
+        start: int = 0,
+    ):
+        self._raw = raw
+        self._limiter = limiter
+        self._sink = sink
+        self.complete = False
+        self._chunks = queue.Queue(maxsize=max(1, buffer_size // READ_CHUNK_SIZE))
+        self._current = b""
+        self._position = 0
+        self._consumed = start
+        self._eof = False
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _put(self, item: bytes | Exception | None):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _fill(self):
+        num_bytes = 0
+        seconds = 0.0
+        end = None
+        try:
+            while not self._stopped.is_set():
+                start = time.perf_counter()
+                chunk = self._raw.read(READ_CHUNK_SIZE)
+                seconds += time.perf_counter() - start
+                num_bytes += len(chunk)
+                if self._limiter is not None and (num_bytes >= REPORT_SIZE or not chunk):
+                    self._limiter.report(num_bytes, seconds)
+                    num_bytes, seconds = 0, 0.0
+                if not chunk:
+                    if self._sink is not None:
+                        self._sink.close()
+                    self.complete = True
+                    break
+                if self._sink is not None:
+                    self._sink.write(chunk)
+                self._put(chunk)
+        except Exception as e:
+            end = e
+        finally:
+            if self._sink is not None:
+                self._sink.close()
+            if self._limiter is not None:
+                self._limiter.release()
+        self._put(end)
+
+    def read(self, size: int = -1) -> bytes:
+        if self._position == len(self._current):
+            if self._eof:
+                return b""
+            item = self._chunks.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if item is None:
+                self._eof = True
+                return b""
+            self._current, self._position = item, 0
+        end = len(self._current) if size < 0 else self._position + size
+        data = self._current[self._position : end]
+        self._position += len(data)
+        self._consumed += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self._consumed
+
+    def close(self):
+        # The thread stops at its next read or as soon as the buffer has some room.
+        self._stopped.set()
+        self._raw.close()
+
+
+@dataclass
+class WarcStream:
+    status_code: int
+    reader: PrefetchingReader | BinaryIO
+
+
+class WarcFetcher:
+    """Create it before forking the download workers, each of them gets its own session."""
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        read_ahead: int,
+        pool_size: int = 4,
+        retry_delay: float = 5.0,
+        cache: WarcCache | None = None,
+    ):
+        self.limiter = ConcurrencyLimiter(max_concurrency)
+        self.cache = cache
+        self.read_ahead = read_ahead
+        self.pool_size = pool_size
+        self.retry_delay = retry_delay
+        self._session = None
+        self._session_pid = None
+
+    def session(self) -> requests.Session:
+        # A session can't be shared with the forked processes, the sockets would be shared.
+        if self._session is None or self._session_pid != os.getpid():
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+            self._session_pid = os.getpid()
+        return self._session
+
+    def get_response(self, url: str, offset: int = 0) -> requests.Response:
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else None
+        # connect timeout: 30s, read timeout: 60s
+        response = self.session().get(url, headers=headers, stream=True, timeout=(30, 60))
+        if response.status_code in (429, 503):
+            response.close()
+            self.limiter.slow_down()
+            raise SlowDown(f"{response.status_code} {response.reason}", response=response)
+        response.raise_for_status()
+        return response
+
+    @contextmanager
+    def open(self, url: str, offset: int = 0) -> Iterator[WarcStream]:
+        """Stream the file starting at `offset`. Check that the status code is 206 if
+        `offset` isn't 0, the server can ignore the range. The `tell` of the reader gives the
+        position in the whole file."""
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None:
+            with cached.open("rb") as f:
+                f.seek(offset)
+                yield WarcStream(status_code=206 if offset > 0 else 200, reader=f)
+            return
+
+        # The slot is released by the reader once the response is downloaded.
+        self.limiter.acquire()
+        try:
+            response = retry_call(
+                self.get_response,
+                fargs=(url, offset),
+                exceptions=RequestException,
+                tries=3,
+                delay=self.retry_delay,
+                backoff=2,
+            )
+            part, sink = None, None
+            if self.cache is not None and response.status_code == 200:
+                part, sink = self.cache.create_part(url)
+            start = offset if response.status_code == 206 else 0
+            reader = PrefetchingReader(
+                response.raw, self.read_ahead, self.limiter, sink, start
+            )
+        except BaseException:
+            self.limiter.release()
+            raise
+        try:
+            yield WarcStream(status_code=response.status_code, reader=reader)
+        finally:
+            reader.close()
+            response.close()
+            if part is not None:
+                if reader.complete:
+                    self.cache.commit(url, part)
+                else:
+                    part.unlink(missing_ok=True)
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from dactory import compute_gopher_metrics
+from dactory import compute_gopher_metrics, compute_repetition_metrics
 
 
 # https://arxiv.org/pdf/2112.11446
@@ -15,30 +15,56 @@ class GopherConfig:
     require_stop_words: bool = True
     max_frac_duplicate_sentences: float = 0.3
     max_frac_duplicate_paragraphs: float = 0.3
+    # For the n-grams of 2 to 4 words, None to not filter on them.
+    max_top_ngram_char_frac: tuple[float, ...] | None = None
+    # For the n-grams of 5 to 10 words, None to not filter on them.
+    max_duplicate_ngram_char_frac: tuple[float, ...] | None = None
+
+
+# The thresholds of the paper for the repetitions of word n-grams, used with
+# `--enable-gopher-repetition-filters`.
+GOPHER_REPETITION_THRESHOLDS = dict(
+    max_top_ngram_char_frac=(0.20, 0.18, 0.16),
+    max_duplicate_ngram_char_frac=(0.15, 0.14, 0.13, 0.12, 0.11, 0.10),
+)
 
 
 def passes_gopher_filters(
     text: str, language: str, config: GopherConfig
 ) -> tuple[bool, dict[str, float]]:
     metrics = compute_gopher_metrics(text, language)
+    # The metrics of the n-grams are only computed when they are filtered on.
+    if config.max_top_ngram_char_frac or config.max_duplicate_ngram_char_frac:
+        metrics |= compute_repetition_metrics(text)
+    return check_gopher_metrics(metrics, config), metrics
+
 
+def check_gopher_metrics(metrics: dict[str, float], config: GopherConfig) -> bool:
+    """`metrics` has the metrics of `compute_gopher_metrics` and `compute_repetition_metrics`,
+    or of `compute_document_metrics`."""
     if metrics["mean_word_length"] < config.min_mean_word_length:
-        return False, metrics
+        return False
     if metrics["mean_word_length"] > config.max_mean_word_length:
-        return False, metrics
+        return False
     if metrics["frac_words_with_alpha"] < config.min_frac_words_with_alpha:
-        return False, metrics
+        return False
     if metrics["frac_lines_end_punctuation"] < config.min_frac_lines_end_punctuation:
-        return False, metrics
+        return False
     if metrics["frac_lines_start_bullet"] > config.max_frac_lines_start_bullet:
-        return False, metrics
+        return False
     if metrics["frac_alphabetic_chars"] < config.min_frac_alphabetic_chars:
-        return False, metrics
+        return False
     if config.require_stop_words and metrics["has_stop_words"] < 0.5:
-        return False, metrics
+        return False
     if metrics["frac_duplicate_sentences"] > config.max_frac_duplicate_sentences:
-        return False, metrics
+        return False
     if metrics["frac_duplicate_paragraphs"] > config.max_frac_duplicate_paragraphs:
-        return False, metrics
+        return False
+    for n, max_frac in zip(range(2, 5), config.max_top_ngram_char_frac or ()):
+        if metrics[f"top_{n}gram_char_frac"] > max_frac:
+            return False
+    for n, max_frac in zip(range(5, 11), config.max_duplicate_ngram_char_frac or ()):
+        if metrics[f"duplicate_{n}gram_char_frac"] > max_frac:
+            return False
 
-    return True, metrics
+    return True
@@ -1,4 +1,5 @@
 import time
+from dataclasses import dataclass
 
 import fasttext
 from fasttext.FastText import _FastText as FastTextModel
@@ -28,3 +29,34 @@ def load_language_detection_model(
 
 def get_all_languages_available(lang_detection_model: FastTextModel) -> list[str]:
     return [x.removeprefix("__label__") for x in lang_detection_model.get_labels()]
+
+
+def predict_language(lang_detection_model: FastTextModel, text: str) -> tuple[str, float]:
+    lid = lang_detection_model.predict(text.replace("\n", " "))
+    lid = (lid[0][0].removeprefix("__label__"), lid[1][0])
+    if lid[0] == "hr":
+        lid = (lid[0], 2 * lid[1])
+    return lid
+
+
+@dataclass
+class LanguageSampling:
+    """Identifying the language of a long text on a sample of it first.
+
+    The sample is made of `num_chunks` evenly spaced chunks of the text, `num_chars` in total.
+    If the language found has a score of at least `decision_score`, the document is kept or
+    rejected without looking at the whole text. A fraction `audit_rate` of these decisions
+    are compared to the one on the whole text.
+    """
+
+    num_chars: int
+    decision_score: float = 0.95
+    audit_rate: float = 0.0
+    num_chunks: int = 4
+
+    def sample(self, text: str) -> str:
+        chunk_length = self.num_chars // self.num_chunks
+        step = (len(text) - chunk_length) / max(1, self.num_chunks - 1)
+        return " ".join(
+            text[int(i * step) : int(i * step) + chunk_length] for i in range(self.num_chunks)
+        )
@@ -9,14 +9,24 @@ import typer
 import zstandard as zstd
 from typer import Argument, Option
 
+import dactory.bloom_filter
 import dactory.create
+import dactory.dedup
+import dactory.refilter
+from dactory.dedup import DedupStage
+from dactory.fetcher import WarcFetcher
 from dactory.language_detector import (
+    LanguageSampling,
     get_all_languages_available,
     load_language_detection_model,
 )
+from dactory.parquet_writer import check_pyarrow
+from dactory.prefilter import HTML_CONTENT_TYPES, RecordPrefilter, load_domains
 from dactory.profiling import profile
 from dactory.scoring import get_quality_classifier, get_scoring_models
+from dactory.warc_cache import WarcCache
 from dactory.warc_groups import get_warc_groups
+from dactory.zstd_writer import OutputFormat, OutputOptions
 
 from .document import Document
 from .download_models import HF_PREFIX
@@ -45,7 +55,9 @@ def stats():
     file_to_load = Path("/lustre/scwpod02/client/kyutai/gabriel/dactory_test/0.jsonl.zstd")
     documents = []
     with file_to_load.open("rb") as in_f:
-        with zstd.ZstdDecompressor().stream_reader(in_f) as in_f_decompressed:
+        with zstd.ZstdDecompressor().stream_reader(
+            in_f, read_across_frames=True
+        ) as in_f_decompressed:
             in_f_decompressed_text = io.TextIOWrapper(in_f_decompressed, encoding="utf-8")
             for line in in_f_decompressed_text:
                 documents.append(Document.model_validate_json(line))
@@ -60,6 +72,100 @@ def stats():
         print(f"{lang}: {count / total * 100:.2f}%")
 
 
+@app.command()
+def merge_bloom_filters(
+    output: Annotated[Path, Argument(help="Where to save the merged bloom filter.")],
+    bloom_filters: Annotated[
+        list[Path], Argument(help="The bloom filters to merge, they must have the same size.")
+    ],
+):
+    """Merge the bloom filters saved with `--save-bloom-filters`, for example by several slurm
+    tasks. The result contains the lines seen by all of them and can be given to `--bloom-filter`."""
+    dactory.bloom_filter.merge_bloom_filters(bloom_filters, output)
+
+
+@app.command()
+def create_bloom_filter(
+    output: Annotated[Path, Argument(help="Where to save the bloom filter.")],
+    size_gb: Annotated[float, Option(help="Size of the bloom filter in GB.")] = 4.0,
+    num_hashes: Annotated[int, Option(help="Number of bits set for each line.")] = 7,
+):
+    """Create an empty bloom filter with the blocked layout, faster than the original one.
+    It can be given to `--bloom-filter`. The original bloom filters can't be converted, since
+    the lines they contain aren't stored."""
+    dactory.bloom_filter.create_blocked_bloom_filter(int(size_gb * 1e9), num_hashes, output)
+
+
+@app.command()
+def dedup(
+    source_directory: Annotated[
+        Path, Argument(help="Directory where `dactory create` saved the groups.")
+    ],
+    destination_directory: Annotated[
+        Path,
+        Argument(
+            help="Directory to save the deduplicated groups, the intermediate files are saved in DESTINATION_DIRECTORY/minhash/."
+        ),
+    ],
+    stage: Annotated[
+        DedupStage, Option(help="Stage to run, `all` runs them in order in a single task.")
+    ] = DedupStage.all,
+    task: Annotated[int, Option(help="Index of this task, for example $SLURM_PROCID.")] = 0,
+    num_tasks: Annotated[
+        int, Option(help="Number of tasks running the stage, for example $SLURM_NTASKS.")
+    ] = 1,
+    minhash_threshold: Annotated[
+        float, Option(help="MinHash LSH similarity threshold.")
+    ] = 0.8,
+    minhash_num_perm: Annotated[int, Option(help="Number of MinHash permutations.")] = 128,
+    minhash_ngram_size: Annotated[
+        int, Option(help="Size of the MinHash shingles, in bytes or in words.")
+    ] = 5,
+    minhash_words: Annotated[
+        bool, Option(help="Use shingles of words instead of bytes for MinHash.")
+    ] = False,
+    band_parts: Annotated[
+        int,
+        Option(
+            help=(
+                "Split each band in this many ranges of hashes in the `bands` stage, which "
+                "divides the memory of a task by about as much."
+            )
+        ),
+    ] = 16,
+    shard_size_mb: Annotated[
+        int,
+        Option(
+            help=(
+                "Split each group in DESTINATION_DIRECTORY/<group>.<shard>.jsonl.zstd files of "
+                "about this size, listed in <group>.manifest.json. Use 0 for one file per group."
+            )
+        ),
+    ] = 0,
+    quiet: Annotated[bool, Option("--quiet", "-q", help="Do not show progress bars.")] = False,
+):
+    """Removes the near duplicates across all the groups saved by `dactory create`.
+
+    The stages are `signatures`, `bands` and `filter`. Each of them can be split between
+    several tasks, and must be finished by all the tasks before starting the next one. A stage
+    that was stopped can be started again, it skips the files already written.
+    """
+    dactory.dedup.dedup_dataset(
+        source_directory,
+        destination_directory,
+        stage,
+        threshold=minhash_threshold,
+        num_perm=minhash_num_perm,
+        ngram_size=minhash_ngram_size,
+        words=minhash_words,
+        task=task,
+        num_tasks=num_tasks,
+        num_parts=band_parts,
+        shard_size=shard_size_mb << 20,
+        quiet=quiet,
+    )
+
+
 @app.command()
 def list_languages(
     lang_detection_model: Annotated[
@@ -72,37 +178,17 @@ def list_languages(
     print("Available languages: " + ",".join(languages))
 
 
-@app.command("create")
-class CreateArgs(pydantic.BaseModel):
-    """Downloads the CommonCrawl corpus and filters the documents.
-    If will save the documents in the destination directory in the format <group>.jsonl.zstd.
-
-    If a file <group>.jsonl.zstd is complete, it will be skipped.
-    The files are compressed with zstd. You can read them with `zstd -cd my_file.zstd`
-
-    While the code uses multiprocessing within a group, the whole dataset can be created even faster by using
-    xargs or slurm to run multiple groups in parallel. Use --group <group-idx> to download only one group.
+class FilterArgs(pydantic.BaseModel):
+    """The options of `create` and `refilter`."""
 
-    Path of files can have two different formats:
-    - hf://org/repo-name/filename for huggingface files
-    - https://something.com/some/file
-    - /path/to/file for local files
-
-    You can list all the languages available in the language detection model with `dactory list-languages`.
-    """
-
-    destination_directory: Annotated[
-        Path,
-        Argument(
-            help="Directory to save the downloaded files. They will be saved at DESTINATION_DIRECTORY/<group>.jsonl.zstd"
-        ),
-    ]
-    corpus: Annotated[str, Option("--corpus", "-c", help="The CommonCrawl corpus")] = (
-        "CC-MAIN-2024-51"
-    )
     load_models_early: Annotated[
         bool,
-        Option(help="Load scoring models before downloading, disable for faster iteration."),
+        Option(
+            help=(
+                "Load scoring models before downloading, disable for faster iteration. The "
+                "models loaded early are shared by the filter workers."
+            )
+        ),
     ] = True
     workers: Annotated[
         int,
@@ -110,6 +196,15 @@ class CreateArgs(pydantic.BaseModel):
             "--workers", "-w", help="Number of processes to download and filter the documents."
         ),
     ] = 8
+    filter_workers: Annotated[
+        int,
+        Option(
+            help=(
+                "Number of processes to compute the metrics and the scores of the documents. "
+                "Use 0 to do it in the main process."
+            )
+        ),
+    ] = 8
     groups: Annotated[
         str,
         Option(
@@ -143,22 +238,75 @@ class CreateArgs(pydantic.BaseModel):
     min_bloom_threshold: Annotated[
         float, Option(help="Keep only paragraphs above the bloom threshold.")
     ] = 0.2
+    save_bloom_filters: Annotated[
+        bool,
+        Option(
+            help=(
+                "Keep the state of the bloom filter after each group in DESTINATION_DIRECTORY/<group>.bloom.bin. "
+                "Use `dactory merge-bloom-filters` to combine them."
+            )
+        ),
+    ] = False
     scoring_models: Annotated[
         str, Option(help="Path or url of the directory containing the scoring models.")
     ] = f"{KYUTAI_HF_REPOSITORY}/"
+    scoring_models_max_memory_gb: Annotated[
+        float,
+        Option(
+            help=(
+                "Memory limit of the scoring models loaded when their language appears, in GB, "
+                "in each filter worker. The least recently used are unloaded to stay below it. "
+                "Use 0 for no limit."
+            )
+        ),
+    ] = 0.0
     max_rand_score: Annotated[
         float, Option(help="Filter any text that has a score for `rand` above the threshold.")
     ] = 0.9
+    score_cache_lines: Annotated[
+        int,
+        Option(
+            help=(
+                "Number of distinct lines whose scores are kept by each fastText model in each "
+                "filter worker, so the lines repeated across documents, such as menus and "
+                "footers, are scored once. Use 0 to disable the cache."
+            )
+        ),
+    ] = 0
     # V1: Gopher-style heuristic filters
     enable_gopher_filters: Annotated[
         bool, Option(help="Enable Gopher-style heuristic filters.")
     ] = False
+    enable_gopher_repetition_filters: Annotated[
+        bool,
+        Option(
+            help=(
+                "With --enable-gopher-filters, also filter on the repetitions of word n-grams, "
+                "and store their metrics."
+            )
+        ),
+    ] = False
     # V2: MinHash document-level dedup
     enable_minhash_dedup: Annotated[
         bool, Option(help="Enable MinHash document-level deduplication.")
     ] = False
     minhash_threshold: Annotated[float, Option(help="MinHash LSH similarity threshold.")] = 0.8
     minhash_num_perm: Annotated[int, Option(help="Number of MinHash permutations.")] = 128
+    minhash_ngram_size: Annotated[
+        int, Option(help="Size of the MinHash shingles, in bytes or in words.")
+    ] = 5
+    minhash_words: Annotated[
+        bool, Option(help="Use shingles of words instead of bytes for MinHash.")
+    ] = False
+    minhash_max_memory_gb: Annotated[
+        float,
+        Option(
+            help=(
+                "Memory limit of the MinHash index of a group, in GB. Once reached, the "
+                "documents are still compared to the indexed ones, but are not indexed anymore."
+            )
+        ),
+    ] = 8.0
     # V3: DCLM quality classifier
     quality_classifier: Annotated[
         str, Option(help="Path/URL to DCLM fastText quality model, or 'none'.")
@@ -166,15 +314,187 @@ class CreateArgs(pydantic.BaseModel):
     max_dclm_low_score: Annotated[
         float, Option(help="Filter docs with dclm_low score above this threshold.")
     ] = 0.5
+    # Output
+    output_format: Annotated[
+        OutputFormat,
+        Option(
+            help=(
+                "Format of the finished groups. parquet writes DESTINATION_DIRECTORY/<group>.parquet "
+                "with a column for each score and metric, it needs the `parquet` extra."
+            )
+        ),
+    ] = OutputFormat.jsonl
+    zstd_level: Annotated[int, Option(help="zstd compression level of the groups.")] = 3
+    zstd_threads: Annotated[
+        int, Option(help="Threads used by zstd to compress the groups, 0 to use a single one.")
+    ] = 0
+    zstd_long_distance_matching: Annotated[
+        bool, Option(help="Enable the long distance matching of zstd.")
+    ] = False
+    shard_size_mb: Annotated[
+        int,
+        Option(
+            help=(
+                "Split each group in DESTINATION_DIRECTORY/<group>.<shard>.jsonl.zstd files of "
+                "about this size, listed in <group>.manifest.json. Use 0 for one file per group."
+            )
+        ),
+    ] = 0
     quiet: Annotated[bool, Option("--quiet", "-q", help="Do not show progress bars.")] = False
 
+
+@app.command("create")
+class CreateArgs(FilterArgs):
+    """Downloads the CommonCrawl corpus and filters the documents.
+    If will save the documents in the destination directory in the format <group>.jsonl.zstd.
+
+    If a file <group>.jsonl.zstd is complete, it will be skipped.
+    The files are compressed with zstd. You can read them with `zstd -cd my_file.zstd`
+
+    While the code uses multiprocessing within a group, the whole dataset can be created even faster by using
+    xargs or slurm to run multiple groups in parallel. Use --group <group-idx> to download only one group.
+
+    Path of files can have two different formats:
+    - hf://org/repo-name/filename for huggingface files
+    - https://something.com/some/file
+    - /path/to/file for local files
+
+    You can list all the languages available in the language detection model with `dactory list-languages`.
+    """
+
+    destination_directory: Annotated[
+        Path,
+        Argument(
+            help="Directory to save the downloaded files. They will be saved at DESTINATION_DIRECTORY/<group>.jsonl.zstd"
+        ),
+    ]
+    corpus: Annotated[str, Option("--corpus", "-c", help="The CommonCrawl corpus")] = (
+        "CC-MAIN-2024-51"
+    )
+    read_ahead_mb: Annotated[
+        int,
+        Option(help="Size of the buffer filled in the background by each download, in MB."),
+    ] = 64
+    warc_cache_dir: Annotated[
+        Path | None,
+        Option(
+            help="Keep a copy of the downloaded WARC files there, and read them from there on the next runs."
+        ),
+    ] = None
+    warc_cache_size_gb: Annotated[
+        int,
+        Option(help="Size of the WARC cache, the files used the least recently are removed."),
+    ] = 1000
+    content_types: Annotated[
+        str,
+        Option(
+            help=(
+                "A comma delimited list of the content types of the records to extract, from "
+                f"their HTTP headers, `{','.join(HTML_CONTENT_TYPES)}` for the web pages. "
+                "`ALL` for no filter."
+            )
+        ),
+    ] = "ALL"
+    only_successful_responses: Annotated[
+        bool, Option(help="Skip the HTTP responses whose status is not 2xx.")
+    ] = False
+    max_payload_size_mb: Annotated[
+        float,
+        Option(
+            help=(
+                "Skip the records larger than this before extracting their text, in MB. "
+                "0 for no limit."
+            )
+        ),
+    ] = 0.0
+    blocked_domains: Annotated[
+        str,
+        Option(
+            help=(
+                "Path or url of a file with one domain per line, the records of these domains "
+                "and their subdomains are skipped."
+            )
+        ),
+    ] = "none"
+    allowed_domains: Annotated[
+        str,
+        Option(
+            help=(
+                "Path or url of a file with one domain per line, only the records of these "
+                "domains and their subdomains are extracted."
+            )
+        ),
+    ] = "none"
+    lid_sample_chars: Annotated[
+        int,
+        Option(
+            help=(
+                "Identify the language of the longer texts on evenly spaced chunks of this many "
+                "characters in total, then on the whole text only if the score is below "
+                "--lid-decision-score. Use 0 to always use the whole text."
+            )
+        ),
+    ] = 0
+    lid_decision_score: Annotated[
+        float,
+        Option(
+            help=(
+                "Minimum language score on the chunks to keep or reject the document, never "
+                "below the score required on the whole text (0.8)."
+            )
+        ),
+    ] = 0.95
+    lid_audit_rate: Annotated[
+        float,
+        Option(
+            help=(
+                "Fraction of the decisions on the chunks compared to the language of the "
+                "whole text, the agreement is shown with the progress."
+            )
+        ),
+    ] = 0.0
+    extract_only: Annotated[
+        bool,
+        Option(
+            help=(
+                "Only download the documents and detect their language, without the other filters. "
+                "Use `dactory refilter` on the result to try different filters."
+            )
+        ),
+    ] = False
+
     def __init__(self, **cli_args) -> None:
         super().__init__(**cli_args)
         loaded_args = parse_args_and_load_models(self)
         dactory.create.create_dataset(loaded_args)
 
 
-def get_languages(user_args: CreateArgs, lang_detection_model) -> list[str]:
+@app.command("refilter")
+class RefilterArgs(FilterArgs):
+    """Runs the deduplication and the filters on documents extracted by `dactory create --extract-only`.
+
+    It works like `dactory create`, reading SOURCE_DIRECTORY/<group>.jsonl.zstd instead of
+    downloading the WARC files of the group. Only the groups fully extracted can be used.
+    """
+
+    source_directory: Annotated[
+        Path,
+        Argument(help="Directory where `dactory create --extract-only` saved the documents."),
+    ]
+    destination_directory: Annotated[
+        Path,
+        Argument(
+            help="Directory to save the filtered documents. They will be saved at DESTINATION_DIRECTORY/<group>.jsonl.zstd"
+        ),
+    ]
+
+    def __init__(self, **cli_args) -> None:
+        super().__init__(**cli_args)
+        loaded_args = parse_refilter_args_and_load_models(self)
+        dactory.refilter.refilter_dataset(loaded_args)
+
+
+def get_languages(user_args: FilterArgs, lang_detection_model) -> list[str]:
     """Get the languages to download."""
     if user_args.languages == "ALL":
         languages = get_all_languages_available(lang_detection_model)
@@ -201,6 +521,50 @@ def parse_groups_to_do(command_line_arg: str, number_of_warcs: int) -> list[int]
                 )
 
 
+def load_filters(user_args: FilterArgs, languages: list[str]) -> dict:
+    """The arguments of LoadedArgs shared by `create` and `refilter`."""
+    if user_args.output_format == OutputFormat.parquet:
+        check_pyarrow()
+        if user_args.shard_size_mb > 0:
+            raise ValueError("--shard-size-mb is only supported with `--output-format jsonl`")
+    return dict(
+        workers=user_args.workers,
+        filter_workers=user_args.filter_workers,
+        min_length=user_args.min_length,
+        bloom_filter=user_args.bloom_filter,
+        min_bloom_threshold=user_args.min_bloom_threshold,
+        save_bloom_filters=user_args.save_bloom_filters,
+        scoring_models=get_scoring_models(
+            user_args.scoring_models,
+            languages,
+            user_args.load_models_early,
+            user_args.score_cache_lines,
+            int(user_args.scoring_models_max_memory_gb * 1e9),
+        ),
+        max_rand_score=user_args.max_rand_score,
+        enable_gopher_filters=user_args.enable_gopher_filters,
+        enable_gopher_repetition_filters=user_args.enable_gopher_repetition_filters,
+        enable_minhash_dedup=user_args.enable_minhash_dedup,
+        minhash_threshold=user_args.minhash_threshold,
+        minhash_num_perm=user_args.minhash_num_perm,
+        minhash_ngram_size=user_args.minhash_ngram_size,
+        minhash_words=user_args.minhash_words,
+        minhash_max_memory=int(user_args.minhash_max_memory_gb * 1e9),
+        quality_classifier=get_quality_classifier(
+            user_args.quality_classifier, user_args.score_cache_lines
+        ),
+        max_dclm_low_score=user_args.max_dclm_low_score,
+        output=OutputOptions(
+            format=user_args.output_format,
+            level=user_args.zstd_level,
+            threads=user_args.zstd_threads,
+            long_distance_matching=user_args.zstd_long_distance_matching,
+            shard_size=user_args.shard_size_mb << 20,
+        ),
+        quiet=user_args.quiet,
+    )
+
+
 def parse_args_and_load_models(user_args: CreateArgs) -> dactory.create.LoadedArgs:
     """Parse the command line arguments and load the models."""
     lang_detection_model = load_language_detection_model(user_args.lang_detection_model)
@@ -209,29 +573,84 @@ def parse_args_and_load_models(user_args: CreateArgs) -> dactory.create.LoadedAr
     user_args.destination_directory.mkdir(parents=True, exist_ok=True)
     warc_paths = get_warc_groups(user_args.corpus)
     groups = parse_groups_to_do(user_args.groups, len(warc_paths))
+    if user_args.extract_only:
+        # The other filters will run with `dactory refilter`, no need to load their models.
+        user_args = user_args.model_copy(
+            update=dict(
+                bloom_filter="none",
+                scoring_models="none",
+                quality_classifier="none",
+                enable_gopher_filters=False,
+                enable_gopher_repetition_filters=False,
+                enable_minhash_dedup=False,
+            )
+        )
 
     return dactory.create.LoadedArgs(
         destination_directory=user_args.destination_directory,
         corpus=user_args.corpus,
-        workers=user_args.workers,
         groups=groups,
         warc_paths=warc_paths,
-        min_length=user_args.min_length,
         lang_detection_model=lang_detection_model,
         languages=languages,
-        bloom_filter=user_args.bloom_filter,
-        min_bloom_threshold=user_args.min_bloom_threshold,
-        scoring_models=get_scoring_models(
-            user_args.scoring_models, languages, user_args.load_models_early
+        fetcher=WarcFetcher(
+            max_concurrency=user_args.workers,
+            read_ahead=user_args.read_ahead_mb << 20,
+            cache=None
+            if user_args.warc_cache_dir is None
+            else WarcCache(user_args.warc_cache_dir, user_args.warc_cache_size_gb << 30),
         ),
-        max_rand_score=user_args.max_rand_score,
-        enable_gopher_filters=user_args.enable_gopher_filters,
-        enable_minhash_dedup=user_args.enable_minhash_dedup,
-        minhash_threshold=user_args.minhash_threshold,
-        minhash_num_perm=user_args.minhash_num_perm,
-        quality_classifier=get_quality_classifier(user_args.quality_classifier),
-        max_dclm_low_score=user_args.max_dclm_low_score,
-        quiet=user_args.quiet,
+        prefilter=RecordPrefilter(
+            content_types=()
+            if user_args.content_types == "ALL"
+            else tuple(t.strip().lower() for t in user_args.content_types.split(",")),
+            only_successful_responses=user_args.only_successful_responses,
+            # The text extracted is never longer than the HTML.
+            min_payload_size=user_args.min_length,
+            max_payload_size=int(user_args.max_payload_size_mb * 1e6),
+            blocked_domains=load_domains(user_args.blocked_domains) or frozenset(),
+            allowed_domains=load_domains(user_args.allowed_domains),
+        ),
+        lid_sampling=LanguageSampling(
+            num_chars=user_args.lid_sample_chars,
+            decision_score=user_args.lid_decision_score,
+            audit_rate=user_args.lid_audit_rate,
+        )
+        if user_args.lid_sample_chars > 0
+        else None,
+        extract_only=user_args.extract_only,
+        **load_filters(user_args, languages),
+    )
+
+
+def parse_refilter_args_and_load_models(user_args: RefilterArgs) -> dactory.create.LoadedArgs:
+    """Same as `parse_args_and_load_models`, the groups come from the source directory."""
+    # The language detection model is only needed to list the languages.
+    lang_detection_model = (
+        load_language_detection_model(user_args.lang_detection_model)
+        if user_args.languages == "ALL"
+        else None
+    )
+    languages = get_languages(user_args, lang_detection_model)
+
+    user_args.destination_directory.mkdir(parents=True, exist_ok=True)
+    group_files = dactory.refilter.source_group_files(user_args.source_directory)
+    groups = parse_groups_to_do(user_args.groups, len(group_files))
+    if user_args.groups == "ALL":
+        groups = [group_idx for group_idx in groups if group_files[group_idx]]
+
+    return dactory.create.LoadedArgs(
+        destination_directory=user_args.destination_directory,
+        corpus=str(user_args.source_directory),
+        groups=groups,
+        warc_paths=group_files,
+        lang_detection_model=None,
+        languages=languages,
+        fetcher=None,
+        prefilter=None,
+        lid_sampling=None,
+        extract_only=False,
+        **load_filters(user_args, languages),
     )
 
 
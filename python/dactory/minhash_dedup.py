@@ -1,22 +1,79 @@
-from datasketch import MinHash, MinHashLSH
+from functools import cache
+from pathlib import Path
 
-from dactory import compute_minhash_signature
+import numpy as np
+
+from dactory import LshIndex, compute_minhash_signature_batch
+
+
+def _integrate(f, start: float, end: float, num_points: int = 1001) -> float:
+    """Simpson's rule, the functions are smooth."""
+    x = np.linspace(start, end, num_points)
+    y = f(x)
+    step = (end - start) / (num_points - 1)
+    return step / 3 * (y[0] + 4 * y[1:-1:2].sum() + 2 * y[2:-1:2].sum() + y[-1])
+
+
+@cache
+def optimal_lsh_param(threshold: float, num_perm: int) -> tuple[int, int]:
+    """Number of bands and rows per band minimizing the sum of the probabilities of false
+    positives and false negatives, like `datasketch.MinHashLSH`."""
+    min_error = float("inf")
+    optimal = (0, 0)
+    for num_bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // num_bands + 1):
+            false_positive = _integrate(
+                lambda s: 1 - (1 - s**rows) ** num_bands, 0.0, threshold
+            )
+            false_negative = _integrate(lambda s: (1 - s**rows) ** num_bands, threshold, 1.0)
+            error = 0.5 * false_positive + 0.5 * false_negative
+            if error < min_error:
+                min_error = error
+                optimal = (num_bands, rows)
+    return optimal
 
 
 class MinHashDeduplicator:
-    def __init__(self, threshold: float = 0.8, num_perm: int = 128, ngram_size: int = 5):
+    """`ngram_size` is a number of bytes, or of words with `words`.
+
+    The index uses at most `max_memory` bytes. Once it is full, the documents are still
+    compared to the ones already indexed, but are not indexed anymore. With `snapshot`, the
+    index starts from the one saved with `save`."""
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        ngram_size: int = 5,
+        words: bool = False,
+        max_memory: int = 8 << 30,
+        snapshot: Path | None = None,
+    ):
         self.threshold = threshold
         self.num_perm = num_perm
         self.ngram_size = ngram_size
-        self.lsh = MinHashLSH(threshold=threshold, num_perm=num_perm)
-        self._counter = 0
+        self.words = words
+        num_bands, rows = optimal_lsh_param(threshold, num_perm)
+        if snapshot is None:
+            self.index = LshIndex(num_bands, rows, max_memory)
+        else:
+            self.index = LshIndex.load(str(snapshot), max_memory)
+            if (self.index.num_bands, self.index.rows) != (num_bands, rows):
+                raise ValueError(
+                    f"{snapshot} was saved with other MinHash parameters: {self.index.num_bands} "
+                    f"bands of {self.index.rows} rows instead of {num_bands} bands of {rows} rows"
+                )
 
     def is_duplicate(self, text: str) -> bool:
-        sig = compute_minhash_signature(text, self.num_perm, self.ngram_size)
-        mh = MinHash(num_perm=self.num_perm)
-        mh.hashvalues[:] = sig
-        if self.lsh.query(mh):
-            return True
-        self.lsh.insert(str(self._counter), mh)
-        self._counter += 1
-        return False
+        return self.are_duplicates([text])[0]
+
+    def are_duplicates(self, texts: list[str]) -> list[bool]:
+        """Same as `is_duplicate` on each text in order, the signatures are computed in
+        parallel. A text can be a duplicate of one before it in the list."""
+        signatures = compute_minhash_signature_batch(
+            texts, self.num_perm, self.ngram_size, self.words
+        )
+        return self.index.query_and_insert_batch(signatures)
+
+    def save(self, path: Path):
+        self.index.save(str(path))
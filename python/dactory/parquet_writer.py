@@ -0,0 +1,109 @@
+"""Columnar output of the groups, with `--output-format parquet`.
+
+The scores and the Gopher metrics of the documents are stored as one column each, next to
+the text, so they can be read without the text and filtered with the statistics of the row
+groups, for example with
+`pq.read_table(path, columns=["url"], filters=[("score_rand", "<", 0.5)])`.
+pyarrow is only needed for this format, it is installed with `pip install dactory[parquet]`.
+"""
+
+import io
+import json
+from collections.abc import Iterator
+from pathlib import Path
+
+import zstandard as zstd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Documents in each row group of the Parquet files.
+ROW_GROUP_SIZE = 10_000
+# The fields of a Document, with their name in the JSON lines, except the scores and metrics.
+DOCUMENT_COLUMNS = {
+    "text": "string",
+    "date": "string",
+    "url": "string",
+    "language": "string",
+    "language_score": "float64",
+    "warc-id": "string",
+    "group_idx": "int64",
+    "warc_file": "string",
+    "record_idx": "int64",
+    "repetitions": "float64",
+    "long_words": "float64",
+}
+SCORE_PREFIX = "score_"
+GOPHER_PREFIX = "gopher_"
+
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError(
+            "pyarrow is needed for `--output-format parquet`, install it with "
+            "`pip install dactory[parquet]`."
+        )
+
+
+def read_json_lines(path: Path) -> Iterator[dict]:
+    with path.open("rb") as in_f:
+        with zstd.ZstdDecompressor().stream_reader(
+            in_f, read_across_frames=True
+        ) as in_f_decompressed:
+            for line in io.TextIOWrapper(in_f_decompressed, encoding="utf-8"):
+                yield json.loads(line)
+
+
+def document_schema(score_names: list[str], metric_names: list[str]) -> "pa.Schema":
+    return pa.schema(
+        [(name, pa.type_for_alias(type_)) for name, type_ in DOCUMENT_COLUMNS.items()]
+        + [(SCORE_PREFIX + name, pa.float64()) for name in score_names]
+        + [(GOPHER_PREFIX + name, pa.float64()) for name in metric_names]
+    )
+
+
+def documents_table(documents: list[dict], schema: "pa.Schema") -> "pa.Table":
+    columns = {name: [d[name] for d in documents] for name in DOCUMENT_COLUMNS}
+    for name in schema.names:
+        if name.startswith(SCORE_PREFIX):
+            key = name.removeprefix(SCORE_PREFIX)
+            columns[name] = [d["scores"].get(key) for d in documents]
+        elif name.startswith(GOPHER_PREFIX):
+            key = name.removeprefix(GOPHER_PREFIX)
+            columns[name] = [(d.get("gopher_metrics") or {}).get(key) for d in documents]
+    return pa.table(columns, schema=schema)
+
+
+def write_parquet(
+    source: Path, path: Path, compression_level: int, row_group_size: int = ROW_GROUP_SIZE
+) -> int:
+    """Writes the documents of the JSON lines file `source` to the Parquet file `path`, and
+    returns their number.
+
+    The scores and metrics are not the same for all the documents, a first pass over `source`
+    finds the columns needed, the documents without one of them have a null value there.
+    """
+    check_pyarrow()
+    score_names, metric_names = set(), set()
+    for document in read_json_lines(source):
+        score_names.update(document["scores"])
+        metric_names.update(document.get("gopher_metrics") or ())
+    schema = document_schema(sorted(score_names), sorted(metric_names))
+    num_documents = 0
+    with pq.ParquetWriter(
+        path, schema, compression="zstd", compression_level=compression_level
+    ) as writer:
+        documents = []
+        for document in read_json_lines(source):
+            documents.append(document)
+            if len(documents) == row_group_size:
+                writer.write_table(documents_table(documents, schema), row_group_size)
+                num_documents += len(documents)
+                documents = []
+        if documents:
+            writer.write_table(documents_table(documents, schema), row_group_size)
+            num_documents += len(documents)
+    return num_documents
@@ -0,0 +1,91 @@
+"""Rejecting the WARC records from their headers, before decoding and extracting their text.
+
+The text extraction is the most expensive step of the download workers, and most records are
+rejected after it. The checks here only read the WARC and HTTP headers and the length of the
+payload, and name the reason of the rejection, which `dactory create` counts.
+
+By default, only the records that can't give a document are rejected, the others are
+extracted as before. The checks on the HTTP status, the content type and the size of the
+payload also reject records that could, and are enabled by the options of `dactory create`.
+"""
+
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+from fastwarc.warc import WarcRecord
+
+from dactory.download_models import download_if_necessary
+
+# The content types of the web pages, a value for `content_types`.
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+
+
+@dataclass
+class RecordPrefilter:
+    # Empty to extract all the content types.
+    content_types: tuple[str, ...] = ()
+    # Reject the HTTP responses whose status is not 2xx.
+    only_successful_responses: bool = False
+    # In bytes, 0 for no limit. A payload not longer than `min_payload_size` can't give a text
+    # longer than it, the HTML tags and entities are longer than what they become.
+    min_payload_size: int = 0
+    max_payload_size: int = 0
+    # Domains whose records are rejected, with their subdomains.
+    blocked_domains: frozenset[str] = frozenset()
+    # If not None, the records of the other domains are rejected.
+    allowed_domains: frozenset[str] | None = None
+
+    def rejection_reason(self, record: WarcRecord) -> str | None:
+        """The name of the first check the record fails, None if it passes them all."""
+        if record.headers["WARC-Type"] != "response":
+            return "not_response"
+        if (
+            self.only_successful_responses
+            and record.is_http
+            and not 200 <= record.http_headers.status_code < 300
+        ):
+            return "http_status"
+        if self.content_types and (content_type := get_content_type(record)) is not None:
+            if content_type not in self.content_types:
+                return "content_type"
+        if record.content_length <= self.min_payload_size:
+            return "too_short"
+        if self.max_payload_size and record.content_length > self.max_payload_size:
+            return "payload_size"
+        if self.blocked_domains or self.allowed_domains is not None:
+            domains = parent_domains(record.headers["WARC-Target-URI"])
+            if not self.blocked_domains.isdisjoint(domains):
+                return "blocked_domain"
+            if self.allowed_domains is not None and self.allowed_domains.isdisjoint(domains):
+                return "domain_not_allowed"
+        return None
+
+
+def get_content_type(record: WarcRecord) -> str | None:
+    """The content type sent by the server, or the one detected by the crawler."""
+    content_type = record.http_content_type if record.is_http else None
+    if not content_type:
+        content_type = record.headers.get("WARC-Identified-Payload-Type")
+    return content_type.strip().lower() if content_type else None
+
+
+def parent_domains(url: str) -> list[str]:
+    """`a.b.com` gives `a.b.com`, `b.com` and `com`."""
+    host = urlsplit(url).hostname or ""
+    parts = host.removeprefix("www.").split(".")
+    return [".".join(parts[i:]) for i in range(len(parts))]
+
+
+def load_domains(path_or_url: str) -> frozenset[str] | None:
+    """One domain per line, the empty lines and the ones starting with `#` are ignored. None
+    for `none`."""
+    if path_or_url.lower() == "none":
+        return None
+    path = download_if_necessary(path_or_url)
+    domains = set()
+    with path.open() as f:
+        for line in f:
+            line = line.strip().lower()
+            if line and not line.startswith("#"):
+                domains.add(line.removeprefix("www."))
+    return frozenset(domains)
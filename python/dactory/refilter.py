@@ -0,0 +1,105 @@
+"""Running the filters again on the documents saved by `dactory create --extract-only`.
+
+The download, the text extraction and the language detection are the slowest part of the
+pipeline, and don't depend on the filters. Each group file of the source directory replaces
+the WARCs of the group, and goes through the same deduplication and filters as in `create`.
+A group file, with all its shards if it was split, is a single task, read by one download
+worker, so only MAX_GROUPS_IN_PROGRESS of them are read at the same time: the filter workers
+do the rest of the work. The documents of a WARC can be in two shards, they must be read in
+order for the progress of the WARC to be right.
+"""
+
+import io
+import json
+from collections import Counter
+from pathlib import Path
+from typing import Iterator
+
+import zstandard as zstd
+
+from .create import GroupWriter, LoadedArgs, WarcResults, create_dataset
+from .document import Document
+from .rewinding import GroupProgress
+
+
+def read_documents(path: Path) -> Iterator[Document]:
+    with path.open("rb") as in_f:
+        with zstd.ZstdDecompressor().stream_reader(
+            in_f, read_across_frames=True
+        ) as in_f_decompressed:
+            for line in io.TextIOWrapper(in_f_decompressed, encoding="utf-8"):
+                yield Document.model_validate_json(line)
+
+
+def read_group_documents(path: Path) -> Iterator[Document]:
+    """The documents of a file of `source_group_files`, from its shards in order if it is a
+    manifest."""
+    for shard_path in group_shard_paths(path):
+        yield from read_documents(shard_path)
+
+
+def group_shard_paths(path: Path) -> list[Path]:
+    """The shards listed in `<group>.manifest.json`, or `<group>.jsonl.zstd` itself."""
+    if not path.name.endswith(".manifest.json"):
+        return [path]
+    manifest = json.loads(path.read_text())
+    return [path.parent / shard["path"] for shard in manifest["shards"]]
+
+
+def source_group_files(source_directory: Path) -> list[list[str]]:
+    """Like the WARC paths of the corpus, the file of each group: `<group>.jsonl.zstd`, or
+    `<group>.manifest.json` if it was split into shards. The groups not fully extracted in
+    the source directory have no file. The shards are only read through their manifest, the
+    ones without a manifest are left by an interrupted run."""
+    group_files = {}
+    for path in sorted(source_directory.iterdir()):
+        group, _, suffix = path.name.partition(".")
+        if group.isdigit() and suffix in ("jsonl.zstd", "manifest.json"):
+            group_files[int(group)] = [str(path)]
+    return [group_files.get(i, []) for i in range(max(group_files, default=-1) + 1)]
+
+
+def extracted_document_generator(
+    args: LoadedArgs, path: str, group_idx: int, previous_work: GroupProgress
+) -> Iterator[Document | WarcResults]:
+    """Like `document_generator`, for a whole group file. Skips what was already written
+    in the destination, for each WARC of the group."""
+    processed_records = 0
+    failed_records = 0
+    rejected_records = Counter()
+    if not previous_work[path].done:
+        for document in read_group_documents(Path(path)):
+            if document.record_idx <= previous_work[document.warc_file].last_record_seen:
+                continue
+            if document.language not in args.languages:
+                reason = "language"
+            elif len(document.text) <= args.min_length:
+                reason = "too_short"
+            else:
+                processed_records += 1
+                yield document
+                continue
+            failed_records += 1
+            rejected_records[reason] += 1
+    yield WarcResults(
+        warc_url=path,
+        group_idx=group_idx,
+        success=True,
+        processed_records=processed_records,
+        failed_records=failed_records,
+        rejected_records=dict(rejected_records),
+    )
+
+
+def extracted_tasks(group: GroupWriter) -> list[tuple[str, GroupProgress]]:
+    return [(path, group.work_already_done) for path in group.args.warc_paths[group.group_idx]]
+
+
+def refilter_dataset(args: LoadedArgs):
+    """`args.warc_paths` must come from `source_group_files`."""
+    for group_idx in args.groups:
+        if group_idx >= len(args.warc_paths) or not args.warc_paths[group_idx]:
+            raise ValueError(
+                f"Group {group_idx} wasn't fully extracted in the source directory"
+            )
+    create_dataset(args, extracted_document_generator, extracted_tasks)
@@ -1,4 +1,7 @@
 import io
+import json
+import os
+import time
 from pathlib import Path
 from typing import Self
 
@@ -8,41 +11,143 @@ from pydantic import BaseModel
 from tqdm import tqdm
 
 from .document import Document
+from .zstd_writer import FramedZstdWriter
+
+# How often the journal of the progress is synced to the disk, in seconds.
+JOURNAL_SYNC_SECONDS = 10.0
+# Changes appended to the journal before it is compacted into the progress file.
+JOURNAL_COMPACTION_LINES = 1000
 
 
 class WarcProgress(BaseModel):
     last_record_seen: int = -1
     done: bool = False
+    # Compressed offset of a gzip member boundary in the WARC, and the index of the record
+    # starting there. Every record before it was fully handled, so we can resume from there
+    # with a range request instead of downloading the whole file again.
+    resume_offset: int = 0
+    resume_record_idx: int = 0
 
 
 class GroupProgress(BaseModel):
-    """Progress within one single group."""
+    """Progress within one single group.
+
+    Each change saved is appended to a journal next to `persistent_path`, which is compacted
+    into it from time to time. The journal is synced to the disk at most every
+    JOURNAL_SYNC_SECONDS: after a crash, the last WARCs done can be seen as not done, their
+    records already written are then skipped.
+    """
 
     persistent_path: Path  # Save periodially there to avoid data loss
     warcs_progress: dict[str, WarcProgress]
+    # The sum of the records seen in each WARC, kept up to date by `set_last_record_seen`.
+    _records_seen: int = pydantic.PrivateAttr(0)
+    _journal_lines: int = pydantic.PrivateAttr(0)
+    _last_sync: float = pydantic.PrivateAttr(0.0)
+
+    def model_post_init(self, context):
+        self.count_records_seen()
 
     def __getitem__(self, item: str) -> WarcProgress:
         if item not in self.warcs_progress:
             self.warcs_progress[item] = WarcProgress()
         return self.warcs_progress[item]
 
+    @property
+    def journal_path(self) -> Path:
+        return self.persistent_path.with_suffix(".journal")
+
+    def set_last_record_seen(self, warc_file: str, record_idx: int):
+        progress = self[warc_file]
+        self._records_seen += record_idx - progress.last_record_seen
+        progress.last_record_seen = record_idx
+
+    def count_records_seen(self):
+        self._records_seen = sum(x.last_record_seen + 1 for x in self.warcs_progress.values())
+
     def nb_records_seen(self) -> int:
-        return sum(x.last_record_seen for x in self.warcs_progress.values())
+        return self._records_seen
+
+    def save(self, warc_file: str):
+        """Appends the progress of `warc_file` to the journal."""
+        entry = {"warc_file": warc_file, **self[warc_file].model_dump()}
+        with self.journal_path.open("a") as f:
+            f.write(json.dumps(entry) + "\n")
+            if time.monotonic() - self._last_sync > JOURNAL_SYNC_SECONDS:
+                f.flush()
+                os.fsync(f.fileno())
+                self._last_sync = time.monotonic()
+        self._journal_lines += 1
+        if self._journal_lines >= JOURNAL_COMPACTION_LINES:
+            self.compact()
+
+    def compact(self):
+        """Writes the whole progress to `persistent_path` at once, and empties the journal."""
+        tmp_path = self.persistent_path.with_name(self.persistent_path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            f.write(self.model_dump_json(indent=4))
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.rename(self.persistent_path)
+        # If we stop before this, the journal replayed on the progress changes nothing.
+        self.journal_path.unlink(missing_ok=True)
+        self._journal_lines = 0
 
-    def save(self):
-        """Note that the record seens may not be up to date, because we save each time a warc is done."""
-        self.persistent_path.write_text(self.model_dump_json(indent=4))
+    def unlink(self):
+        self.persistent_path.unlink(missing_ok=True)
+        self.journal_path.unlink(missing_ok=True)
 
     @staticmethod
     def try_to_load(path: Path) -> Self:
-        """Try to load the progress file. If it doesn't exist, create a new one."""
+        """Try to load the progress file and its journal. If they don't exist, create a new
+        one."""
         if path.exists():
-            return GroupProgress.model_validate_json(path.read_text())
-        return GroupProgress(persistent_path=path, warcs_progress={})
+            progress = GroupProgress.model_validate_json(path.read_text())
+        else:
+            progress = GroupProgress(persistent_path=path, warcs_progress={})
+        if progress.journal_path.exists():
+            with progress.journal_path.open("rb") as f:
+                for line in f:
+                    # The last line can be incomplete if we stopped while writing it.
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    warc_file = entry.pop("warc_file")
+                    progress.warcs_progress[warc_file] = WarcProgress(**entry)
+                    progress._journal_lines += 1
+            progress.count_records_seen()
+            # Start from a clean journal, without the incomplete line.
+            progress.compact()
+        return progress
+
+
+def resume_framed_file(
+    destination_tmp: Path, destination_index: Path, group_idx: int, progress_file: Path
+) -> GroupProgress:
+    """Same as `rewind_old_file` for a file written by FramedZstdWriter, which is cut after its
+    last complete frame instead of being copied."""
+    output = GroupProgress.try_to_load(progress_file)
+    last_records = FramedZstdWriter.recover(destination_tmp, destination_index)
+    for warc_file, progress in output.warcs_progress.items():
+        # The documents of a WARC are all written before it is marked as done.
+        if not progress.done:
+            output.set_last_record_seen(warc_file, last_records.get(warc_file, -1))
+    for warc_file, record_idx in last_records.items():
+        output.set_last_record_seen(warc_file, record_idx)
+    tqdm.write(
+        f"Resuming group {group_idx}, we's already seen {output.nb_records_seen():,} records. If this isn't what you want, abort and delete the destination directory."
+    )
+    return output
 
 
 def rewind_old_file(
-    destination_tmp_old: Path, output_file, group_idx: int, progress_file: Path
+    destination_tmp_old: Path,
+    output_file: FramedZstdWriter,
+    group_idx: int,
+    progress_file: Path,
 ) -> GroupProgress:
     # We need to do two things:
     # 1. Find out where we stopped at each warc file
@@ -52,12 +157,14 @@ def rewind_old_file(
         return output
     try:
         with destination_tmp_old.open("rb") as in_f:
-            with zstd.ZstdDecompressor().stream_reader(in_f) as in_f_decompressed:
+            with zstd.ZstdDecompressor().stream_reader(
+                in_f, read_across_frames=True
+            ) as in_f_decompressed:
                 in_f_decompressed_text = io.TextIOWrapper(in_f_decompressed, encoding="utf-8")
                 for line in in_f_decompressed_text:
                     doc = Document.model_validate_json(line)
-                    output[doc.warc_file].last_record_seen = doc.record_idx
-                    output_file.write(line.encode("utf-8"))
+                    output.set_last_record_seen(doc.warc_file, doc.record_idx)
+                    output_file.write(line.encode("utf-8"), doc.warc_file, doc.record_idx)
     except (pydantic.ValidationError, UnicodeDecodeError):
         # An error is expected, it's very likely we stopped in the middle of a record
         pass
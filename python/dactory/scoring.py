@@ -1,67 +1,155 @@
+import os
+from collections import OrderedDict
+from collections.abc import Sequence
+from pathlib import Path
+
 from tqdm import tqdm
 
 from dactory import FastTextPyWrapper
 from dactory.download_models import download_if_necessary
 
 
+def scores_dict(labels: Sequence[str], scores: list[float] | None) -> dict[str, float]:
+    """The scores of `FastTextPyWrapper.get_doc_scores` with the names of the labels. Empty
+    if the document has no line."""
+    if scores is None:
+        return {}
+    return dict(zip(labels, scores))
+
+
 def get_model_path_for_lang(models_directory: str, lang: str) -> str:
     return models_directory.removesuffix("/") + f"/filter_{lang}.bin"
 
 
 class ScoringModels:
-    """We load the models lazily for a better UX."""
+    """We load the models lazily for a better UX.
+
+    The models loaded before the filter workers are forked are shared by all of them, since the
+    weights are never written. The models of the other languages are loaded by each worker when
+    the language appears. With `max_memory`, the least recently used of these are unloaded to
+    keep their total size below it.
+    """
 
     def __init__(
-        self, models_directory: str, languages_supported: list[str], load_models_early: bool
+        self,
+        models_directory: str,
+        languages_supported: list[str],
+        load_models_early: bool,
+        cache_size: int = 0,
+        max_memory: int = 0,
     ):
         self.models_directory = models_directory
         self.languages_supported = languages_supported
-        self.models = {}
+        # Lines whose scores are kept by each model, see `FastTextPyWrapper.load`.
+        self.cache_size = cache_size
+        # In bytes, 0 for no limit.
+        self.max_memory = max_memory
+        # From the least to the most recently used.
+        self.models: OrderedDict[str, FastTextPyWrapper] = OrderedDict()
+        # The labels of each model, in the order of its scores.
+        self.labels = {}
+        # The process which loaded each model and its size. The models loaded by another
+        # process were inherited from it and are shared.
+        self.loaded_by: dict[str, tuple[int, int]] = {}
+        # The cache hits and misses of the models unloaded.
+        self.unloaded_cache_stats = (0, 0)
         if load_models_early:
             self.load_all_models()
 
     def load_all_models(self):
         for lang in self.languages_supported:
+            size = self.download_model(lang).stat().st_size
+            if self.max_memory and self.memory_usage() + size > self.max_memory:
+                tqdm.write(
+                    "The scoring models don't all fit in the memory limit, the next ones "
+                    "will be loaded when needed"
+                )
+                return
             self.load_model_if_necessary(lang)
 
-    def load_model_if_necessary(self, lang: str):
-        if lang in self.models:
-            return
+    def download_model(self, lang: str) -> Path:
         model_path_or_url = get_model_path_for_lang(self.models_directory, lang)
         model_path = download_if_necessary(model_path_or_url)
         if not model_path.exists():
             raise FileNotFoundError(f"Model for {lang} not found at {model_path}")
+        return model_path
+
+    def memory_usage(self) -> int:
+        """The size of the models loaded by this process, the ones it can unload."""
+        pid = os.getpid()
+        return sum(size for owner, size in self.loaded_by.values() if owner == pid)
+
+    def load_model_if_necessary(self, lang: str):
+        if lang in self.models:
+            self.models.move_to_end(lang)
+            return
+        model_path = self.download_model(lang)
+        # The weights of a fastText model are about the size of its file.
+        size = model_path.stat().st_size
+        self.unload_models(self.max_memory - size)
         tqdm.write(f"Loading scoring model for language: {lang}")
-        self.models[lang] = FastTextPyWrapper.load(str(model_path))
+        self.models[lang] = FastTextPyWrapper.load(str(model_path), self.cache_size)
+        self.labels[lang] = self.models[lang].labels()
+        self.loaded_by[lang] = (os.getpid(), size)
+
+    def unload_models(self, memory_available: int):
+        """Unloads the least recently used models loaded by this process until they use less
+        than `memory_available`, if there is a limit."""
+        if not self.max_memory:
+            return
+        pid = os.getpid()
+        for lang in [lang for lang in self.models if self.loaded_by[lang][0] == pid]:
+            if self.memory_usage() <= memory_available:
+                return
+            tqdm.write(f"Unloading scoring model for language: {lang}")
+            model = self.models.pop(lang)
+            hits, misses = self.unloaded_cache_stats
+            self.unloaded_cache_stats = (hits + model.cache_hits, misses + model.cache_misses)
+            del self.labels[lang], self.loaded_by[lang]
 
     def get_doc_scores(self, text: str, lang: str) -> dict[str, float]:
         if lang not in self.languages_supported:
             raise ValueError(f"Language {lang} not supported")
         self.load_model_if_necessary(lang)
-        return self.models[lang].get_doc_annotations(text)
+        return scores_dict(self.labels[lang], self.models[lang].get_doc_scores(text))
+
+    def cache_stats(self) -> tuple[int, int]:
+        """The hits and the misses of the line caches of all the models loaded."""
+        hits, misses = self.unloaded_cache_stats
+        hits += sum(model.cache_hits for model in self.models.values())
+        misses += sum(model.cache_misses for model in self.models.values())
+        return hits, misses
 
 
 class QualityClassifier:
-    def __init__(self, model_path_or_url: str):
+    def __init__(self, model_path_or_url: str, cache_size: int = 0):
         path = download_if_necessary(model_path_or_url)
         if not path.exists():
             raise FileNotFoundError(f"Quality classifier model not found at {path}")
         tqdm.write(f"Loading quality classifier model from: {path}")
-        self.model = FastTextPyWrapper.load(str(path))
+        self.model = FastTextPyWrapper.load(str(path), cache_size)
+        self.labels = self.model.labels()
 
     def get_quality_score(self, text: str) -> dict[str, float]:
-        return self.model.get_doc_annotations(text)
+        return scores_dict(self.labels, self.model.get_doc_scores(text))
+
+    def cache_stats(self) -> tuple[int, int]:
+        return self.model.cache_hits, self.model.cache_misses
 
 
 def get_scoring_models(
-    path_or_url: str, languages: list[str], load_models_early: bool
+    path_or_url: str,
+    languages: list[str],
+    load_models_early: bool,
+    cache_size: int = 0,
+    max_memory: int = 0,
 ) -> ScoringModels | None:
     if path_or_url.lower() == "none":
         return None
-    return ScoringModels(path_or_url, languages, load_models_early)
+    return ScoringModels(path_or_url, languages, load_models_early, cache_size, max_memory)
 
 
-def get_quality_classifier(path_or_url: str) -> QualityClassifier | None:
+def get_quality_classifier(path_or_url: str, cache_size: int = 0) -> QualityClassifier | None:
     if path_or_url.lower() == "none":
         return None
-    return QualityClassifier(path_or_url)
+    return QualityClassifier(path_or_url, cache_size)
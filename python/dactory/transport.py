@@ -0,0 +1,203 @@
+"""Moving documents between processes without pickling them one by one.
+
+The documents are stored column by column (like an arrow record batch) in a shared memory
+segment, and only a small handle goes through the multiprocessing queues.
+"""
+
+from dataclasses import dataclass, fields, replace
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from .document import Document
+
+# Number of documents in a batch sent by a worker.
+TRANSPORT_BATCH_SIZE = 64
+
+# The text is last, so the deduplication can replace it and copy the rest as it is.
+STRING_COLUMNS = ("date", "url", "language", "warc_id", "warc_file", "text")
+NUMBER_COLUMNS = {"language_score": np.float64, "group_idx": np.int64, "record_idx": np.int64}
+
+
+def start_resource_tracker():
+    """Must be called before starting the workers. Then all the processes share the same
+    resource tracker, which frees the shared memory left behind if the processes are stopped
+    before reading all the batches."""
+    resource_tracker.ensure_running()
+
+
+def encode_strings(values: list[str]) -> list[bytes]:
+    """The offsets and the utf-8 data of a string column, padded to 8 bytes."""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = b"".join(encoded)
+    return [offsets.tobytes(), data + b"\0" * (-len(data) % 8)]
+
+
+def decode_strings(data: bytes, num_documents: int, position: int) -> tuple[list[str], int]:
+    """The string column at `position` in `data`, and the position of the next column."""
+    offsets = np.frombuffer(
+        data, dtype=np.int64, count=num_documents + 1, offset=position
+    ).tolist()
+    position += 8 * (num_documents + 1)
+    values = [
+        data[position + start : position + end].decode("utf-8")
+        for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+    return values, position + offsets[-1] + (-offsets[-1] % 8)
+
+
+def write_shared_memory(parts: list[bytes]) -> tuple[str, int]:
+    size = sum(len(part) for part in parts)
+    shm = SharedMemory(create=True, size=max(size, 1))
+    position = 0
+    for part in parts:
+        shm.buf[position : position + len(part)] = part
+        position += len(part)
+    shm.close()
+    return shm.name, size
+
+
+@dataclass
+class SharedDocumentBatch:
+    """Handle of a DocumentBatch in shared memory. This is what goes through the queues."""
+
+    name: str
+    size: int
+    num_documents: int
+    group_idx: int
+    # Where the text column starts.
+    text_position: int
+    # The documents still in the batch after the deduplication, None if all of them are.
+    keep: list[bool] | None = None
+
+    def load(self) -> "DocumentBatch":
+        """Copy the batch out of the shared memory, and free it. Can only be called once."""
+        shm = SharedMemory(name=self.name)
+        try:
+            data = bytes(shm.buf[: self.size])
+        finally:
+            shm.close()
+            shm.unlink()
+        batch = DocumentBatch.decode(data, self.num_documents)
+        return batch if self.keep is None else batch.select(self.keep)
+
+    def load_text(self) -> list[str]:
+        """Only decode the text column. The batch stays in the shared memory."""
+        shm = SharedMemory(name=self.name)
+        try:
+            data = bytes(shm.buf[self.text_position : self.size])
+        finally:
+            shm.close()
+        return decode_strings(data, self.num_documents, 0)[0]
+
+    def unlink(self):
+        shm = SharedMemory(name=self.name)
+        shm.close()
+        shm.unlink()
+
+    def replace_text(self, text: list[str] | None, keep: list[bool]) -> "SharedDocumentBatch":
+        """The batch with a new text for each document, or the same one if `text` is None.
+        The other columns are copied without being decoded, and the documents where `keep` is
+        False are only removed by `load`. The old batch is freed."""
+        if text is None:
+            return replace(self, keep=keep)
+        shm = SharedMemory(name=self.name)
+        try:
+            columns = bytes(shm.buf[: self.text_position])
+        finally:
+            shm.close()
+            shm.unlink()
+        name, size = write_shared_memory([columns, *encode_strings(text)])
+        return replace(self, name=name, size=size, keep=keep)
+
+
+@dataclass
+class DocumentBatch:
+    """Documents coming out of the download workers, stored column by column.
+    All the documents of a batch come from the same WARC."""
+
+    text: list[str]
+    date: list[str]
+    url: list[str]
+    language: list[str]
+    warc_id: list[str]
+    warc_file: list[str]
+    language_score: list[float]
+    group_idx: list[int]
+    record_idx: list[int]
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    @staticmethod
+    def from_documents(documents: list[Document]) -> "DocumentBatch":
+        columns = {field.name: [] for field in fields(DocumentBatch)}
+        for document in documents:
+            for name, values in columns.items():
+                values.append(getattr(document, name))
+        return DocumentBatch(**columns)
+
+    def to_documents(self) -> list[Document]:
+        return [
+            Document(
+                text=self.text[i],
+                date=self.date[i],
+                url=self.url[i],
+                language=self.language[i],
+                language_score=self.language_score[i],
+                warc_id=self.warc_id[i],
+                scores={},
+                group_idx=self.group_idx[i],
+                warc_file=self.warc_file[i],
+                record_idx=self.record_idx[i],
+                repetitions=None,
+                long_words=None,
+            )
+            for i in range(len(self))
+        ]
+
+    def select(self, keep: list[bool]) -> "DocumentBatch":
+        """Only keep the documents where `keep` is True."""
+        columns = {}
+        for field in fields(self):
+            values = getattr(self, field.name)
+            columns[field.name] = [v for v, k in zip(values, keep) if k]
+        return DocumentBatch(**columns)
+
+    def encode(self) -> list[bytes]:
+        """The numbers first, then for each string column the offsets and the utf-8 data,
+        with the text last. Every part is padded to 8 bytes so the arrays are aligned."""
+        parts = []
+        for name, dtype in NUMBER_COLUMNS.items():
+            parts.append(np.asarray(getattr(self, name), dtype=dtype).tobytes())
+        for name in STRING_COLUMNS:
+            parts.extend(encode_strings(getattr(self, name)))
+        return parts
+
+    @staticmethod
+    def decode(data: bytes, num_documents: int) -> "DocumentBatch":
+        columns = {}
+        position = 0
+        for name, dtype in NUMBER_COLUMNS.items():
+            array = np.frombuffer(data, dtype=dtype, count=num_documents, offset=position)
+            columns[name] = array.tolist()
+            position += array.nbytes
+        for name in STRING_COLUMNS:
+            columns[name], position = decode_strings(data, num_documents, position)
+        return DocumentBatch(**columns)
+
+    def to_shared_memory(self) -> SharedDocumentBatch:
+        parts = self.encode()
+        name, size = write_shared_memory(parts)
+        # The text column is made of the last two parts.
+        text_position = size - len(parts[-2]) - len(parts[-1])
+        return SharedDocumentBatch(
+            name=name,
+            size=size,
+            num_documents=len(self),
+            group_idx=self.group_idx[0],
+            text_position=text_position,
+        )
@@ -0,0 +1,72 @@
+"""Local copy of the WARC files, to run the pipeline again without downloading them.
+
+The files are named after the hash of their URL, the WARCs of CommonCrawl never change. They
+are written to a `.part` file while being downloaded, and only renamed once complete. When
+the cache is bigger than its maximum size, the files used the least recently are removed.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO
+
+# Downloads not written to for this long come from a process that was stopped.
+STALE_PART_SECONDS = 3600
+
+
+class WarcCache:
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.remove_stale_parts()
+
+    def path(self, url: str) -> Path:
+        return self.directory / (hashlib.sha256(url.encode()).hexdigest() + ".warc.gz")
+
+    def get(self, url: str) -> Path | None:
+        path = self.path(url)
+        try:
+            # The modification time is used as last access time for the eviction.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def create_part(self, url: str) -> tuple[Path, BinaryIO]:
+        """File to write the download to, pass it to `commit` once complete."""
+        fd, name = tempfile.mkstemp(
+            dir=self.directory, prefix=self.path(url).name + ".", suffix=".part"
+        )
+        return Path(name), os.fdopen(fd, "wb")
+
+    def commit(self, url: str, part: Path):
+        part.rename(self.path(url))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache fits in `max_size`.
+        Several processes can do it at the same time."""
+        files = []
+        for path in self.directory.glob("*.warc.gz"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
+
+    def remove_stale_parts(self):
+        for path in self.directory.glob("*.part"):
+            try:
+                if time.time() - path.stat().st_mtime > STALE_PART_SECONDS:
+                    path.unlink()
+            except FileNotFoundError:
+                continue
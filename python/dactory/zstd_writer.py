@@ -1,11 +1,224 @@
+import json
+import os
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
 
 import zstandard as zstd
 
+# Uncompressed size from which the documents buffered are written as a frame.
+FRAME_SIZE = 8 << 20
+# Frames compressed or waiting to be, before `FramedZstdWriter.write` blocks.
+MAX_PENDING_FRAMES = 2
+
 
 @contextmanager
 def zstd_writer(path: Path):
     with path.open("wb") as out_f:
         with zstd.ZstdCompressor().stream_writer(out_f) as output_file_compressed:
             yield output_file_compressed
+
+
+class OutputFormat(str, Enum):
+    jsonl = "jsonl"
+    parquet = "parquet"
+
+
+@dataclass
+class OutputOptions:
+    """How the documents of a group are compressed and split into files."""
+
+    # With parquet, the group is written as JSON lines while in progress, and converted once
+    # it is finished.
+    format: OutputFormat = OutputFormat.jsonl
+    level: int = 3
+    # Threads compressing each frame, 0 to compress it in a single thread.
+    threads: int = 0
+    long_distance_matching: bool = False
+    # Size from which a new shard is started, in bytes. 0 for a single file per group.
+    shard_size: int = 0
+
+    def compressor(self) -> zstd.ZstdCompressor:
+        params = zstd.ZstdCompressionParameters.from_level(
+            self.level, threads=self.threads, enable_ldm=self.long_distance_matching
+        )
+        return zstd.ZstdCompressor(compression_params=params)
+
+
+class FramedZstdWriter:
+    """Appends the documents to `path` as independent zstd frames, which together are a valid
+    zstd file.
+
+    After each frame, a line is appended to `index_path` with the end offset of the frame, its
+    number of lines and the last record written for each WARC in it. A file left by an
+    interruption is resumed with `recover`, which cuts what follows the last frame in the
+    index, without reading the frames.
+
+    The frames are compressed and written by a background thread, zstd releases the GIL, so
+    the caller can go on with the next documents. `flush` waits until they are all written.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        index_path: Path,
+        frame_size: int = FRAME_SIZE,
+        options: OutputOptions | None = None,
+    ):
+        self.path = path
+        self.index_path = index_path
+        self.frame_size = frame_size
+        self.out_f = path.open("ab")
+        self.index_f = index_path.open("a")
+        self.compressor = (options or OutputOptions()).compressor()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending_frames: deque[Future] = deque()
+        self.buffer = []
+        self.buffer_size = 0
+        # The last record of each WARC in the buffer.
+        self.last_records: dict[str, int] = {}
+
+    def write(self, data: bytes, warc_file: str | None = None, last_record_idx: int = -1):
+        """`warc_file` and `last_record_idx` are only needed to resume, with `recover`."""
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if warc_file is not None:
+            self.last_records[warc_file] = last_record_idx
+        if self.buffer_size >= self.frame_size:
+            self.submit_frame()
+
+    def submit_frame(self):
+        """Gives the documents buffered to the background thread, to be written as a frame."""
+        if not self.buffer:
+            return
+        # Bounds the memory used by the frames waiting to be written.
+        while len(self.pending_frames) >= MAX_PENDING_FRAMES:
+            self.pending_frames.popleft().result()
+        self.pending_frames.append(
+            self.executor.submit(self.write_frame, self.buffer, self.last_records)
+        )
+        self.buffer = []
+        self.buffer_size = 0
+        self.last_records = {}
+
+    def write_frame(self, buffer: list[bytes], last_records: dict[str, int]):
+        data = b"".join(buffer)
+        self.out_f.write(self.compressor.compress(data))
+        self.out_f.flush()
+        entry = {
+            "end": self.out_f.tell(),
+            "lines": data.count(b"\n"),
+            "last_records": last_records,
+        }
+        self.index_f.write(json.dumps(entry) + "\n")
+        self.index_f.flush()
+
+    def flush(self):
+        """Writes the documents buffered, and waits until all the frames are written."""
+        self.submit_frame()
+        while self.pending_frames:
+            self.pending_frames.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+            self.out_f.close()
+            self.index_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def recover(path: Path, index_path: Path) -> dict[str, int]:
+        """Truncates `path` and `index_path` to the last frame fully written in both, and
+        returns the last record written for each WARC."""
+        data_size = path.stat().st_size if path.exists() else 0
+        last_records = {}
+        end = index_end = 0
+        with index_path.open("rb") as index_f:
+            for line in index_f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b"\n") or entry["end"] > data_size:
+                    break
+                end = entry["end"]
+                index_end += len(line)
+                last_records.update(entry["last_records"])
+        os.truncate(index_path, index_end)
+        if path.exists():
+            os.truncate(path, end)
+        return last_records
+
+
+def split_into_shards(
+    path: Path, index_path: Path, shard_size: int, shard_path: Callable[[int], Path]
+) -> list[dict]:
+    """Copies the frames of a complete file written by FramedZstdWriter to shards of about
+    `shard_size` bytes, without compressing them again. Returns the entries of the manifest.
+
+    The shards are only part of the output once the manifest is written, they can be left by
+    an interruption before it."""
+    with index_path.open() as index_f:
+        frames = [json.loads(line) for line in index_f]
+    if not frames:
+        shard_path(0).touch()
+        return [{"path": shard_path(0).name, "size": 0, "num_documents": 0}]
+    shards = []
+    start = num_lines = 0
+    with path.open("rb") as in_f:
+        for i, frame in enumerate(frames):
+            end = frame["end"]
+            num_lines += frame["lines"]
+            if end - start < shard_size and i < len(frames) - 1:
+                continue
+            final_path = shard_path(len(shards))
+            tmp_path = final_path.with_name(final_path.name + ".tmp")
+            with tmp_path.open("wb") as out_f:
+                in_f.seek(start)
+                copy_range(in_f, out_f, end - start)
+            shards.append({"path": tmp_path, "size": end - start, "num_documents": num_lines})
+            start, num_lines = end, 0
+    # Renamed once they are all complete.
+    for i, shard in enumerate(shards):
+        shard["path"] = shard["path"].rename(shard_path(i)).name
+    return shards
+
+
+def write_group_shards(
+    path: Path, index_path: Path, shard_size: int, directory: Path, group_idx: int
+):
+    """Splits the group written to `path` in `<group>.<shard>.jsonl.zstd` files of `directory`,
+    listed in `<group>.manifest.json`, then removes `path`. The group is finished once the
+    manifest is written."""
+    # Left by a split that was interrupted, there can be more of them than now.
+    for shard_path in directory.glob(f"{group_idx}.*.jsonl.zstd"):
+        shard_path.unlink()
+    shards = split_into_shards(
+        path, index_path, shard_size, lambda i: directory / f"{group_idx}.{i:05d}.jsonl.zstd"
+    )
+    manifest = {"group_idx": group_idx, "shards": shards}
+    manifest_path = directory / f"{group_idx}.manifest.json"
+    tmp_manifest = manifest_path.with_name(manifest_path.name + ".tmp")
+    tmp_manifest.write_text(json.dumps(manifest, indent=4))
+    tmp_manifest.rename(manifest_path)
+    path.unlink()
+
+
+def copy_range(in_f, out_f, length: int):
+    while length > 0:
+        chunk = in_f.read(min(length, 1 << 20))
+        if not chunk:
+            raise EOFError(f"{in_f.name} is shorter than its index")
+        out_f.write(chunk)
+        length -= len(chunk)
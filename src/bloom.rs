@@ -1,4 +1,20 @@
 use pyo3::prelude::*;
+use std::io::{Read, Seek};
+use std::ops::{Deref, DerefMut};
+
+// Legacy format: i32 number of hashes, then u64 size of the data in bytes.
+const LEGACY_HEADER_SIZE: u64 = 12;
+// Blocked format: the magic, u32 version, u32 number of hashes, u32 unused, u64 size of the
+// data in bytes, then padding so that the blocks are aligned on cache lines when mapped.
+const BLOCKED_MAGIC: [u8; 4] = *b"DBBF";
+const BLOCKED_VERSION: u32 = 1;
+const BLOCKED_HEADER_SIZE: u64 = 64;
+// All the bits of an element are in the same block, one cache line.
+const BLOCK_SIZE: usize = 64;
+const BLOCK_BITS: u64 = 8 * BLOCK_SIZE as u64;
+const MAX_HASHES: usize = 16;
+// Number of bit positions taken from 64 bits of hash.
+const SLICES_PER_HASH: usize = 64 / BLOCK_BITS.trailing_zeros() as usize;
 
 const INIT_VALUES: [u64; 8] = [
     14695981039346656037u64,
@@ -11,18 +27,6 @@ const INIT_VALUES: [u64; 8] = [
     3560712257386009938u64,
 ];
 
-fn fnv1a(data: &[u8], h: Option<u64>) -> u64 {
-    let mut h = match h {
-        Some(h) => h,
-        None => 14695981039346656037u64,
-    };
-    for b in data {
-        h ^= *b as u64;
-        h = h.wrapping_mul(1099511628211u64);
-    }
-    h
-}
-
 pub(crate) fn fnv1a_batch<const N: usize>(data: &[u8]) -> [u64; N] {
     let mut h = [0u64; N];
     for i in 0..N {
@@ -42,74 +46,301 @@ pub(crate) fn fnv1a_batch<const N: usize>(data: &[u8]) -> [u64; N] {
     h
 }
 
+/// The finalizer of splitmix64, to get more bits out of a hash.
+fn mix64(mut z: u64) -> u64 {
+    z = (z ^ (z >> 30)).wrapping_mul(0xbf58476d1ce4e5b9);
+    z = (z ^ (z >> 27)).wrapping_mul(0x94d049bb133111eb);
+    z ^ (z >> 31)
+}
+
+/// The bits of the filter, either read in memory or mapped from the file.
+enum Storage {
+    Owned(Vec<u8>),
+    /// Private copy-on-write mapping: the pages are shared with the page cache, and so with
+    /// the other processes, until they are modified. The file itself is never modified.
+    Mapped(memmap2::MmapMut),
+}
+
+impl Deref for Storage {
+    type Target = [u8];
+
+    fn deref(&self) -> &[u8] {
+        match self {
+            Storage::Owned(data) => data,
+            Storage::Mapped(data) => data,
+        }
+    }
+}
+
+impl DerefMut for Storage {
+    fn deref_mut(&mut self) -> &mut [u8] {
+        match self {
+            Storage::Owned(data) => data,
+            Storage::Mapped(data) => data,
+        }
+    }
+}
+
+/// How the bits of an element are chosen.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+enum Layout {
+    /// The original filters: one FNV-1a hash per bit, anywhere in the data.
+    Legacy,
+    /// One xxh3 hash per element, and all its bits in the same 64 bytes block.
+    Blocked,
+}
+
 #[pyclass]
 pub(crate) struct BloomFilter {
-    data: Vec<u8>,
+    data: Storage,
     num_hashes: usize,
+    layout: Layout,
 }
 
 #[pymethods]
 impl BloomFilter {
+    /// With `mmap`, the file is mapped instead of read, loading is immediate and the memory is
+    /// shared between the processes using the same file. Both formats can be loaded.
     #[staticmethod]
-    pub(crate) fn py_load(path: &str) -> PyResult<BloomFilter> {
-        let bloom = BloomFilter::load(path)
-            .map_err(|e| PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("{}", e)))?;
+    #[pyo3(signature = (path, mmap = true))]
+    pub(crate) fn py_load(path: &str, mmap: bool) -> PyResult<BloomFilter> {
+        let bloom = if mmap {
+            BloomFilter::load_mmap(path)
+        } else {
+            BloomFilter::load(path)
+        };
+        let bloom =
+            bloom.map_err(|e| PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("{}", e)))?;
         Ok(bloom)
     }
-    pub(crate) fn get(&self, s: &str) -> bool {
-        for i in 0..self.num_hashes {
-            let h = fnv1a(s.as_bytes(), Some(INIT_VALUES[i]));
-            if !self.get_idx(h) {
-                return false;
-            }
+
+    /// An empty filter with the blocked layout, `size` is in bytes.
+    #[staticmethod]
+    pub(crate) fn new_blocked(size: usize, num_hashes: usize) -> PyResult<BloomFilter> {
+        if size == 0 || num_hashes == 0 || num_hashes > MAX_HASHES {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                "Invalid bloom filter: {size} bytes and {num_hashes} hashes, at most {MAX_HASHES} hashes"
+            )));
         }
-        true
+        Ok(BloomFilter {
+            data: Storage::Owned(vec![0; size.div_ceil(BLOCK_SIZE) * BLOCK_SIZE]),
+            num_hashes,
+            layout: Layout::Blocked,
+        })
+    }
+
+    pub(crate) fn get(&self, s: &str) -> bool {
+        let (positions, n) = self.bit_positions(s.as_bytes());
+        positions[..n].iter().all(|&idx| self.get_idx(idx))
     }
 
     pub(crate) fn set(&mut self, s: &str) {
-        for i in 0..self.num_hashes {
-            let h = fnv1a(s.as_bytes(), Some(INIT_VALUES[i]));
-            self.set_idx(h);
+        let (positions, n) = self.bit_positions(s.as_bytes());
+        for &idx in &positions[..n] {
+            self.set_idx(idx);
+        }
+    }
+
+    /// Same as `get` followed by `set`, hashing the element only once.
+    pub(crate) fn test_and_set(&mut self, s: &str) -> bool {
+        let (positions, n) = self.bit_positions(s.as_bytes());
+        let mut present = true;
+        for &idx in &positions[..n] {
+            present &= !self.set_idx(idx);
         }
+        present
+    }
+
+    /// Write the filter in the same format as it's loaded. The file is replaced atomically.
+    #[pyo3(name = "save")]
+    pub(crate) fn py_save(&self, path: &str) -> PyResult<()> {
+        self.save(path)
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("{}", e)))
+    }
+
+    /// Add all the elements of `other` to this filter, with a bitwise OR.
+    pub(crate) fn merge(&mut self, other: PyRef<'_, BloomFilter>) -> PyResult<()> {
+        if self.layout != other.layout
+            || self.num_hashes != other.num_hashes
+            || self.data.len() != other.data.len()
+        {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                "Can't merge bloom filters of different shapes: {:?} with {} hashes and {} bytes, {:?} with {} hashes and {} bytes",
+                self.layout,
+                self.num_hashes,
+                self.data.len(),
+                other.layout,
+                other.num_hashes,
+                other.data.len()
+            )));
+        }
+        for (byte, other_byte) in self.data.iter_mut().zip(other.data.iter()) {
+            // Same as set_idx, avoid copying the mapped pages that don't change.
+            if *byte | *other_byte != *byte {
+                *byte |= *other_byte;
+            }
+        }
+        Ok(())
     }
 }
 
 impl BloomFilter {
     pub(crate) fn new(size: usize, num_hashes: usize) -> BloomFilter {
         BloomFilter {
-            data: vec![0; size / 8],
+            data: Storage::Owned(vec![0; size / 8]),
             num_hashes,
+            layout: Layout::Legacy,
         }
     }
 
-    pub(crate) fn load(path: &str) -> anyhow::Result<BloomFilter> {
-        use byteorder::ReadBytesExt;
-        use std::io::Read;
+    /// Returns the layout, the number of hashes, the size of the data, and the size of the header.
+    fn read_header(file: &mut std::fs::File) -> anyhow::Result<(Layout, usize, usize, u64)> {
+        use byteorder::{LittleEndian, ReadBytesExt};
 
+        let mut start = [0u8; 4];
+        file.read_exact(&mut start)?;
+        if start == BLOCKED_MAGIC {
+            let version = file.read_u32::<LittleEndian>()?;
+            if version != BLOCKED_VERSION {
+                anyhow::bail!("Unknown version of the bloom filter format: {version}");
+            }
+            let num_hashes = file.read_u32::<LittleEndian>()? as usize;
+            let _unused = file.read_u32::<LittleEndian>()?;
+            let size = file.read_u64::<LittleEndian>()? as usize;
+            if num_hashes == 0 || num_hashes > MAX_HASHES || size == 0 || size % BLOCK_SIZE != 0 {
+                anyhow::bail!("Invalid bloom filter: {size} bytes and {num_hashes} hashes");
+            }
+            file.seek(std::io::SeekFrom::Start(BLOCKED_HEADER_SIZE))?;
+            Ok((Layout::Blocked, num_hashes, size, BLOCKED_HEADER_SIZE))
+        } else {
+            let num_hashes = i32::from_le_bytes(start) as usize;
+            let size = file.read_u64::<LittleEndian>()? as usize;
+            if num_hashes == 0 || num_hashes > INIT_VALUES.len() {
+                anyhow::bail!("Invalid bloom filter: {num_hashes} hashes");
+            }
+            Ok((Layout::Legacy, num_hashes, size, LEGACY_HEADER_SIZE))
+        }
+    }
+
+    pub(crate) fn load(path: &str) -> anyhow::Result<BloomFilter> {
         let mut file = std::fs::File::open(path)?;
-        let num_hashes = file.read_i32::<byteorder::LittleEndian>()? as usize;
-        let size = file.read_u64::<byteorder::LittleEndian>()? as usize;
+        let (layout, num_hashes, size, _) = Self::read_header(&mut file)?;
         let mut data = vec![0u8; size];
         file.read_exact(&mut data)?;
-        Ok(Self { data, num_hashes })
+        Ok(Self {
+            data: Storage::Owned(data),
+            num_hashes,
+            layout,
+        })
     }
 
-    /*fn save(&self, path: &String) -> anyhow::Result<()> {
-    use byteorder::WriteBytesExt;
-    use std::io::Write;
-    }*/
+    pub(crate) fn load_mmap(path: &str) -> anyhow::Result<BloomFilter> {
+        let mut file = std::fs::File::open(path)?;
+        let (layout, num_hashes, size, header_size) = Self::read_header(&mut file)?;
+        if size == 0 || file.metadata()?.len() < header_size + size as u64 {
+            anyhow::bail!("{path} is not a valid bloom filter, expected {size} bytes of data");
+        }
+        // Safety: the file must not be modified by another program while it's mapped.
+        // Our own writes are private to the process.
+        let data = unsafe {
+            memmap2::MmapOptions::new()
+                .offset(header_size)
+                .len(size)
+                .map_copy(&file)?
+        };
+        // The lookups are all over the place, reading ahead would only waste memory.
+        #[cfg(unix)]
+        data.advise(memmap2::Advice::Random)?;
+        Ok(Self {
+            data: Storage::Mapped(data),
+            num_hashes,
+            layout,
+        })
+    }
+
+    pub(crate) fn save(&self, path: &str) -> anyhow::Result<()> {
+        use byteorder::{LittleEndian, WriteBytesExt};
+        use std::io::Write;
+
+        // Written next to the destination then renamed, so that the file is always complete,
+        // and a mapping of the previous file is not modified.
+        let tmp_path = format!("{path}.tmp");
+        let mut file = std::io::BufWriter::new(std::fs::File::create(&tmp_path)?);
+        match self.layout {
+            Layout::Legacy => {
+                file.write_i32::<LittleEndian>(self.num_hashes as i32)?;
+                file.write_u64::<LittleEndian>(self.data.len() as u64)?;
+            }
+            Layout::Blocked => {
+                file.write_all(&BLOCKED_MAGIC)?;
+                file.write_u32::<LittleEndian>(BLOCKED_VERSION)?;
+                file.write_u32::<LittleEndian>(self.num_hashes as u32)?;
+                file.write_u32::<LittleEndian>(0)?;
+                file.write_u64::<LittleEndian>(self.data.len() as u64)?;
+                file.write_all(&[0u8; BLOCKED_HEADER_SIZE as usize - 24])?;
+            }
+        }
+        file.write_all(&self.data)?;
+        file.into_inner()?.sync_all()?;
+        std::fs::rename(&tmp_path, path)?;
+        Ok(())
+    }
+
+    /// The index of the bits of an element, only the first `num_hashes` are used.
+    fn bit_positions(&self, s: &[u8]) -> ([u64; MAX_HASHES], usize) {
+        let mut positions = [0u64; MAX_HASHES];
+        let num_bits = 8 * self.data.len() as u64;
+        match self.layout {
+            Layout::Legacy => {
+                // One FNV-1a hash per bit, all computed in a single pass like `fnv1a_batch`.
+                let mut h = [0u64; 8];
+                h[..self.num_hashes].copy_from_slice(&INIT_VALUES[..self.num_hashes]);
+                for b in s {
+                    for h in h[..self.num_hashes].iter_mut() {
+                        *h ^= *b as u64;
+                        *h = h.wrapping_mul(1099511628211u64);
+                    }
+                }
+                for i in 0..self.num_hashes {
+                    positions[i] = h[i] % num_bits;
+                }
+            }
+            Layout::Blocked => {
+                let h = xxhash_rust::xxh3::xxh3_128(s);
+                let num_blocks = num_bits / BLOCK_BITS;
+                // Maps the low bits to a block without a division.
+                let block = ((h as u64 as u128 * num_blocks as u128) >> 64) as u64;
+                // Independent bits for each position within the block. Double hashing would
+                // only give 2^17 different sets of positions, too few to be negligible.
+                let high = (h >> 64) as u64;
+                let mut bits = high;
+                for (i, position) in positions[..self.num_hashes].iter_mut().enumerate() {
+                    if i > 0 && i % SLICES_PER_HASH == 0 {
+                        bits = mix64(high.wrapping_add(i as u64));
+                    }
+                    *position = block * BLOCK_BITS + (bits & (BLOCK_BITS - 1));
+                    bits >>= BLOCK_BITS.trailing_zeros();
+                }
+            }
+        }
+        (positions, self.num_hashes)
+    }
 
     fn get_idx(&self, idx: u64) -> bool {
-        let idx = idx as usize % (8 * self.data.len());
-        let i = idx / 8;
+        let i = (idx / 8) as usize;
         let j = idx % 8;
         self.data[i] & (1 << j) != 0
     }
 
-    fn set_idx(&mut self, idx: u64) {
-        let idx = idx as usize % (8 * self.data.len());
-        let i = idx / 8;
+    /// Returns true if the bit wasn't set before.
+    fn set_idx(&mut self, idx: u64) -> bool {
+        let i = (idx / 8) as usize;
         let j = idx % 8;
-        self.data[i] |= 1 << j;
+        // Only write when needed, each write to a mapped page makes a private copy of it.
+        if self.data[i] & (1 << j) == 0 {
+            self.data[i] |= 1 << j;
+            return true;
+        }
+        false
     }
 }
@@ -1,14 +1,21 @@
 use crate::bloom;
 use crate::code;
+use crate::score_cache::ScoreCache;
 use clap::{Parser, Subcommand};
 use fasttext::FastText;
+use numpy::ndarray::Array2;
+use numpy::{IntoPyArray, PyArray2};
+use rayon::prelude::*;
 use serde::{Deserialize, Serialize};
 use std::collections::HashMap;
 use std::io::BufRead;
 use std::io::BufReader;
 use std::string::String;
+use std::sync::Mutex;
+use xxhash_rust::xxh3::xxh3_64;
 
 use pyo3::prelude::*;
+use pyo3::pybacked::PyBackedStr;
 
 #[derive(Serialize, Deserialize)]
 #[serde(untagged)]
@@ -159,42 +166,126 @@ enum Commands {
     Data(DedupArgs),
 }
 
-fn annotate_document(document: &mut Document, model: &FastText, n_labels: usize) {
-    let mut text_len = 0.0;
-    let mut scores = HashMap::<String, f32>::new();
-    for line in document.text.split('\n') {
-        if line.len() == 0 {
-            continue;
+fn annotate_document(document: &mut Document, model: &FastText, label_ids: &LabelIds) {
+    let Some(scores) = document_scores(model, label_ids, None, &document.text) else {
+        return;
+    };
+    for (label, score) in label_ids.labels.iter().zip(scores) {
+        document.scores.insert(label.clone(), score);
+    }
+}
+
+/// The labels of a fastText model, and their position in the scores.
+struct LabelIds {
+    // Without the "__label__" prefix
+    labels: Vec<String>,
+    // With the prefix, as in the predictions.
+    ids: HashMap<String, usize>,
+}
+
+impl LabelIds {
+    fn new(model: &FastText) -> Self {
+        let (model_labels, _) = model.get_labels().expect("yolo");
+        let ids = model_labels
+            .iter()
+            .enumerate()
+            .map(|(i, label)| (label.clone(), i))
+            .collect();
+        let labels = model_labels
+            .iter()
+            .map(|label| (&label[9..]).to_string())
+            .collect();
+        LabelIds { labels, ids }
+    }
+
+    fn len(&self) -> usize {
+        self.labels.len()
+    }
+}
+
+/// The predictions of the lines of the document, weighted by their length and rounded, in
+/// the order of the labels. None if the document has no line. The predictions of the lines
+/// found in `cache` are not computed again. The cache is locked once to look up all the lines
+/// of the document and once to insert the new ones, not around each line.
+fn document_scores(
+    model: &FastText,
+    label_ids: &LabelIds,
+    cache: Option<&Mutex<ScoreCache>>,
+    text: &str,
+) -> Option<Vec<f32>> {
+    let num_labels = label_ids.len();
+    let lines: Vec<&str> = text.split('\n').filter(|line| line.len() > 0).collect();
+    if lines.is_empty() {
+        return None;
+    }
+    // The model is given the lines with their newline, and they are hashed with it.
+    let mut line_buffer = String::new();
+    let keys: Vec<u64> = lines
+        .iter()
+        .map(|line| {
+            line_buffer.clear();
+            line_buffer.push_str(line);
+            line_buffer.push('\n');
+            xxh3_64(line_buffer.as_bytes())
+        })
+        .collect();
+    let mut line_scores = vec![0.0f32; lines.len() * num_labels];
+    // The first occurrence of the lines to predict, in order, and the later occurrences of
+    // these lines with their first one.
+    let mut missing: Vec<usize> = Vec::new();
+    let mut first_missing: HashMap<u64, usize> = HashMap::new();
+    let mut repeated: Vec<(usize, usize)> = Vec::new();
+    {
+        let mut cache = cache.map(|cache| cache.lock().unwrap());
+        for (i, &key) in keys.iter().enumerate() {
+            if let Some(&first) = first_missing.get(&key) {
+                repeated.push((i, first));
+                continue;
+            }
+            let scores = &mut line_scores[i * num_labels..(i + 1) * num_labels];
+            if !cache.as_mut().is_some_and(|cache| cache.get(key, scores)) {
+                missing.push(i);
+                first_missing.insert(key, i);
+            }
         }
-        let line = line.to_owned() + "\n";
-        let p = model.predict(&line, n_labels as i32, 0.0).expect("yolo");
-        for i in 0..n_labels {
-            let e = scores.entry(p[i].label.clone()).or_insert(0.0);
-            *e += p[i].prob * (line.len() as f32);
+    }
+    for &i in &missing {
+        line_buffer.clear();
+        line_buffer.push_str(lines[i]);
+        line_buffer.push('\n');
+        let predictions = model
+            .predict(&line_buffer, num_labels as i32, 0.0)
+            .expect("yolo");
+        let scores = &mut line_scores[i * num_labels..(i + 1) * num_labels];
+        for prediction in &predictions {
+            scores[label_ids.ids[&prediction.label]] += prediction.prob;
         }
-        text_len += line.len() as f32;
     }
-    if text_len == 0.0 {
-        return;
+    for &(i, first) in &repeated {
+        line_scores.copy_within(first * num_labels..(first + 1) * num_labels, i * num_labels);
     }
-    for (k, v) in scores {
-        document
-            .scores
-            .insert((&k[9..]).to_string(), round_2(v / text_len));
+    if let Some(cache) = cache {
+        if !missing.is_empty() {
+            let mut cache = cache.lock().unwrap();
+            for &i in &missing {
+                cache.insert(keys[i], &line_scores[i * num_labels..(i + 1) * num_labels]);
+            }
+        }
     }
-    /*for label in model.get_labels().expect("yolo").0 {
-    let e = document.scores.entry(label).or_insert(0.0);
-    *e /= text_len;
-    }*/
-    /*document.rand = Some(round_2(scores["__label__rand"] / text_len));
-    document.wiki = Some(round_2(scores["__label__wiki"] / text_len));
-    document.books = Some(round_2(scores["__label__books"] / text_len));
-    document.science = Some(round_2(scores["__label__science"] / text_len));
-    document.news = Some(round_2(scores["__label__news"] / text_len));
-    document.stem = Some(round_2(scores["__label__stem"] / text_len));
-    document.life = Some(round_2(scores["__label__life"] / text_len));
-    document.hum = Some(round_2(scores["__label__hum"] / text_len));
-    document.pop = Some(round_2(scores["__label__pop"] / text_len));*/
+
+    let mut scores = vec![0.0f32; num_labels];
+    let mut text_len = 0.0;
+    for (line, line_scores) in lines.iter().zip(line_scores.chunks_exact(num_labels)) {
+        let line_len = (line.len() + 1) as f32;
+        for (score, line_score) in scores.iter_mut().zip(line_scores) {
+            *score += line_score * line_len;
+        }
+        text_len += line_len;
+    }
+    for score in &mut scores {
+        *score = round_2(*score / text_len);
+    }
+    Some(scores)
 }
 
 // Because of the orphan rule, it's not possible to add a trait directly
@@ -202,45 +293,87 @@ fn annotate_document(document: &mut Document, model: &FastText, n_labels: usize)
 #[pyclass]
 pub struct FastTextPyWrapper {
     model: FastText,
-    n_labels: usize,
+    label_ids: LabelIds,
+    // The scores of the last lines, shared by the threads of `get_docs_annotations`.
+    cache: Option<Mutex<ScoreCache>>,
 }
 
 #[pymethods]
 impl FastTextPyWrapper {
+    /// With `cache_size` > 0, the scores of the last `cache_size` distinct lines are kept, so
+    /// the lines repeated across documents, such as menus and footers, are scored once.
     #[staticmethod]
-    fn load(model_path: &str) -> PyResult<Self> {
+    #[pyo3(signature = (model_path, cache_size=0))]
+    fn load(model_path: &str, cache_size: usize) -> PyResult<Self> {
         let mut model = FastText::new();
         let _ = model.load_model(model_path);
-        let n_labels = model.get_labels().expect("yolo").0.len();
-        Ok(FastTextPyWrapper { model, n_labels })
+        let label_ids = LabelIds::new(&model);
+        let cache =
+            (cache_size > 0).then(|| Mutex::new(ScoreCache::new(cache_size, label_ids.len())));
+        Ok(FastTextPyWrapper {
+            model,
+            label_ids,
+            cache,
+        })
     }
 
-    fn get_doc_annotations(&self, doc_text: &str) -> HashMap<String, f32> {
-        let mut final_scores = HashMap::<String, f32>::new();
-        let mut text_len = 0.0;
-        let mut scores = HashMap::<String, f32>::new();
-        for line in doc_text.split('\n') {
-            if line.len() == 0 {
-                continue;
-            }
-            let line = line.to_owned() + "\n";
-            let p = self
-                .model
-                .predict(&line, self.n_labels as i32, 0.0)
-                .expect("yolo");
-            for i in 0..self.n_labels {
-                let e = scores.entry(p[i].label.clone()).or_insert(0.0);
-                *e += p[i].prob * (line.len() as f32);
-            }
-            text_len += line.len() as f32;
-        }
-        if text_len == 0.0 {
-            return final_scores;
-        }
-        for (k, v) in scores {
-            final_scores.insert((&k[9..]).to_string(), round_2(v / text_len));
+    /// The lines whose scores were found in the cache, 0 without a cache.
+    #[getter]
+    fn cache_hits(&self) -> u64 {
+        self.cache.as_ref().map_or(0, |c| c.lock().unwrap().hits)
+    }
+
+    /// The lines whose scores were computed and added to the cache, 0 without a cache.
+    #[getter]
+    fn cache_misses(&self) -> u64 {
+        self.cache.as_ref().map_or(0, |c| c.lock().unwrap().misses)
+    }
+
+    /// The names of the scores returned by `get_doc_scores` and `get_docs_annotations`.
+    fn labels(&self) -> Vec<String> {
+        self.label_ids.labels.clone()
+    }
+
+    fn get_doc_annotations(&self, py: Python<'_>, doc_text: &str) -> HashMap<String, f32> {
+        let scores = py.allow_threads(|| self.doc_scores(doc_text));
+        match scores {
+            Some(scores) => self.label_ids.labels.iter().cloned().zip(scores).collect(),
+            None => HashMap::new(),
         }
-        final_scores
+    }
+
+    /// Same as `get_doc_annotations`, in the order of `labels()`, without building a dict.
+    /// None if the document has no line.
+    fn get_doc_scores(&self, py: Python<'_>, doc_text: &str) -> Option<Vec<f32>> {
+        py.allow_threads(|| self.doc_scores(doc_text))
+    }
+
+    /// Returns an array of shape (len(texts), len(labels())). The row of an empty
+    /// document is filled with NaN.
+    fn get_docs_annotations<'py>(
+        &self,
+        py: Python<'py>,
+        texts: Vec<PyBackedStr>,
+    ) -> Bound<'py, PyArray2<f32>> {
+        let n_labels = self.label_ids.len();
+        let scores: Vec<f32> = py.allow_threads(|| {
+            texts
+                .par_iter()
+                .flat_map_iter(|text| {
+                    self.doc_scores(text)
+                        .unwrap_or_else(|| vec![f32::NAN; n_labels])
+                })
+                .collect()
+        });
+        Array2::from_shape_vec((texts.len(), n_labels), scores)
+            .expect("One row of scores per text.")
+            .into_pyarray(py)
+    }
+}
+
+impl FastTextPyWrapper {
+    fn doc_scores(&self, doc_text: &str) -> Option<Vec<f32>> {
+        document_scores(&self.model, &self.label_ids, self.cache.as_ref(), doc_text)
     }
 }
 
@@ -256,9 +389,8 @@ pub fn dedup_document(
     for paragraph in re.split(doc_text) {
         let mut keep = 0.0f32;
         for line in paragraph.split('\n') {
-            if !bloom_filter.get(line) {
+            if !bloom_filter.test_and_set(line) {
                 keep += line.len() as f32;
-                bloom_filter.set(line);
             }
         }
         if keep / (paragraph.len() as f32) > threshold {
@@ -315,12 +447,12 @@ fn annotate(args: AnnotateArgs) -> anyhow::Result<()> {
     let buf_stdin = BufReader::new(std::io::stdin());
     let mut model = FastText::new();
     let _ = model.load_model(&args.model);
-    let n_labels = model.get_labels().expect("yolo").0.len();
+    let label_ids = LabelIds::new(&model);
 
     for document in buf_stdin.lines() {
         let document = document?;
         let mut document: Document = serde_json::from_str(&document)?;
-        annotate_document(&mut document, &model, n_labels);
+        annotate_document(&mut document, &model, &label_ids);
         println!("{}", serde_json::to_string(&document).expect("yolo"));
     }
     Ok(())
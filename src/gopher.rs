@@ -1,6 +1,24 @@
+use numpy::ndarray::Array2;
+use numpy::{IntoPyArray, PyArray2};
 use pyo3::prelude::*;
+use pyo3::pybacked::PyBackedStr;
+use rayon::prelude::*;
 use std::collections::HashMap;
 
+use crate::metrics::{scan, ScanOptions};
+
+/// Order of the columns returned by `compute_gopher_metrics_batch`.
+pub const GOPHER_METRIC_NAMES: [&str; 8] = [
+    "mean_word_length",
+    "frac_words_with_alpha",
+    "frac_lines_end_punctuation",
+    "frac_lines_start_bullet",
+    "frac_alphabetic_chars",
+    "has_stop_words",
+    "frac_duplicate_sentences",
+    "frac_duplicate_paragraphs",
+];
+
 const STOP_WORDS: &[(&str, &[&str])] = &[
     (
         "en",
@@ -185,14 +203,14 @@ const STOP_WORDS: &[(&str, &[&str])] = &[
     ),
 ];
 
-fn get_stop_words(language: &str) -> Option<&'static [&'static str]> {
+pub(crate) fn get_stop_words(language: &str) -> Option<&'static [&'static str]> {
     STOP_WORDS
         .iter()
         .find(|(lang, _)| *lang == language)
         .map(|(_, words)| *words)
 }
 
-fn is_bullet_start(line: &str) -> bool {
+pub(crate) fn is_bullet_start(line: &str) -> bool {
     let trimmed = line.trim_start();
     if trimmed.is_empty() {
         return false;
@@ -210,174 +228,50 @@ fn is_bullet_start(line: &str) -> bool {
     i > 0 && i < bytes.len() && bytes[i] == b'.'
 }
 
-fn is_end_punctuation(c: u8) -> bool {
+pub(crate) fn is_end_punctuation(c: u8) -> bool {
     matches!(c, b'.' | b'!' | b'?' | b';' | b':')
 }
 
 #[pyfunction]
-pub fn compute_gopher_metrics(text: &str, language: &str) -> HashMap<String, f32> {
-    let mut metrics = HashMap::new();
-
-    // Word-level metrics
-    let mut total_word_len: usize = 0;
-    let mut word_count: usize = 0;
-    let mut words_with_alpha: usize = 0;
-
-    for word in text.split_whitespace() {
-        word_count += 1;
-        total_word_len += word.len();
-        if word.chars().any(|c| c.is_alphabetic()) {
-            words_with_alpha += 1;
-        }
-    }
-
-    let mean_word_length = if word_count > 0 {
-        total_word_len as f32 / word_count as f32
-    } else {
-        0.0
-    };
-    let frac_words_with_alpha = if word_count > 0 {
-        words_with_alpha as f32 / word_count as f32
-    } else {
-        0.0
-    };
-
-    // Line-level metrics
-    let lines: Vec<&str> = text.lines().collect();
-    let line_count = lines.len();
-    let mut lines_end_punctuation: usize = 0;
-    let mut lines_start_bullet: usize = 0;
-
-    for line in &lines {
-        let trimmed = line.trim_end();
-        if !trimmed.is_empty() {
-            if is_end_punctuation(*trimmed.as_bytes().last().unwrap()) {
-                lines_end_punctuation += 1;
-            }
-        }
-        if is_bullet_start(line) {
-            lines_start_bullet += 1;
-        }
-    }
-
-    let frac_lines_end_punctuation = if line_count > 0 {
-        lines_end_punctuation as f32 / line_count as f32
-    } else {
-        0.0
-    };
-    let frac_lines_start_bullet = if line_count > 0 {
-        lines_start_bullet as f32 / line_count as f32
-    } else {
-        0.0
-    };
-
-    // Character-level metrics
-    let total_chars = text.chars().count();
-    let alphabetic_chars = text.chars().filter(|c| c.is_alphabetic()).count();
-    let frac_alphabetic_chars = if total_chars > 0 {
-        alphabetic_chars as f32 / total_chars as f32
-    } else {
-        0.0
-    };
-
-    // Stop words check
-    let has_stop_words = if let Some(stop_words) = get_stop_words(language) {
-        let lower = text.to_lowercase();
-        let found = stop_words
-            .iter()
-            .filter(|sw| lower.split_whitespace().any(|w| w == **sw))
-            .count();
-        if found >= 2 {
-            1.0
-        } else {
-            0.0
-        }
-    } else {
-        // If no stop words for this language, pass by default
-        1.0
-    };
-
-    // Duplicate sentences: split on sentence boundaries (.!?) followed by whitespace
-    let frac_duplicate_sentences = compute_frac_duplicate(text, SplitMode::Sentence);
-    let frac_duplicate_paragraphs = compute_frac_duplicate(text, SplitMode::Paragraph);
-
-    metrics.insert("mean_word_length".to_string(), mean_word_length);
-    metrics.insert("frac_words_with_alpha".to_string(), frac_words_with_alpha);
-    metrics.insert(
-        "frac_lines_end_punctuation".to_string(),
-        frac_lines_end_punctuation,
-    );
-    metrics.insert(
-        "frac_lines_start_bullet".to_string(),
-        frac_lines_start_bullet,
-    );
-    metrics.insert("frac_alphabetic_chars".to_string(), frac_alphabetic_chars);
-    metrics.insert("has_stop_words".to_string(), has_stop_words);
-    metrics.insert(
-        "frac_duplicate_sentences".to_string(),
-        frac_duplicate_sentences,
-    );
-    metrics.insert(
-        "frac_duplicate_paragraphs".to_string(),
-        frac_duplicate_paragraphs,
-    );
-
-    metrics
-}
-
-enum SplitMode {
-    Sentence,
-    Paragraph,
+pub fn compute_gopher_metrics(py: Python<'_>, text: &str, language: &str) -> HashMap<String, f32> {
+    let metrics = py.allow_threads(|| gopher_metrics(text, language));
+    GOPHER_METRIC_NAMES
+        .iter()
+        .zip(metrics)
+        .map(|(name, value)| (name.to_string(), value))
+        .collect()
 }
 
-fn compute_frac_duplicate(text: &str, mode: SplitMode) -> f32 {
-    let chunks: Vec<&str> = match mode {
-        SplitMode::Sentence => split_sentences(text),
-        SplitMode::Paragraph => text
-            .split("\n\n")
-            .map(|s| s.trim())
-            .filter(|s| !s.is_empty())
-            .collect(),
-    };
-
-    let total_chars: usize = chunks.iter().map(|s| s.len()).sum();
-    if total_chars == 0 {
-        return 0.0;
-    }
-
-    let mut seen = std::collections::HashSet::new();
-    let mut duplicate_chars: usize = 0;
-
-    for chunk in &chunks {
-        if !seen.insert(*chunk) {
-            duplicate_chars += chunk.len();
-        }
+/// Returns an array of shape (len(texts), 8), the columns are in the order of
+/// `gopher_metric_names()`.
+#[pyfunction]
+pub fn compute_gopher_metrics_batch<'py>(
+    py: Python<'py>,
+    texts: Vec<PyBackedStr>,
+    languages: Vec<PyBackedStr>,
+) -> PyResult<Bound<'py, PyArray2<f32>>> {
+    if texts.len() != languages.len() {
+        return Err(pyo3::exceptions::PyValueError::new_err(
+            "texts and languages must have the same length",
+        ));
     }
-
-    duplicate_chars as f32 / total_chars as f32
+    let results: Vec<f32> = py.allow_threads(|| {
+        texts
+            .par_iter()
+            .zip(languages.par_iter())
+            .flat_map_iter(|(text, language)| gopher_metrics(text, language))
+            .collect()
+    });
+    let results = Array2::from_shape_vec((texts.len(), GOPHER_METRIC_NAMES.len()), results)
+        .expect("One row of metrics per text.");
+    Ok(results.into_pyarray(py))
 }
 
-fn split_sentences(text: &str) -> Vec<&str> {
-    let mut sentences = Vec::new();
-    let bytes = text.as_bytes();
-    let mut start = 0;
-
-    for (i, &b) in bytes.iter().enumerate() {
-        if is_end_punctuation(b) {
-            let end = i + 1;
-            if end >= bytes.len() || bytes[end].is_ascii_whitespace() {
-                let s = text[start..end].trim();
-                if !s.is_empty() {
-                    sentences.push(s);
-                }
-                start = end;
-            }
-        }
-    }
-    let s = text[start..].trim();
-    if !s.is_empty() {
-        sentences.push(s);
-    }
+#[pyfunction]
+pub fn gopher_metric_names() -> Vec<&'static str> {
+    GOPHER_METRIC_NAMES.to_vec()
+}
 
-    sentences
+pub(crate) fn gopher_metrics(text: &str, language: &str) -> [f32; 8] {
+    scan(text, language, &ScanOptions::default()).gopher
 }
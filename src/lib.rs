@@ -4,8 +4,11 @@ mod bloom;
 mod code;
 mod entry;
 mod gopher;
+mod lsh;
+mod metrics;
 mod minhash;
 mod repetitions;
+mod score_cache;
 
 /// A Python module implemented in Rust.
 #[pymodule]
@@ -15,10 +18,38 @@ fn dactory(m: &Bound<'_, PyModule>) -> PyResult<()> {
         repetitions::compute_repetitions_rolling,
         m
     )?)?;
+    m.add_function(wrap_pyfunction!(
+        repetitions::compute_repetitions_rolling_batch,
+        m
+    )?)?;
+    m.add_function(wrap_pyfunction!(
+        repetitions::compute_repetition_metrics,
+        m
+    )?)?;
+    m.add_function(wrap_pyfunction!(
+        repetitions::compute_repetition_metrics_batch,
+        m
+    )?)?;
+    m.add_function(wrap_pyfunction!(repetitions::repetition_metric_names, m)?)?;
     m.add_function(wrap_pyfunction!(repetitions::compute_long_words, m)?)?;
+    m.add_function(wrap_pyfunction!(repetitions::compute_long_words_batch, m)?)?;
     m.add_function(wrap_pyfunction!(gopher::compute_gopher_metrics, m)?)?;
+    m.add_function(wrap_pyfunction!(gopher::compute_gopher_metrics_batch, m)?)?;
+    m.add_function(wrap_pyfunction!(gopher::gopher_metric_names, m)?)?;
+    m.add_function(wrap_pyfunction!(metrics::compute_document_metrics, m)?)?;
+    m.add_function(wrap_pyfunction!(
+        metrics::compute_document_metrics_batch,
+        m
+    )?)?;
+    m.add_function(wrap_pyfunction!(metrics::document_metric_names, m)?)?;
     m.add_function(wrap_pyfunction!(minhash::compute_minhash_signature, m)?)?;
+    m.add_function(wrap_pyfunction!(
+        minhash::compute_minhash_signature_batch,
+        m
+    )?)?;
+    m.add_function(wrap_pyfunction!(lsh::compute_band_hashes, m)?)?;
     m.add_class::<bloom::BloomFilter>()?;
+    m.add_class::<lsh::LshIndex>()?;
     m.add_class::<entry::FastTextPyWrapper>()?;
     Ok(())
 }
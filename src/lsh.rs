@@ -0,0 +1,312 @@
+use numpy::ndarray::Array2;
+use numpy::{IntoPyArray, PyArray2, PyReadonlyArray2};
+use pyo3::prelude::*;
+use rayon::prelude::*;
+use xxhash_rust::xxh3::xxh3_64;
+
+const MAGIC: [u8; 4] = *b"DLSH";
+const VERSION: u32 = 1;
+const INITIAL_CAPACITY: usize = 1 << 10;
+// The hashes are in open addressing tables, 0 marks an empty slot.
+const EMPTY: u64 = 0;
+
+fn band_hashes(signature: &[u64], num_bands: usize, rows: usize) -> Vec<u64> {
+    signature
+        .chunks_exact(rows)
+        .take(num_bands)
+        .map(|band| {
+            let bytes: Vec<u8> = band.iter().flat_map(|v| v.to_le_bytes()).collect();
+            match xxh3_64(&bytes) {
+                EMPTY => 1,
+                hash => hash,
+            }
+        })
+        .collect()
+}
+
+/// The hashes of the bands used by `LshIndex`, of shape (len(signatures), num_bands). Two
+/// signatures are candidates when they have the same hash in one of the bands.
+#[pyfunction]
+pub fn compute_band_hashes<'py>(
+    py: Python<'py>,
+    signatures: PyReadonlyArray2<'py, u64>,
+    num_bands: usize,
+    rows: usize,
+) -> PyResult<Bound<'py, PyArray2<u64>>> {
+    let signatures = signatures.as_array();
+    if num_bands == 0 || rows == 0 || signatures.ncols() < num_bands * rows {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "Signatures of {} values can't have {num_bands} bands of {rows} rows",
+            signatures.ncols()
+        )));
+    }
+    let signature_rows: Vec<Vec<u64>> = signatures.rows().into_iter().map(|r| r.to_vec()).collect();
+    let hashes: Vec<u64> = py.allow_threads(|| {
+        signature_rows
+            .par_iter()
+            .flat_map_iter(|signature| band_hashes(signature, num_bands, rows))
+            .collect()
+    });
+    Ok(
+        Array2::from_shape_vec((signature_rows.len(), num_bands), hashes)
+            .expect("One hash per band.")
+            .into_pyarray(py),
+    )
+}
+
+/// Set of the hashes of one band, in a flat array with linear probing.
+struct BandTable {
+    hashes: Vec<u64>,
+    len: usize,
+}
+
+impl BandTable {
+    fn new(capacity: usize) -> Self {
+        Self {
+            hashes: vec![EMPTY; capacity],
+            len: 0,
+        }
+    }
+
+    fn slot(&self, hash: u64) -> usize {
+        let mask = self.hashes.len() - 1;
+        let mut i = hash as usize & mask;
+        while self.hashes[i] != EMPTY && self.hashes[i] != hash {
+            i = (i + 1) & mask;
+        }
+        i
+    }
+
+    fn contains(&self, hash: u64) -> bool {
+        self.hashes[self.slot(hash)] == hash
+    }
+
+    /// The table must not be full, see `needs_to_grow`.
+    fn insert(&mut self, hash: u64) {
+        let i = self.slot(hash);
+        if self.hashes[i] == EMPTY {
+            self.hashes[i] = hash;
+            self.len += 1;
+        }
+    }
+
+    /// Keep the load factor under 1/2, the probes stay short.
+    fn needs_to_grow(&self) -> bool {
+        2 * (self.len + 1) > self.hashes.len()
+    }
+
+    fn grow(&mut self) {
+        let capacity = 2 * self.hashes.len();
+        let old = std::mem::replace(&mut self.hashes, vec![EMPTY; capacity]);
+        self.len = 0;
+        for hash in old.into_iter().filter(|&h| h != EMPTY) {
+            self.insert(hash);
+        }
+    }
+}
+
+/// Index of MinHash signatures with banded LSH: two signatures are candidates when all the
+/// rows of one of their bands are equal. Only the hash of each band is stored.
+///
+/// The memory is limited to `max_bytes`. When the tables would have to grow beyond it, the
+/// index is full: new documents are still compared to the documents already in the index,
+/// but are not added to it anymore, see `num_skipped`.
+#[pyclass]
+pub(crate) struct LshIndex {
+    #[pyo3(get)]
+    num_bands: usize,
+    #[pyo3(get)]
+    rows: usize,
+    #[pyo3(get)]
+    max_bytes: usize,
+    /// Number of documents added to the index.
+    #[pyo3(get)]
+    num_documents: u64,
+    /// Number of documents not added because the index was full.
+    #[pyo3(get)]
+    num_skipped: u64,
+    tables: Vec<BandTable>,
+}
+
+#[pymethods]
+impl LshIndex {
+    #[new]
+    #[pyo3(signature = (num_bands, rows, max_bytes = usize::MAX))]
+    pub(crate) fn new(num_bands: usize, rows: usize, max_bytes: usize) -> PyResult<Self> {
+        if num_bands == 0 || rows == 0 {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                "Invalid LSH parameters: {num_bands} bands of {rows} rows"
+            )));
+        }
+        Ok(Self {
+            num_bands,
+            rows,
+            max_bytes,
+            num_documents: 0,
+            num_skipped: 0,
+            tables: (0..num_bands)
+                .map(|_| BandTable::new(INITIAL_CAPACITY))
+                .collect(),
+        })
+    }
+
+    /// Size of the tables in bytes.
+    #[getter]
+    pub(crate) fn memory_usage(&self) -> usize {
+        self.tables.iter().map(|t| 8 * t.hashes.len()).sum()
+    }
+
+    /// Returns true if the signature is a candidate duplicate of a document of the index,
+    /// otherwise adds it to the index. Only the first `num_bands * rows` values are used.
+    pub(crate) fn query_and_insert(&mut self, signature: Vec<u64>) -> PyResult<bool> {
+        self.check_signature_size(signature.len())?;
+        let band_hashes = self.band_hashes(&signature);
+        Ok(self.query_and_insert_hashes(&band_hashes))
+    }
+
+    /// Same as `query_and_insert` on each row in order, a signature can be a duplicate of
+    /// one before it in the batch. The band hashes are computed in parallel.
+    pub(crate) fn query_and_insert_batch(
+        &mut self,
+        py: Python<'_>,
+        signatures: PyReadonlyArray2<'_, u64>,
+    ) -> PyResult<Vec<bool>> {
+        let signatures = signatures.as_array();
+        self.check_signature_size(signatures.ncols())?;
+        let rows: Vec<Vec<u64>> = signatures.rows().into_iter().map(|r| r.to_vec()).collect();
+        py.allow_threads(|| {
+            let band_hashes: Vec<Vec<u64>> =
+                rows.par_iter().map(|row| self.band_hashes(row)).collect();
+            Ok(band_hashes
+                .iter()
+                .map(|hashes| self.query_and_insert_hashes(hashes))
+                .collect())
+        })
+    }
+
+    /// Written to a temporary file then renamed, the file is always complete.
+    #[pyo3(name = "save")]
+    pub(crate) fn py_save(&self, path: &str) -> PyResult<()> {
+        self.save(path)
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("{}", e)))
+    }
+
+    /// `max_bytes` replaces the limit of the saved index.
+    #[staticmethod]
+    #[pyo3(name = "load", signature = (path, max_bytes = usize::MAX))]
+    pub(crate) fn py_load(path: &str, max_bytes: usize) -> PyResult<Self> {
+        Self::load(path, max_bytes)
+            .map_err(|e| PyErr::new::<pyo3::exceptions::PyIOError, _>(format!("{}", e)))
+    }
+}
+
+impl LshIndex {
+    fn check_signature_size(&self, size: usize) -> PyResult<()> {
+        if size < self.num_bands * self.rows {
+            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+                "Signatures of {size} values are too short for {} bands of {} rows",
+                self.num_bands, self.rows
+            )));
+        }
+        Ok(())
+    }
+
+    fn band_hashes(&self, signature: &[u64]) -> Vec<u64> {
+        band_hashes(signature, self.num_bands, self.rows)
+    }
+
+    fn query_and_insert_hashes(&mut self, band_hashes: &[u64]) -> bool {
+        let duplicate = self
+            .tables
+            .iter()
+            .zip(band_hashes)
+            .any(|(table, &hash)| table.contains(hash));
+        if !duplicate {
+            self.insert(band_hashes);
+        }
+        duplicate
+    }
+
+    fn insert(&mut self, band_hashes: &[u64]) {
+        let extra_bytes: usize = self
+            .tables
+            .iter()
+            .filter(|t| t.needs_to_grow())
+            .map(|t| 8 * t.hashes.len())
+            .sum();
+        if extra_bytes > 0 && self.memory_usage() + extra_bytes > self.max_bytes {
+            self.num_skipped += 1;
+            return;
+        }
+        for (table, &hash) in self.tables.iter_mut().zip(band_hashes) {
+            if table.needs_to_grow() {
+                table.grow();
+            }
+            table.insert(hash);
+        }
+        self.num_documents += 1;
+    }
+
+    pub(crate) fn save(&self, path: &str) -> anyhow::Result<()> {
+        use byteorder::{LittleEndian, WriteBytesExt};
+        use std::io::Write;
+
+        let tmp_path = format!("{path}.tmp");
+        let mut file = std::io::BufWriter::new(std::fs::File::create(&tmp_path)?);
+        file.write_all(&MAGIC)?;
+        file.write_u32::<LittleEndian>(VERSION)?;
+        file.write_u32::<LittleEndian>(self.num_bands as u32)?;
+        file.write_u32::<LittleEndian>(self.rows as u32)?;
+        file.write_u64::<LittleEndian>(self.num_documents)?;
+        file.write_u64::<LittleEndian>(self.num_skipped)?;
+        for table in &self.tables {
+            file.write_u64::<LittleEndian>(table.hashes.len() as u64)?;
+            file.write_u64::<LittleEndian>(table.len as u64)?;
+            for &hash in &table.hashes {
+                file.write_u64::<LittleEndian>(hash)?;
+            }
+        }
+        file.into_inner()?.sync_all()?;
+        std::fs::rename(&tmp_path, path)?;
+        Ok(())
+    }
+
+    pub(crate) fn load(path: &str, max_bytes: usize) -> anyhow::Result<Self> {
+        use byteorder::{LittleEndian, ReadBytesExt};
+        use std::io::Read;
+
+        let mut file = std::io::BufReader::new(std::fs::File::open(path)?);
+        let mut magic = [0u8; 4];
+        file.read_exact(&mut magic)?;
+        if magic != MAGIC {
+            anyhow::bail!("{path} is not an LSH index");
+        }
+        let version = file.read_u32::<LittleEndian>()?;
+        if version != VERSION {
+            anyhow::bail!("Unknown version of the LSH index format: {version}");
+        }
+        let num_bands = file.read_u32::<LittleEndian>()? as usize;
+        let rows = file.read_u32::<LittleEndian>()? as usize;
+        let num_documents = file.read_u64::<LittleEndian>()?;
+        let num_skipped = file.read_u64::<LittleEndian>()?;
+        let mut tables = Vec::with_capacity(num_bands);
+        for _ in 0..num_bands {
+            let capacity = file.read_u64::<LittleEndian>()? as usize;
+            let len = file.read_u64::<LittleEndian>()? as usize;
+            if !capacity.is_power_of_two() || len >= capacity {
+                anyhow::bail!("{path} is not a valid LSH index");
+            }
+            let mut hashes = vec![EMPTY; capacity];
+            file.read_u64_into::<LittleEndian>(&mut hashes)?;
+            tables.push(BandTable { hashes, len });
+        }
+        Ok(Self {
+            num_bands,
+            rows,
+            max_bytes,
+            num_documents,
+            num_skipped,
+            tables,
+        })
+    }
+}
@@ -0,0 +1,385 @@
+use numpy::ndarray::Array2;
+use numpy::{IntoPyArray, PyArray2};
+use pyo3::prelude::*;
+use pyo3::pybacked::PyBackedStr;
+use rayon::prelude::*;
+use std::collections::HashSet;
+use xxhash_rust::xxh3::xxh3_64;
+
+use crate::gopher::{get_stop_words, is_bullet_start, is_end_punctuation, GOPHER_METRIC_NAMES};
+use crate::repetitions::{
+    long_words, ngram_repetition_metrics, repetitions_rolling, RollingRepetitions,
+    REPETITION_METRIC_NAMES, SCRATCH,
+};
+
+const NUM_DOCUMENT_METRICS: usize = 2 + GOPHER_METRIC_NAMES.len() + REPETITION_METRIC_NAMES.len();
+
+/// All the metrics of `compute_repetitions_rolling(text, n)`, `compute_long_words(text,
+/// min_length)`, `compute_gopher_metrics` and `compute_repetition_metrics` in one pass over
+/// the text. The values are the same, in the order of `document_metric_names()`. Without
+/// `gopher`, only the repetitions and the long words are computed, the others are NaN.
+/// Without `repetition_metrics`, the words aren't hashed and the metrics of
+/// `compute_repetition_metrics` are NaN.
+#[pyfunction]
+#[pyo3(signature = (
+    text, language, n = 20, min_length = 15, gopher = true, repetition_metrics = true
+))]
+pub fn compute_document_metrics(
+    py: Python<'_>,
+    text: &str,
+    language: &str,
+    n: usize,
+    min_length: usize,
+    gopher: bool,
+    repetition_metrics: bool,
+) -> Vec<f32> {
+    py.allow_threads(|| {
+        document_metrics(text, language, n, min_length, gopher, repetition_metrics).to_vec()
+    })
+}
+
+/// Returns an array of shape (len(texts), len(document_metric_names())).
+#[pyfunction]
+#[pyo3(signature = (
+    texts, languages, n = 20, min_length = 15, gopher = true, repetition_metrics = true
+))]
+pub fn compute_document_metrics_batch<'py>(
+    py: Python<'py>,
+    texts: Vec<PyBackedStr>,
+    languages: Vec<PyBackedStr>,
+    n: usize,
+    min_length: usize,
+    gopher: bool,
+    repetition_metrics: bool,
+) -> PyResult<Bound<'py, PyArray2<f32>>> {
+    if texts.len() != languages.len() {
+        return Err(pyo3::exceptions::PyValueError::new_err(
+            "texts and languages must have the same length",
+        ));
+    }
+    let results: Vec<f32> = py.allow_threads(|| {
+        texts
+            .par_iter()
+            .zip(languages.par_iter())
+            .flat_map_iter(|(text, language)| {
+                document_metrics(text, language, n, min_length, gopher, repetition_metrics)
+            })
+            .collect()
+    });
+    let results = Array2::from_shape_vec((texts.len(), NUM_DOCUMENT_METRICS), results)
+        .expect("One row of metrics per text.");
+    Ok(results.into_pyarray(py))
+}
+
+/// Order of the values returned by `compute_document_metrics`: the repetitions and the long
+/// words, then the Gopher metrics and the repetition metrics, with the same names as in
+/// `gopher_metric_names()` and `repetition_metric_names()`.
+#[pyfunction]
+pub fn document_metric_names() -> Vec<&'static str> {
+    ["repetitions", "long_words"]
+        .into_iter()
+        .chain(GOPHER_METRIC_NAMES)
+        .chain(REPETITION_METRIC_NAMES)
+        .collect()
+}
+
+pub(crate) fn document_metrics(
+    text: &str,
+    language: &str,
+    n: usize,
+    min_length: usize,
+    gopher: bool,
+    repetition_metrics: bool,
+) -> [f32; NUM_DOCUMENT_METRICS] {
+    let mut values = [f32::NAN; NUM_DOCUMENT_METRICS];
+    if !gopher {
+        // The loops of the two metrics alone are faster than the scan.
+        values[0] = repetitions_rolling(text, n);
+        values[1] = long_words(text, min_length);
+        return values;
+    }
+    let options = ScanOptions {
+        repetitions: Some(n),
+        long_words: Some(min_length),
+        ngram_repetitions: repetition_metrics,
+    };
+    let metrics = scan(text, language, &options);
+    values[0] = metrics.repetitions;
+    values[1] = metrics.long_words;
+    values[2..2 + GOPHER_METRIC_NAMES.len()].copy_from_slice(&metrics.gopher);
+    if repetition_metrics {
+        values[2 + GOPHER_METRIC_NAMES.len()..].copy_from_slice(&metrics.ngram_repetitions);
+    }
+    values
+}
+
+/// What `scan` computes on top of the Gopher metrics, the others are 0.
+#[derive(Default)]
+pub(crate) struct ScanOptions {
+    /// The size of the windows of `repetitions_rolling`.
+    pub(crate) repetitions: Option<usize>,
+    /// The minimum length of the words of `long_words`.
+    pub(crate) long_words: Option<usize>,
+    /// The metrics of `repetition_metrics`.
+    pub(crate) ngram_repetitions: bool,
+}
+
+pub(crate) struct ScanMetrics {
+    pub(crate) repetitions: f32,
+    pub(crate) long_words: f32,
+    /// In the order of `GOPHER_METRIC_NAMES`.
+    pub(crate) gopher: [f32; 8],
+    /// In the order of `REPETITION_METRIC_NAMES`.
+    pub(crate) ngram_repetitions: [f32; 9],
+}
+
+/// Computes the metrics in a single pass over the chars of the text. The words, lines,
+/// sentences and paragraphs are the same as with `split_whitespace`, `lines`, and the splits
+/// of the Gopher metrics, but are found as the chars go, without being collected or copied.
+pub(crate) fn scan(text: &str, language: &str, options: &ScanOptions) -> ScanMetrics {
+    SCRATCH.with_borrow_mut(|table| {
+        let bytes = text.as_bytes();
+        let mut rolling = options.repetitions.filter(|&n| bytes.len() > n).map(|n| {
+            table.reset(bytes.len() - n);
+            RollingRepetitions::new(n)
+        });
+        let mut words = WordCounts::new(language, options);
+        let mut lines = LineCounts::default();
+        let mut sentences = DuplicateCounts::default();
+        let mut paragraphs = DuplicateCounts::default();
+        let mut total_chars: usize = 0;
+        let mut alphabetic_chars: usize = 0;
+        let mut word_start = None;
+        let mut word_has_alpha = false;
+        let mut line_start = 0;
+        let mut sentence_start = 0;
+        let mut paragraph_start = 0;
+
+        for (i, c) in text.char_indices() {
+            if let Some(rolling) = &mut rolling {
+                for j in i..i + c.len_utf8() {
+                    rolling.push(bytes, j, table);
+                }
+            }
+            let alphabetic = c.is_alphabetic();
+            total_chars += 1;
+            alphabetic_chars += alphabetic as usize;
+            if c.is_whitespace() {
+                if let Some(start) = word_start.take() {
+                    words.push(&text[start..i], word_has_alpha);
+                }
+            } else if word_start.is_none() {
+                word_start = Some(i);
+                word_has_alpha = alphabetic;
+            } else {
+                word_has_alpha |= alphabetic;
+            }
+            if c == '\n' {
+                let line = &text[line_start..i];
+                lines.push(line.strip_suffix('\r').unwrap_or(line));
+                line_start = i + 1;
+                // Like `split("\n\n")`, the separators don't overlap.
+                if i >= paragraph_start && bytes.get(i + 1) == Some(&b'\n') {
+                    paragraphs.push(&text[paragraph_start..i]);
+                    paragraph_start = i + 2;
+                }
+            } else if c.is_ascii() && is_end_punctuation(c as u8) {
+                if bytes.get(i + 1).map_or(true, |b| b.is_ascii_whitespace()) {
+                    sentences.push(&text[sentence_start..i + 1]);
+                    sentence_start = i + 1;
+                }
+            }
+        }
+        if let Some(start) = word_start {
+            words.push(&text[start..], word_has_alpha);
+        }
+        if line_start < bytes.len() {
+            lines.push(&text[line_start..]);
+        }
+        sentences.push(&text[sentence_start..]);
+        paragraphs.push(&text[paragraph_start..]);
+
+        let frac_alphabetic_chars = if total_chars > 0 {
+            alphabetic_chars as f32 / total_chars as f32
+        } else {
+            0.0
+        };
+        let (mean_word_length, frac_words_with_alpha) = words.gopher_metrics();
+        let (frac_lines_end_punctuation, frac_lines_start_bullet) = lines.gopher_metrics();
+        let gopher = [
+            mean_word_length,
+            frac_words_with_alpha,
+            frac_lines_end_punctuation,
+            frac_lines_start_bullet,
+            frac_alphabetic_chars,
+            words.has_stop_words(),
+            sentences.frac_duplicate(),
+            paragraphs.frac_duplicate(),
+        ];
+        let repetitions = rolling.map_or(0.0, |r| r.n_repetitions as f32 / bytes.len() as f32);
+        let long_words = if bytes.is_empty() {
+            0.0
+        } else {
+            words.long_word_chars as f32 / bytes.len() as f32
+        };
+        let ngram_repetitions = if options.ngram_repetitions {
+            ngram_repetition_metrics(table, &words.hashes, &words.lengths, bytes.len())
+        } else {
+            [0.0; 9]
+        };
+        ScanMetrics {
+            repetitions,
+            long_words,
+            gopher,
+            ngram_repetitions,
+        }
+    })
+}
+
+struct WordCounts {
+    count: usize,
+    total_length: usize,
+    with_alpha: usize,
+    stop_words: Option<&'static [&'static str]>,
+    /// Bit i is set when the stop word i was found.
+    found_stop_words: u64,
+    min_long_word_length: Option<usize>,
+    long_word_chars: usize,
+    keep_hashes: bool,
+    hashes: Vec<u64>,
+    lengths: Vec<usize>,
+}
+
+impl WordCounts {
+    fn new(language: &str, options: &ScanOptions) -> Self {
+        let stop_words = get_stop_words(language);
+        assert!(stop_words.map_or(0, |s| s.len()) <= 64);
+        Self {
+            count: 0,
+            total_length: 0,
+            with_alpha: 0,
+            stop_words,
+            found_stop_words: 0,
+            min_long_word_length: options.long_words,
+            long_word_chars: 0,
+            keep_hashes: options.ngram_repetitions,
+            hashes: vec![],
+            lengths: vec![],
+        }
+    }
+
+    fn push(&mut self, word: &str, has_alpha: bool) {
+        self.count += 1;
+        self.total_length += word.len();
+        self.with_alpha += has_alpha as usize;
+        if self
+            .min_long_word_length
+            .is_some_and(|min| word.len() >= min)
+        {
+            self.long_word_chars += word.len();
+        }
+        if self.keep_hashes {
+            self.hashes.push(xxh3_64(word.as_bytes()));
+            self.lengths.push(word.len());
+        }
+        // Two stop words are enough.
+        if self.found_stop_words.count_ones() < 2 {
+            if let Some(stop_words) = self.stop_words {
+                self.find_stop_word(word, stop_words);
+            }
+        }
+    }
+
+    /// The stop words are lowercase. Lowercasing each word is the same as lowercasing the
+    /// text, the whitespace doesn't change.
+    fn find_stop_word(&mut self, word: &str, stop_words: &[&str]) {
+        let lower = if word.is_ascii() {
+            None
+        } else {
+            Some(word.to_lowercase())
+        };
+        for (i, stop_word) in stop_words.iter().enumerate() {
+            let found = match &lower {
+                None => word.eq_ignore_ascii_case(stop_word),
+                Some(lower) => lower == stop_word,
+            };
+            if found {
+                self.found_stop_words |= 1 << i;
+            }
+        }
+    }
+
+    fn gopher_metrics(&self) -> (f32, f32) {
+        if self.count == 0 {
+            return (0.0, 0.0);
+        }
+        (
+            self.total_length as f32 / self.count as f32,
+            self.with_alpha as f32 / self.count as f32,
+        )
+    }
+
+    fn has_stop_words(&self) -> f32 {
+        // If no stop words for this language, pass by default
+        if self.stop_words.is_none() || self.found_stop_words.count_ones() >= 2 {
+            1.0
+        } else {
+            0.0
+        }
+    }
+}
+
+#[derive(Default)]
+struct LineCounts {
+    count: usize,
+    end_punctuation: usize,
+    start_bullet: usize,
+}
+
+impl LineCounts {
+    fn push(&mut self, line: &str) {
+        self.count += 1;
+        if let Some(&last) = line.trim_end().as_bytes().last() {
+            self.end_punctuation += is_end_punctuation(last) as usize;
+        }
+        self.start_bullet += is_bullet_start(line) as usize;
+    }
+
+    fn gopher_metrics(&self) -> (f32, f32) {
+        if self.count == 0 {
+            return (0.0, 0.0);
+        }
+        (
+            self.end_punctuation as f32 / self.count as f32,
+            self.start_bullet as f32 / self.count as f32,
+        )
+    }
+}
+
+/// The sentences or the paragraphs, trimmed, the empty ones are ignored.
+#[derive(Default)]
+struct DuplicateCounts<'a> {
+    seen: HashSet<&'a str>,
+    total_chars: usize,
+    duplicate_chars: usize,
+}
+
+impl<'a> DuplicateCounts<'a> {
+    fn push(&mut self, chunk: &'a str) {
+        let chunk = chunk.trim();
+        if chunk.is_empty() {
+            return;
+        }
+        self.total_chars += chunk.len();
+        if !self.seen.insert(chunk) {
+            self.duplicate_chars += chunk.len();
+        }
+    }
+
+    fn frac_duplicate(&self) -> f32 {
+        if self.total_chars == 0 {
+            return 0.0;
+        }
+        self.duplicate_chars as f32 / self.total_chars as f32
+    }
+}
@@ -1,41 +1,155 @@
+use numpy::ndarray::Array2;
+use numpy::{IntoPyArray, PyArray2};
 use pyo3::prelude::*;
+use pyo3::pybacked::PyBackedStr;
+use rayon::prelude::*;
+use xxhash_rust::xxh3::xxh3_64;
 
-const FNV_OFFSET: u64 = 14695981039346656037;
-const FNV_PRIME: u64 = 1099511628211;
+// The permutations are the same for every run, the signatures can be compared between runs.
+const PERMUTATION_SEED: u64 = 0x5851f42d4c957f2d;
 
-fn fnv1a(data: &[u8], seed: u64) -> u64 {
-    let mut h = seed;
-    for b in data {
-        h ^= *b as u64;
-        h = h.wrapping_mul(FNV_PRIME);
-    }
-    h
+fn mix64(mut z: u64) -> u64 {
+    z = (z ^ (z >> 30)).wrapping_mul(0xbf58476d1ce4e5b9);
+    z = (z ^ (z >> 27)).wrapping_mul(0x94d049bb133111eb);
+    z ^ (z >> 31)
+}
+
+fn splitmix64(state: &mut u64) -> u64 {
+    *state = state.wrapping_add(0x9e3779b97f4a7c15);
+    mix64(*state)
+}
+
+/// `ngram_size` is a number of bytes, or of words with `words`.
+#[pyfunction]
+#[pyo3(signature = (text, num_perm, ngram_size, words = false))]
+pub fn compute_minhash_signature(
+    py: Python<'_>,
+    text: &str,
+    num_perm: usize,
+    ngram_size: usize,
+    words: bool,
+) -> Vec<u64> {
+    py.allow_threads(|| {
+        let permutations = Permutations::new(num_perm);
+        minhash_signature(text, &permutations, ngram_size, words)
+    })
 }
 
+/// Returns an array of shape (len(texts), num_perm).
 #[pyfunction]
-pub fn compute_minhash_signature(text: &str, num_perm: usize, ngram_size: usize) -> Vec<u64> {
-    let bytes = text.as_bytes();
-    if bytes.len() < ngram_size {
-        return vec![u64::MAX; num_perm];
+#[pyo3(signature = (texts, num_perm, ngram_size, words = false))]
+pub fn compute_minhash_signature_batch<'py>(
+    py: Python<'py>,
+    texts: Vec<PyBackedStr>,
+    num_perm: usize,
+    ngram_size: usize,
+    words: bool,
+) -> Bound<'py, PyArray2<u64>> {
+    let signatures: Vec<u64> = py.allow_threads(|| {
+        let permutations = Permutations::new(num_perm);
+        texts
+            .par_iter()
+            .flat_map_iter(|t| minhash_signature(t, &permutations, ngram_size, words))
+            .collect()
+    });
+    Array2::from_shape_vec((texts.len(), num_perm), signatures)
+        .expect("One signature per text.")
+        .into_pyarray(py)
+}
+
+/// The permutations of the hashes: multiply-shift `(a * h + b) >> 32` on the 64-bit hashes,
+/// with `a` odd, which keeps the 32 high bits. Each shingle is hashed only once, then goes
+/// through all the permutations, which the compiler vectorizes.
+pub(crate) struct Permutations {
+    a: Vec<u64>,
+    b: Vec<u64>,
+}
+
+impl Permutations {
+    pub(crate) fn new(num_perm: usize) -> Self {
+        let mut state = PERMUTATION_SEED;
+        let mut a = Vec::with_capacity(num_perm);
+        let mut b = Vec::with_capacity(num_perm);
+        for _ in 0..num_perm {
+            a.push(splitmix64(&mut state) | 1);
+            b.push(splitmix64(&mut state));
+        }
+        Self { a, b }
     }
 
-    let seeds: Vec<u64> = (0..num_perm)
-        .map(|i| {
-            let idx_bytes = (i as u64).to_le_bytes();
-            fnv1a(&idx_bytes, FNV_OFFSET)
-        })
-        .collect();
-
-    let mut mins = vec![u64::MAX; num_perm];
-
-    for window in bytes.windows(ngram_size) {
-        for (i, seed) in seeds.iter().enumerate() {
-            let h = fnv1a(window, *seed);
-            if h < mins[i] {
-                mins[i] = h;
-            }
+    pub(crate) fn len(&self) -> usize {
+        self.a.len()
+    }
+}
+
+/// One hash per shingle: the windows of `ngram_size` bytes, or of `ngram_size` words
+/// separated by whitespace with `words`. Empty if the text is shorter than one shingle.
+fn shingle_hashes(text: &str, ngram_size: usize, words: bool) -> Vec<u64> {
+    if words {
+        let word_hashes: Vec<u64> = text
+            .split_whitespace()
+            .map(|w| xxh3_64(w.as_bytes()))
+            .collect();
+        if word_hashes.len() < ngram_size {
+            return vec![];
+        }
+        word_hashes
+            .windows(ngram_size)
+            // Order dependent combination, so that each word is hashed only once.
+            .map(|window| {
+                window
+                    .iter()
+                    .fold(0u64, |h, &w| mix64(h.rotate_left(23) ^ w))
+            })
+            .collect()
+    } else {
+        let bytes = text.as_bytes();
+        if bytes.len() < ngram_size {
+            return vec![];
         }
+        bytes.windows(ngram_size).map(xxh3_64).collect()
+    }
+}
+
+/// The values are 32 bits, except for the texts shorter than one shingle, which get only
+/// `u64::MAX`. They are never similar to a longer text, but all of them have the same
+/// signature, so the LSH index sees them as duplicates of each other.
+pub(crate) fn minhash_signature(
+    text: &str,
+    permutations: &Permutations,
+    ngram_size: usize,
+    words: bool,
+) -> Vec<u64> {
+    let hashes = shingle_hashes(text, ngram_size, words);
+    let mut signature = vec![u64::MAX; permutations.len()];
+    if hashes.is_empty() {
+        return signature;
     }
+    #[cfg(target_arch = "x86_64")]
+    if is_x86_feature_detected!("avx2") {
+        // Safety: the CPU supports AVX2.
+        unsafe { permute_avx2(&hashes, permutations, &mut signature) };
+        return signature;
+    }
+    permute(&hashes, permutations, &mut signature);
+    signature
+}
+
+#[inline(always)]
+fn permute(hashes: &[u64], permutations: &Permutations, signature: &mut [u64]) {
+    let parameters = permutations.a.iter().zip(&permutations.b);
+    for ((&a, &b), value) in parameters.zip(signature) {
+        let min = hashes.iter().fold(u32::MAX, |m, &h| {
+            m.min((a.wrapping_mul(h).wrapping_add(b) >> 32) as u32)
+        });
+        *value = min as u64;
+    }
+}
 
-    mins
+/// The default target has no vector multiplication of u64, compile the same code for AVX2,
+/// which does it with 32-bit multiplications.
+#[cfg(target_arch = "x86_64")]
+#[target_feature(enable = "avx2")]
+unsafe fn permute_avx2(hashes: &[u64], permutations: &Permutations, signature: &mut [u64]) {
+    permute(hashes, permutations, signature)
 }
@@ -1,82 +1,362 @@
+use numpy::ndarray::Array2;
+use numpy::{IntoPyArray, PyArray1, PyArray2};
 use pyo3::prelude::*;
+use pyo3::pybacked::PyBackedStr;
+use rayon::prelude::*;
+use std::cell::RefCell;
 use std::collections::HashMap;
+use xxhash_rust::xxh3::xxh3_64;
 
-fn fnv1a_64(data: &[u8]) -> u64 {
-    let mut h = 14695981039346656037u64;
-    for b in data {
-        h ^= *b as u64;
-        h = h.wrapping_mul(1099511628211u64);
-    }
-    h
+/// Order of the columns returned by `compute_repetition_metrics_batch`. The fraction of the
+/// characters in the most frequent n-gram of words for n from 2 to 4, then in the duplicated
+/// n-grams of words for n from 5 to 10, as in Gopher (https://arxiv.org/pdf/2112.11446).
+pub const REPETITION_METRIC_NAMES: [&str; 9] = [
+    "top_2gram_char_frac",
+    "top_3gram_char_frac",
+    "top_4gram_char_frac",
+    "duplicate_5gram_char_frac",
+    "duplicate_6gram_char_frac",
+    "duplicate_7gram_char_frac",
+    "duplicate_8gram_char_frac",
+    "duplicate_9gram_char_frac",
+    "duplicate_10gram_char_frac",
+];
+const TOP_NGRAM_SIZES: std::ops::RangeInclusive<usize> = 2..=4;
+const MAX_NGRAM_SIZE: usize = 10;
+
+const MIN_CAPACITY: usize = 1 << 10;
+// The table starts at most this large and grows with the number of distinct keys.
+const MAX_INITIAL_CAPACITY: usize = 1 << 16;
+// A larger table of a thread is freed after the text that needed it, instead of being kept.
+const MAX_RETAINED_CAPACITY: usize = 1 << 20;
+
+thread_local! {
+    pub(crate) static SCRATCH: RefCell<ScratchTable> = RefCell::new(ScratchTable::default());
+}
+
+#[derive(Clone, Copy, Default)]
+struct Slot {
+    stamp: u32,
+    count: u32,
+    key: u64,
 }
 
-fn init_adler_32(data: &[u8], n: usize) -> (u32, u32) {
-    let mut a = 1;
-    let mut b = 0;
-    for i in 0..n {
-        a = (a + data[i] as u32) % 65521;
-        b = (b + a) % 65521;
+/// Counts of hashes in an open addressing table, reused by all the calls of a thread. The
+/// table is not cleared between calls, each call has a new stamp and the slots with an older
+/// stamp are empty. A call only uses the first `mask + 1` slots, so that a short text stays
+/// in the cache even after a long one.
+#[derive(Default)]
+pub(crate) struct ScratchTable {
+    slots: Vec<Slot>,
+    mask: usize,
+    shift: u32,
+    len: usize,
+    stamp: u32,
+}
+
+impl ScratchTable {
+    /// Empties the table, which will hold up to `max_keys` keys.
+    pub(crate) fn reset(&mut self, max_keys: usize) {
+        if self.slots.len() > MAX_RETAINED_CAPACITY {
+            self.slots.truncate(MAX_RETAINED_CAPACITY);
+            self.slots.shrink_to_fit();
+        }
+        self.next_stamp();
+        // The load factor stays under 2/3.
+        let capacity = (max_keys + max_keys / 2 + 1).next_power_of_two();
+        self.use_capacity(capacity.clamp(MIN_CAPACITY, MAX_INITIAL_CAPACITY));
+        self.len = 0;
+    }
+
+    fn next_stamp(&mut self) {
+        self.stamp = self.stamp.wrapping_add(1);
+        if self.stamp == 0 {
+            self.slots.fill(Slot::default());
+            self.stamp = 1;
+        }
+    }
+
+    fn use_capacity(&mut self, capacity: usize) {
+        if capacity > self.slots.len() {
+            self.slots.resize(capacity, Slot::default());
+        }
+        self.mask = capacity - 1;
+        self.shift = 64 - capacity.trailing_zeros();
+    }
+
+    /// The slot of the key, or the empty slot where it goes.
+    #[inline]
+    fn find(&self, key: u64) -> usize {
+        let mut i = (key.wrapping_mul(0x9e3779b97f4a7c15) >> self.shift) as usize;
+        loop {
+            let slot = &self.slots[i];
+            if slot.stamp != self.stamp || slot.key == key {
+                return i;
+            }
+            i = (i + 1) & self.mask;
+        }
+    }
+
+    #[cold]
+    fn grow(&mut self) {
+        let entries: Vec<Slot> = self.slots[..=self.mask]
+            .iter()
+            .filter(|slot| slot.stamp == self.stamp)
+            .copied()
+            .collect();
+        self.next_stamp();
+        self.use_capacity(2 * (self.mask + 1));
+        for entry in entries {
+            let i = self.find(entry.key);
+            self.slots[i] = Slot {
+                stamp: self.stamp,
+                ..entry
+            };
+        }
+    }
+
+    /// Returns the number of times the key was inserted before.
+    #[inline]
+    pub(crate) fn insert(&mut self, key: u64) -> u32 {
+        let mut i = self.find(key);
+        let slot = &mut self.slots[i];
+        if slot.stamp == self.stamp {
+            slot.count += 1;
+            return slot.count - 1;
+        }
+        if 3 * (self.len + 1) > 2 * (self.mask + 1) {
+            self.grow();
+            i = self.find(key);
+        }
+        self.slots[i] = Slot {
+            stamp: self.stamp,
+            count: 1,
+            key,
+        };
+        self.len += 1;
+        0
     }
-    (a, b)
+}
+
+fn mix64(mut z: u64) -> u64 {
+    z = (z ^ (z >> 30)).wrapping_mul(0xbf58476d1ce4e5b9);
+    z = (z ^ (z >> 27)).wrapping_mul(0x94d049bb133111eb);
+    z ^ (z >> 31)
 }
 
 #[pyfunction]
-pub fn compute_repetitions_rolling(text: &str, n: usize) -> f32 {
-    let mut n_repetitions = 0;
-    let text = text.as_bytes();
-    let mut ngrams = vec![0 as u32; 4 * text.len()];
-    //let mut ngrams = vec![0 as u8; 16 * text.len()];
+pub fn compute_repetitions_rolling(py: Python<'_>, text: &str, n: usize) -> f32 {
+    py.allow_threads(|| repetitions_rolling(text, n))
+}
+
+#[pyfunction]
+pub fn compute_repetitions_rolling_batch<'py>(
+    py: Python<'py>,
+    texts: Vec<PyBackedStr>,
+    n: usize,
+) -> Bound<'py, PyArray1<f32>> {
+    let results: Vec<f32> = py.allow_threads(|| {
+        texts
+            .par_iter()
+            .map(|t| repetitions_rolling(t, n))
+            .collect()
+    });
+    results.into_pyarray(py)
+}
 
+/// Fraction of the windows of `n` bytes seen before in the text, compared by the lower 32
+/// bits of a polynomial rolling hash. A hash of 0 always counts as seen.
+pub(crate) fn repetitions_rolling(text: &str, n: usize) -> f32 {
+    let text = text.as_bytes();
     if text.len() <= n {
         return 0.0;
     }
+    SCRATCH.with_borrow_mut(|seen| {
+        seen.reset(text.len() - n);
+        let mut rolling = RollingRepetitions::new(n);
+        for i in 0..text.len() {
+            rolling.push(text, i, seen);
+        }
+        rolling.n_repetitions as f32 / text.len() as f32
+    })
+}
+
+/// The state of `repetitions_rolling`, the bytes of the text are pushed one at a time.
+pub(crate) struct RollingRepetitions {
+    n: usize,
+    bn: i64,
+    h: i64,
+    pub(crate) n_repetitions: usize,
+}
+
+impl RollingRepetitions {
+    const B: i64 = 33;
+    const PRIME: i64 = 1_000_000_007;
+
+    pub(crate) fn new(n: usize) -> Self {
+        Self {
+            n,
+            bn: 1,
+            h: 0,
+            n_repetitions: 0,
+        }
+    }
 
-    //let (mut a, mut b) = init_adler_32(&text, n);
-    //for i in n..text.len() {
-    //a = (a - text[i-n] as u32 + text[i] as u32) % 65521;
-    //b = (b - n as u32 * text[i-n] as u32 + a - 1) % 65521;
-    //let h = (b * 65536 + a);
-    let b = 33 as i64;
-    let mut bn = 1 as i64;
-    let prime = 1_000_000_007 as i64;
-    let mut h = 0 as i64;
-    for i in 0..text.len() {
-        if i < n {
-            h = (h * b + text[i] as i64) % prime;
-            bn = (bn * b) % prime;
-            continue;
-        }
-        //h = ((h - text[i-n] as u32 * bn) * b + text[i] as u32) % prime;
-        h = (h * b - bn * text[i - n] as i64 + text[i] as i64) % prime;
-
-        /*let h1 = h as usize % (8 * ngrams.len());
-        let h2 = (h * 127) as usize % (8 * ngrams.len());
-        let (i1, j1) = (h1 / 8, h1 % 8);
-        let (i2, j2) = (h2 / 8, h2 % 8);
-        let seen = (ngrams[i1] & (1 << j1) > 0) && (ngrams[i2] & (1 << j2) > 0);
-        ngrams[i1] |= 1 << j1;
-        ngrams[i2] |= 1 << j2;
-        if seen {
-            n_repetitions += 1;
-        }*/
-
-        let mut p = h as usize % ngrams.len();
-        let h32 = h as u32;
-
-        while ngrams[p] != 0 && ngrams[p] != h32 {
-            p = (p + 1) % ngrams.len();
-        }
-        if ngrams[p] == h32 {
-            n_repetitions += 1;
+    /// `i` is the index of the byte in `text`, the previous bytes were pushed before.
+    #[inline]
+    pub(crate) fn push(&mut self, text: &[u8], i: usize, seen: &mut ScratchTable) {
+        if i < self.n {
+            self.h = (self.h * Self::B + text[i] as i64) % Self::PRIME;
+            self.bn = (self.bn * Self::B) % Self::PRIME;
+            return;
+        }
+        self.h =
+            (self.h * Self::B - self.bn * text[i - self.n] as i64 + text[i] as i64) % Self::PRIME;
+        let h32 = self.h as u32;
+        if h32 == 0 || seen.insert(h32 as u64) > 0 {
+            self.n_repetitions += 1;
+        }
+    }
+}
+
+#[pyfunction]
+pub fn compute_repetition_metrics(py: Python<'_>, text: &str) -> HashMap<String, f32> {
+    let metrics = py.allow_threads(|| repetition_metrics(text));
+    REPETITION_METRIC_NAMES
+        .iter()
+        .zip(metrics)
+        .map(|(name, value)| (name.to_string(), value))
+        .collect()
+}
+
+/// Returns an array of shape (len(texts), 9), the columns are in the order of
+/// `repetition_metric_names()`.
+#[pyfunction]
+pub fn compute_repetition_metrics_batch<'py>(
+    py: Python<'py>,
+    texts: Vec<PyBackedStr>,
+) -> Bound<'py, PyArray2<f32>> {
+    let results: Vec<f32> = py.allow_threads(|| {
+        texts
+            .par_iter()
+            .flat_map_iter(|t| repetition_metrics(t))
+            .collect()
+    });
+    Array2::from_shape_vec((texts.len(), REPETITION_METRIC_NAMES.len()), results)
+        .expect("One row of metrics per text.")
+        .into_pyarray(py)
+}
+
+#[pyfunction]
+pub fn repetition_metric_names() -> Vec<&'static str> {
+    REPETITION_METRIC_NAMES.to_vec()
+}
+
+/// The words are separated by whitespace and hashed once. The hashes of the n-grams are
+/// computed from the ones of the (n-1)-grams, so all the sizes take a single pass over the
+/// text. The lengths are in bytes, the spaces between the words of an n-gram count for the
+/// most frequent n-grams, not for the duplicated ones. The most frequent n-gram must occur
+/// at least twice, otherwise the fraction is 0. Its overlapping occurrences all count, as in
+/// Gopher, so the fraction can be above 1 for very repetitive texts.
+pub(crate) fn repetition_metrics(text: &str) -> [f32; 9] {
+    let (word_hashes, word_lengths): (Vec<u64>, Vec<usize>) = text
+        .split_whitespace()
+        .map(|w| (xxh3_64(w.as_bytes()), w.len()))
+        .unzip();
+    SCRATCH.with_borrow_mut(|table| {
+        ngram_repetition_metrics(table, &word_hashes, &word_lengths, text.len())
+    })
+}
+
+/// `repetition_metrics` from the hashes of the words of the text, with `xxh3_64`, and their
+/// lengths.
+pub(crate) fn ngram_repetition_metrics(
+    table: &mut ScratchTable,
+    word_hashes: &[u64],
+    word_lengths: &[usize],
+    text_len: usize,
+) -> [f32; 9] {
+    let mut metrics = [0.0; 9];
+    // Hash and length without spaces of the n-gram starting at each word.
+    let mut hashes: Vec<u64> = word_hashes.iter().map(|&w| mix64(w)).collect();
+    let mut lengths = word_lengths.to_vec();
+    for (n, metric) in (2..=MAX_NGRAM_SIZE).zip(&mut metrics) {
+        if word_hashes.len() < n {
+            break;
+        }
+        hashes.truncate(word_hashes.len() - n + 1);
+        lengths.truncate(hashes.len());
+        for (i, (hash, length)) in hashes.iter_mut().zip(&mut lengths).enumerate() {
+            // Same order dependent combination as the shingles of the MinHash.
+            *hash = mix64(hash.rotate_left(23) ^ word_hashes[i + n - 1]);
+            *length += word_lengths[i + n - 1];
+        }
+        table.reset(hashes.len());
+        let chars = if TOP_NGRAM_SIZES.contains(&n) {
+            top_ngram_chars(table, &hashes, &lengths, n)
+        } else {
+            duplicate_ngram_chars(table, &hashes, &lengths, n)
+        };
+        *metric = chars as f32 / text_len as f32;
+    }
+    metrics
+}
+
+fn top_ngram_chars(table: &mut ScratchTable, hashes: &[u64], lengths: &[usize], n: usize) -> usize {
+    let mut top_count = 1;
+    let mut top_length = 0;
+    for (&hash, &length) in hashes.iter().zip(lengths) {
+        let count = table.insert(hash) + 1;
+        if count > top_count {
+            top_count = count;
+            top_length = length + n - 1;
+        }
+    }
+    top_count as usize * top_length
+}
+
+/// After a duplicated n-gram, the next n-gram starts after it, so that each character is
+/// counted at most once.
+fn duplicate_ngram_chars(
+    table: &mut ScratchTable,
+    hashes: &[u64],
+    lengths: &[usize],
+    n: usize,
+) -> usize {
+    let mut duplicate_chars = 0;
+    let mut i = 0;
+    while i < hashes.len() {
+        if table.insert(hashes[i]) > 0 {
+            duplicate_chars += lengths[i];
+            i += n;
         } else {
-            ngrams[p] = h32;
+            i += 1;
         }
     }
-    n_repetitions as f32 / text.len() as f32
+    duplicate_chars
 }
 
 #[pyfunction]
-pub fn compute_long_words(text: &str, min_length: usize) -> f32 {
+pub fn compute_long_words(py: Python<'_>, text: &str, min_length: usize) -> f32 {
+    py.allow_threads(|| long_words(text, min_length))
+}
+
+#[pyfunction]
+pub fn compute_long_words_batch<'py>(
+    py: Python<'py>,
+    texts: Vec<PyBackedStr>,
+    min_length: usize,
+) -> Bound<'py, PyArray1<f32>> {
+    let results: Vec<f32> = py.allow_threads(|| {
+        texts
+            .par_iter()
+            .map(|t| long_words(t, min_length))
+            .collect()
+    });
+    results.into_pyarray(py)
+}
+
+pub(crate) fn long_words(text: &str, min_length: usize) -> f32 {
     if text.len() == 0 {
         return 0.0;
     }
@@ -88,22 +368,3 @@ pub fn compute_long_words(text: &str, min_length: usize) -> f32 {
     }
     n_long_words as f32 / text.len() as f32
 }
-
-fn compute_repetitions(text: &String, n: usize) -> u32 {
-    let mut n_repetitions = 0;
-    let mut ngrams = HashMap::<&[u8], u32>::new();
-    let text = text.as_bytes();
-
-    if text.len() <= n {
-        return 0;
-    }
-
-    for i in 0..(text.len() - n) {
-        let ngram = &text[i..(i + n)];
-        match ngrams.insert(ngram, 1) {
-            Some(_) => n_repetitions += 1,
-            None => (),
-        }
-    }
-    n_repetitions
-}
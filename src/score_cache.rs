@@ -0,0 +1,190 @@
+use std::collections::HashMap;
+
+const NIL: usize = usize::MAX;
+
+/// The scores of the lines seen recently by a model, keyed by the hash of the line, with the
+/// least recently used line evicted when the cache is full. The entries are in flat arrays,
+/// linked in order of use by their indices.
+pub(crate) struct ScoreCache {
+    capacity: usize,
+    num_labels: usize,
+    index: HashMap<u64, usize>,
+    keys: Vec<u64>,
+    // `num_labels` scores per entry.
+    scores: Vec<f32>,
+    previous: Vec<usize>,
+    next: Vec<usize>,
+    // The most and the least recently used entries.
+    head: usize,
+    tail: usize,
+    pub(crate) hits: u64,
+    pub(crate) misses: u64,
+}
+
+impl ScoreCache {
+    pub(crate) fn new(capacity: usize, num_labels: usize) -> Self {
+        Self {
+            capacity,
+            num_labels,
+            index: HashMap::with_capacity(capacity),
+            keys: Vec::with_capacity(capacity),
+            scores: Vec::with_capacity(capacity * num_labels),
+            previous: Vec::with_capacity(capacity),
+            next: Vec::with_capacity(capacity),
+            head: NIL,
+            tail: NIL,
+            hits: 0,
+            misses: 0,
+        }
+    }
+
+    pub(crate) fn len(&self) -> usize {
+        self.keys.len()
+    }
+
+    /// Copies the scores of the line to `scores` and returns true if they are in the cache.
+    pub(crate) fn get(&mut self, key: u64, scores: &mut [f32]) -> bool {
+        let Some(&i) = self.index.get(&key) else {
+            self.misses += 1;
+            return false;
+        };
+        self.hits += 1;
+        scores.copy_from_slice(self.entry_scores(i));
+        self.unlink(i);
+        self.push_front(i);
+        true
+    }
+
+    pub(crate) fn insert(&mut self, key: u64, scores: &[f32]) {
+        if self.capacity == 0 || self.index.contains_key(&key) {
+            return;
+        }
+        let i = if self.len() < self.capacity {
+            self.keys.push(key);
+            self.scores.extend_from_slice(scores);
+            self.previous.push(NIL);
+            self.next.push(NIL);
+            self.len() - 1
+        } else {
+            let i = self.tail;
+            self.unlink(i);
+            self.index.remove(&self.keys[i]);
+            self.keys[i] = key;
+            let num_labels = self.num_labels;
+            self.scores[i * num_labels..(i + 1) * num_labels].copy_from_slice(scores);
+            i
+        };
+        self.index.insert(key, i);
+        self.push_front(i);
+    }
+
+    fn entry_scores(&self, i: usize) -> &[f32] {
+        &self.scores[i * self.num_labels..(i + 1) * self.num_labels]
+    }
+
+    fn unlink(&mut self, i: usize) {
+        let (previous, next) = (self.previous[i], self.next[i]);
+        match previous {
+            NIL => self.head = next,
+            p => self.next[p] = next,
+        }
+        match next {
+            NIL => self.tail = previous,
+            n => self.previous[n] = previous,
+        }
+    }
+
+    fn push_front(&mut self, i: usize) {
+        self.previous[i] = NIL;
+        self.next[i] = self.head;
+        match self.head {
+            NIL => self.tail = i,
+            h => self.previous[h] = i,
+        }
+        self.head = i;
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn get(cache: &mut ScoreCache, key: u64) -> Option<f32> {
+        let mut scores = [0.0];
+        cache.get(key, &mut scores).then_some(scores[0])
+    }
+
+    #[test]
+    fn evicts_least_recently_inserted() {
+        let mut cache = ScoreCache::new(2, 1);
+        cache.insert(1, &[0.1]);
+        cache.insert(2, &[0.2]);
+        cache.insert(3, &[0.3]);
+        assert_eq!(cache.len(), 2);
+        assert_eq!(get(&mut cache, 1), None);
+        assert_eq!(get(&mut cache, 2), Some(0.2));
+        assert_eq!(get(&mut cache, 3), Some(0.3));
+    }
+
+    #[test]
+    fn get_moves_to_front() {
+        let mut cache = ScoreCache::new(2, 1);
+        cache.insert(1, &[0.1]);
+        cache.insert(2, &[0.2]);
+        assert_eq!(get(&mut cache, 1), Some(0.1));
+        cache.insert(3, &[0.3]);
+        assert_eq!(get(&mut cache, 2), None);
+        assert_eq!(get(&mut cache, 1), Some(0.1));
+        assert_eq!(get(&mut cache, 3), Some(0.3));
+    }
+
+    #[test]
+    fn reuses_tail_slot() {
+        let mut cache = ScoreCache::new(3, 2);
+        for key in 0..3 {
+            cache.insert(key, &[key as f32, -(key as f32)]);
+        }
+        // 0 is the tail, its slot gets the scores of 3.
+        cache.insert(3, &[3.0, -3.0]);
+        assert_eq!(cache.keys, vec![3, 1, 2]);
+        assert_eq!(cache.scores, vec![3.0, -3.0, 1.0, -1.0, 2.0, -2.0]);
+        assert_eq!(cache.index.len(), 3);
+        assert_eq!((cache.head, cache.tail), (0, 1));
+        // Then 1, and the order of use is kept after several evictions.
+        cache.insert(4, &[4.0, -4.0]);
+        assert_eq!(cache.keys, vec![3, 4, 2]);
+        let mut scores = [0.0; 2];
+        assert!(cache.get(2, &mut scores));
+        assert_eq!(scores, [2.0, -2.0]);
+        cache.insert(5, &[5.0, -5.0]);
+        assert_eq!(cache.keys, vec![5, 4, 2]);
+    }
+
+    #[test]
+    fn insert_existing_key() {
+        let mut cache = ScoreCache::new(2, 1);
+        cache.insert(1, &[0.1]);
+        cache.insert(1, &[0.5]);
+        assert_eq!(cache.len(), 1);
+        assert_eq!(get(&mut cache, 1), Some(0.1));
+    }
+
+    #[test]
+    fn zero_capacity() {
+        let mut cache = ScoreCache::new(0, 1);
+        cache.insert(1, &[0.1]);
+        assert_eq!(cache.len(), 0);
+        assert_eq!(get(&mut cache, 1), None);
+    }
+
+    #[test]
+    fn counts_hits_and_misses() {
+        let mut cache = ScoreCache::new(2, 1);
+        assert_eq!(get(&mut cache, 1), None);
+        cache.insert(1, &[0.1]);
+        assert_eq!(get(&mut cache, 1), Some(0.1));
+        assert_eq!(get(&mut cache, 1), Some(0.1));
+        assert_eq!(get(&mut cache, 2), None);
+        assert_eq!((cache.hits, cache.misses), (2, 2));
+    }
+}
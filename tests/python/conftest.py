@@ -0,0 +1,168 @@
+import gzip
+import http.server
+import threading
+
+import dactory.create
+import dactory.dedup
+import pytest
+from dactory.create import GroupWriter, LoadedArgs
+from dactory.fetcher import READ_CHUNK_SIZE, WarcFetcher
+from dactory.language_detector import FastTextModel
+from dactory.prefilter import RecordPrefilter
+from dactory.zstd_writer import FramedZstdWriter, OutputOptions
+
+
+def make_record(idx: int) -> bytes:
+    body = f"HTTP/1.1 200 OK\r\nContent-Type: text/html\r\n\r\n<p>document {idx}</p>".encode()
+    header = (
+        "WARC/1.0\r\nWARC-Type: response\r\nWARC-Date: 2024-01-01T00:00:00Z\r\n"
+        "Content-Type: application/http; msgtype=response\r\n"
+        f"WARC-Record-ID: <urn:uuid:{idx}>\r\nWARC-Target-URI: http://example.com/{idx}\r\n"
+        f"Content-Length: {len(body)}\r\n\r\n"
+    ).encode()
+    # Like the CommonCrawl files, one gzip member per record.
+    return gzip.compress(header + body + b"\r\n\r\n")
+
+
+RECORDS = [make_record(i) for i in range(100)]
+WARC = b"".join(RECORDS)
+
+
+class WarcHandler(http.server.BaseHTTPRequestHandler):
+    """Serves WARC at /sample.warc.gz, with range requests, half of it at /truncated, all of
+    it at /no-range whatever the range asked, and 503 at /busy."""
+
+    def do_GET(self):
+        if self.path == "/truncated":
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(WARC)))
+            self.end_headers()
+            self.wfile.write(WARC[: len(WARC) // 2])
+            self.close_connection = True
+            return
+        if self.path == "/busy":
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start = 0
+        if "Range" in self.headers and self.path != "/no-range":
+            start = int(self.headers["Range"].removeprefix("bytes=").removesuffix("-"))
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(WARC) - start))
+        self.end_headers()
+        self.wfile.write(WARC[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), WarcHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def no_start_delay(monkeypatch):
+    monkeypatch.setattr(dactory.create, "MAX_WORKER_START_DELAY", 0)
+
+
+class StubLanguageModel(FastTextModel):
+    """A fastText model giving the language and score returned by `predict_fn` for a text."""
+
+    def __init__(self, predict_fn=lambda text: ("en", 0.99)):
+        self.predict_fn = predict_fn
+        self.texts = []
+
+    def predict(self, text):
+        self.texts.append(text)
+        language, score = self.predict_fn(text)
+        return [f"__label__{language}"], [score]
+
+
+@pytest.fixture
+def make_args(tmp_path):
+    """LoadedArgs with all the filters and models disabled, and some fields replaced."""
+
+    def make_args(**kwargs) -> LoadedArgs:
+        values = dict(
+            destination_directory=tmp_path / "destination",
+            corpus="CC-MAIN-2024-10",
+            workers=1,
+            filter_workers=0,
+            groups=[0],
+            warc_paths=[[]],
+            min_length=0,
+            lang_detection_model=StubLanguageModel(),
+            languages=["en"],
+            bloom_filter="none",
+            min_bloom_threshold=0.2,
+            save_bloom_filters=False,
+            scoring_models=None,
+            max_rand_score=1.0,
+            enable_gopher_filters=False,
+            enable_gopher_repetition_filters=False,
+            enable_minhash_dedup=False,
+            minhash_threshold=0.8,
+            minhash_num_perm=128,
+            minhash_ngram_size=5,
+            minhash_words=False,
+            minhash_max_memory=1 << 30,
+            quality_classifier=None,
+            max_dclm_low_score=1.0,
+            output=OutputOptions(),
+            fetcher=WarcFetcher(max_concurrency=2, read_ahead=READ_CHUNK_SIZE),
+            prefilter=RecordPrefilter(),
+            lid_sampling=None,
+            extract_only=False,
+            quiet=True,
+        )
+        return LoadedArgs(**(values | kwargs))
+
+    return make_args
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def interrupt_writes(monkeypatch):
+    """Makes `GroupWriter.write` raise Interrupted after `num_batches` calls, until
+    `interrupt_writes(None)`."""
+    write = GroupWriter.write
+
+    def interrupt_writes(num_batches: int | None):
+        if num_batches is None:
+            monkeypatch.setattr(GroupWriter, "write", write)
+            return
+        batches_written = 0
+
+        def interrupted_write(self, batch):
+            nonlocal batches_written
+            if batches_written == num_batches:
+                raise Interrupted
+            batches_written += 1
+            write(self, batch)
+
+        monkeypatch.setattr(GroupWriter, "write", interrupted_write)
+
+    return interrupt_writes
+
+
+class SmallFramesWriter(FramedZstdWriter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, frame_size=200, **kwargs)
+
+
+@pytest.fixture
+def small_frames(monkeypatch):
+    """The groups are written in frames of a few documents, to be split in several shards."""
+    monkeypatch.setattr(dactory.create, "FramedZstdWriter", SmallFramesWriter)
+    monkeypatch.setattr(dactory.dedup, "FramedZstdWriter", SmallFramesWriter)
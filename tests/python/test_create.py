@@ -0,0 +1,299 @@
+import json
+import random
+from collections import Counter
+
+import dactory.create
+import dactory.zstd_writer
+import pytest
+from dactory.bloom_filter import create_blocked_bloom_filter
+from dactory.create import (
+    UnwantedWarcRecord,
+    WarcResults,
+    create_dataset,
+    document_generator,
+    get_warc_url,
+    identify_language,
+)
+from dactory.document import Document
+from dactory.language_detector import LanguageSampling
+from dactory.refilter import read_documents, read_group_documents, source_group_files
+from dactory.rewinding import WarcProgress
+from dactory.zstd_writer import OutputOptions, split_into_shards
+
+from .conftest import RECORDS, WARC, Interrupted, StubLanguageModel
+
+
+def run(args, url: str, previous_work: WarcProgress) -> tuple[list, WarcResults]:
+    *documents, results = document_generator(args, url, 0, previous_work)
+    assert isinstance(results, WarcResults)
+    for document in documents:
+        assert document.text == f"document {document.record_idx}"
+    return [document.record_idx for document in documents], results
+
+
+def offset_of(record_idx: int) -> int:
+    return sum(len(record) for record in RECORDS[:record_idx])
+
+
+class TestDocumentGenerator:
+    def test_whole_warc(self, make_args, server_url):
+        record_ids, results = run(make_args(), f"{server_url}/sample.warc.gz", WarcProgress())
+        assert record_ids == list(range(100))
+        assert results.success and results.processed_records == 100
+
+    def test_range_resume(self, make_args, server_url):
+        # Resumes at record 40 with a range request, the records up to 49 are already written.
+        previous_work = WarcProgress(
+            last_record_seen=49, resume_offset=offset_of(40), resume_record_idx=40
+        )
+        record_ids, results = run(make_args(), f"{server_url}/sample.warc.gz", previous_work)
+        assert record_ids == list(range(50, 100))
+        assert results.success and results.processed_records == 50
+
+    def test_range_ignored(self, make_args, server_url):
+        # The server answers 200 with the whole file, the records are counted from the start.
+        previous_work = WarcProgress(
+            last_record_seen=49, resume_offset=offset_of(40), resume_record_idx=40
+        )
+        record_ids, results = run(make_args(), f"{server_url}/no-range", previous_work)
+        assert record_ids == list(range(50, 100))
+        assert results.success and results.processed_records == 50
+
+    def test_interrupted(self, make_args, server_url):
+        # Each attempt stops in the middle, the records are only yielded once.
+        record_ids, results = run(make_args(), f"{server_url}/truncated", WarcProgress())
+        assert not results.success
+        assert record_ids == list(range(len(record_ids)))
+        assert 0 < len(record_ids) < 100
+        assert results.resume_record_idx <= len(record_ids)
+        assert WARC[results.resume_offset :].startswith(RECORDS[results.resume_record_idx])
+
+        # Then the next run resumes from there.
+        previous_work = WarcProgress(
+            last_record_seen=record_ids[-1],
+            resume_offset=results.resume_offset,
+            resume_record_idx=results.resume_record_idx,
+        )
+        resumed, results = run(make_args(), f"{server_url}/sample.warc.gz", previous_work)
+        assert resumed == list(range(len(record_ids), 100))
+        assert results.success
+
+    def test_interrupted_audit(self, make_args, server_url):
+        # The audit of the decisions taken before the interruption is kept.
+        args = make_args(lid_sampling=LanguageSampling(num_chars=4, audit_rate=1.0))
+        record_ids, results = run(args, f"{server_url}/truncated", WarcProgress())
+        assert not results.success
+        assert results.lid_audit == {"agree": len(record_ids)}
+
+    def test_done(self, make_args, server_url):
+        record_ids, results = run(
+            make_args(), f"{server_url}/sample.warc.gz", WarcProgress(done=True)
+        )
+        assert record_ids == []
+        assert results.success and results.processed_records == 0
+
+
+TEXT = "x" * 100
+SAMPLE = "xx xx xx xx"
+
+
+class TestIdentifyLanguage:
+    def identify(self, make_args, sample_lid, full_lid, audit_rate=0.0, decision_score=0.95):
+        """The languages identified on the sample and on the whole text, and the audit."""
+        model = StubLanguageModel(lambda text: sample_lid if text == SAMPLE else full_lid)
+        args = make_args(
+            lang_detection_model=model,
+            lid_sampling=LanguageSampling(
+                num_chars=8, decision_score=decision_score, audit_rate=audit_rate
+            ),
+        )
+        lid_audit = Counter()
+        try:
+            lid = identify_language(args, TEXT, lid_audit)
+        except UnwantedWarcRecord as e:
+            lid = e.reason
+        return lid, model.texts, lid_audit
+
+    def test_early_accept(self, make_args):
+        lid, texts, _ = self.identify(make_args, ("en", 0.99), ("de", 0.99))
+        assert lid == ("en", 0.99)
+        assert texts == [SAMPLE]
+
+    def test_early_reject(self, make_args):
+        lid, texts, _ = self.identify(make_args, ("de", 0.99), ("en", 0.99))
+        assert lid == "language_sample"
+        assert texts == [SAMPLE]
+
+    def test_fallback_below_decision_score(self, make_args):
+        lid, texts, _ = self.identify(make_args, ("de", 0.9), ("en", 0.85))
+        assert lid == ("en", 0.85)
+        assert texts == [SAMPLE, TEXT]
+        lid, _, _ = self.identify(make_args, ("en", 0.9), ("en", 0.5))
+        assert lid == "language_score"
+        lid, _, _ = self.identify(make_args, ("en", 0.9), ("de", 0.9))
+        assert lid == "language"
+
+    def test_decision_score_below_min_language_score(self, make_args):
+        # The sample can't keep a document with a score the whole text would be rejected with.
+        lid, texts, _ = self.identify(make_args, ("en", 0.6), ("en", 0.6), decision_score=0.5)
+        assert lid == "language_score"
+        assert texts == [SAMPLE, TEXT]
+        lid, texts, _ = self.identify(make_args, ("en", 0.85), ("de", 0.9), decision_score=0.5)
+        assert lid == ("en", 0.85)
+        assert texts == [SAMPLE]
+
+    def test_short_text_not_sampled(self, make_args):
+        model = StubLanguageModel()
+        args = make_args(
+            lang_detection_model=model, lid_sampling=LanguageSampling(num_chars=8)
+        )
+        assert identify_language(args, "short", Counter()) == ("en", 0.99)
+        assert model.texts == ["short"]
+
+    def test_audit(self, make_args):
+        cases = [
+            (("en", 0.99), ("en", 0.9), ("en", 0.99), "agree"),
+            (("de", 0.99), ("de", 0.5), "language_sample", "agree"),
+            (("en", 0.99), ("de", 0.9), ("en", 0.99), "wrong_accept"),
+            # The sample is confident, the whole text is rejected on its score.
+            (("en", 0.99), ("en", 0.5), ("en", 0.99), "wrong_accept"),
+            (("de", 0.99), ("en", 0.9), "language_sample", "wrong_reject"),
+        ]
+        for sample_lid, full_lid, expected_lid, audit in cases:
+            lid, texts, lid_audit = self.identify(make_args, sample_lid, full_lid, 1.0)
+            # The decision is the one of the sample.
+            assert lid == expected_lid
+            assert texts == [SAMPLE, TEXT]
+            assert lid_audit == Counter({audit: 1})
+
+        # Not audited below the decision score, the whole text decides.
+        _, _, lid_audit = self.identify(make_args, ("en", 0.9), ("en", 0.9), 1.0)
+        assert lid_audit == Counter()
+
+
+def unique_generator(args, warc_url, group_idx, previous_work):
+    """Like `document_generator`, with documents that are never duplicates."""
+    processed_records = 0
+    if not previous_work.done:
+        for record_idx in range(previous_work.last_record_seen + 1, 100):
+            processed_records += 1
+            rng = random.Random(f"{warc_url} {record_idx}")
+            lines = [
+                " ".join(f"{rng.getrandbits(32):08x}" for _ in range(8)) for _ in range(2)
+            ]
+            yield Document(
+                text="\n".join(lines),
+                date="2024-01-01",
+                url=f"https://example.com/{record_idx}",
+                language="en",
+                language_score=0.9,
+                warc_id=f"id{record_idx}",
+                scores={},
+                group_idx=group_idx,
+                warc_file=warc_url,
+                record_idx=record_idx,
+                repetitions=None,
+                long_words=None,
+            )
+    yield WarcResults(
+        warc_url=warc_url,
+        group_idx=group_idx,
+        success=True,
+        processed_records=processed_records,
+        failed_records=0,
+    )
+
+
+class TestCreateDataset:
+    @pytest.mark.parametrize("filter_workers", [0, 2])
+    @pytest.mark.parametrize("minhash", [False, True])
+    def test_resume_with_dedup(
+        self, make_args, tmp_path, interrupt_writes, monkeypatch, filter_workers, minhash
+    ):
+        # The state is saved after every batch, and the run interrupted twice.
+        monkeypatch.setattr(dactory.create, "DEDUP_CHECKPOINT_SECONDS", 0)
+        bloom_filter = tmp_path / "empty.bin"
+        create_blocked_bloom_filter(1 << 20, 7, bloom_filter)
+        warc_paths = [[f"{group_idx}/warc{i}" for i in range(3)] for group_idx in range(2)]
+        args = make_args(
+            workers=2,
+            filter_workers=filter_workers,
+            groups=[0, 1],
+            warc_paths=warc_paths,
+            bloom_filter=str(bloom_filter),
+            enable_minhash_dedup=minhash,
+            minhash_num_perm=16,
+            min_length=20,
+        )
+        args.destination_directory.mkdir()
+        for num_batches in (2, 3):
+            interrupt_writes(num_batches)
+            with pytest.raises(Interrupted):
+                create_dataset(args, unique_generator)
+        interrupt_writes(None)
+        create_dataset(args, unique_generator)
+
+        # Each document is written exactly once.
+        for group_idx, group_warc_paths in enumerate(warc_paths):
+            path = args.destination_directory / f"{group_idx}.jsonl.zstd"
+            documents = [(d.warc_file, d.record_idx) for d in read_documents(path)]
+            warc_urls = [get_warc_url(warc_path) for warc_path in group_warc_paths]
+            assert sorted(documents) == [(url, i) for url in warc_urls for i in range(100)]
+
+    def test_shards(self, make_args, small_frames):
+        warc_paths = [[f"{group_idx}/warc{i}" for i in range(2)] for group_idx in range(2)]
+        args = make_args(
+            workers=2,
+            groups=[0, 1],
+            warc_paths=warc_paths,
+            output=OutputOptions(shard_size=2000),
+        )
+        destination = args.destination_directory
+        destination.mkdir()
+        create_dataset(args, unique_generator)
+
+        manifests = [destination / f"{group_idx}.manifest.json" for group_idx in range(2)]
+        assert source_group_files(destination) == [[str(path)] for path in manifests]
+        for group_idx, manifest_path in enumerate(manifests):
+            manifest = json.loads(manifest_path.read_text())
+            assert manifest["group_idx"] == group_idx
+            assert len(manifest["shards"]) > 1
+            for shard in manifest["shards"]:
+                shard_path = destination / shard["path"]
+                assert shard_path.stat().st_size == shard["size"]
+                assert len(list(read_documents(shard_path))) == shard["num_documents"]
+            documents = [
+                (d.warc_file, d.record_idx) for d in read_group_documents(manifest_path)
+            ]
+            warc_urls = [get_warc_url(warc_path) for warc_path in warc_paths[group_idx]]
+            assert sorted(documents) == [(url, i) for url in warc_urls for i in range(100)]
+        assert not list(destination.glob("*.jsonl.zstd.tmp*"))
+
+    def test_shards_interrupted_before_manifest(self, make_args, monkeypatch, small_frames):
+        args = make_args(warc_paths=[["0/warc0"]], output=OutputOptions(shard_size=2000))
+        destination = args.destination_directory
+        destination.mkdir()
+
+        def interrupted_split(*split_args):
+            split_into_shards(*split_args)
+            raise Interrupted
+
+        monkeypatch.setattr(dactory.zstd_writer, "split_into_shards", interrupted_split)
+        with pytest.raises(Interrupted):
+            create_dataset(args, unique_generator)
+        # The shards are written, but the group isn't finished without its manifest.
+        assert list(destination.glob("0.*.jsonl.zstd"))
+        assert source_group_files(destination) == []
+        # And an earlier split was cut into more shards.
+        (destination / "0.09999.jsonl.zstd").touch()
+
+        monkeypatch.setattr(dactory.zstd_writer, "split_into_shards", split_into_shards)
+        create_dataset(args, unique_generator)
+        manifest_path = destination / "0.manifest.json"
+        assert source_group_files(destination) == [[str(manifest_path)]]
+        shards = json.loads(manifest_path.read_text())["shards"]
+        assert sorted(p.name for p in destination.glob("0.*.jsonl.zstd")) == [
+            shard["path"] for shard in shards
+        ]
+        documents = sorted(d.record_idx for d in read_group_documents(manifest_path))
+        assert documents == list(range(100))
@@ -0,0 +1,201 @@
+import json
+
+import numpy as np
+import pytest
+from dactory.dedup import (
+    CorpusDeduplicator,
+    DedupParams,
+    DedupStage,
+    dedup_dataset,
+    hash_parts,
+    read_lines,
+)
+from dactory.refilter import group_shard_paths
+from dactory.zstd_writer import zstd_writer
+
+BASE = " ".join(f"word{i}" for i in range(200))
+
+
+def write_group(directory, group_idx: int, texts: list[str], name: str | None = None):
+    with zstd_writer(directory / (name or f"{group_idx}.jsonl.zstd")) as f:
+        for text in texts:
+            f.write((json.dumps({"text": text}) + "\n").encode())
+
+
+def write_shards(directory, group_idx: int, shards: list[list[str]]):
+    """The group split like by `dactory create --shard-size-mb`, with its manifest."""
+    entries = []
+    for i, texts in enumerate(shards):
+        name = f"{group_idx}.{i:05d}.jsonl.zstd"
+        write_group(directory, group_idx, texts, name)
+        entries.append(
+            {
+                "path": name,
+                "size": (directory / name).stat().st_size,
+                "num_documents": len(texts),
+            }
+        )
+    manifest = {"group_idx": group_idx, "shards": entries}
+    (directory / f"{group_idx}.manifest.json").write_text(json.dumps(manifest))
+
+
+def read_group(directory, group_idx: int) -> list[str]:
+    return [
+        json.loads(line)["text"] for line in read_lines(directory / f"{group_idx}.jsonl.zstd")
+    ]
+
+
+@pytest.fixture
+def source(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    write_group(source, 0, ["first document " + BASE, "unrelated " * 30])
+    write_group(source, 1, [BASE + " slightly changed", "something else " * 20])
+    # Group 2 wasn't finished by `dactory create`.
+    write_group(source, 3, ["first document " + BASE, "last group " * 20])
+    return source
+
+
+def dedup(source, destination, stage=DedupStage.all, task=0, num_tasks=1, **kwargs):
+    dedup_dataset(
+        source,
+        destination,
+        stage,
+        threshold=0.8,
+        num_perm=64,
+        ngram_size=5,
+        words=False,
+        task=task,
+        num_tasks=num_tasks,
+        quiet=True,
+        **kwargs,
+    )
+
+
+class TestDedup:
+    def test_removes_duplicates_across_groups(self, source, tmp_path):
+        destination = tmp_path / "destination"
+        dedup(source, destination)
+        assert read_group(destination, 0) == ["first document " + BASE, "unrelated " * 30]
+        assert read_group(destination, 1) == ["something else " * 20]
+        assert read_group(destination, 3) == ["last group " * 20]
+        assert not (destination / "2.jsonl.zstd").exists()
+
+    def test_several_tasks(self, source, tmp_path):
+        dedup(source, tmp_path / "single")
+        destination = tmp_path / "tasks"
+        for stage in [DedupStage.signatures, DedupStage.bands, DedupStage.filter]:
+            for task in range(2):
+                dedup(source, destination, stage, task, num_tasks=2)
+        for group_idx in [0, 1, 3]:
+            assert read_group(destination, group_idx) == read_group(
+                tmp_path / "single", group_idx
+            )
+
+    def test_restart(self, source, tmp_path):
+        destination = tmp_path / "destination"
+        dedup(source, destination)
+        expected = read_group(destination, 1)
+        (destination / "1.jsonl.zstd").unlink()
+        (destination / "minhash" / "bands" / "0.0.npz").unlink()
+        dedup(source, destination)
+        assert read_group(destination, 1) == expected
+
+    def test_interrupted_filter(self, source, tmp_path):
+        destination = tmp_path / "destination"
+        dedup(source, destination)
+        expected = read_group(destination, 1)
+        (destination / "1.jsonl.zstd").unlink()
+        # Left by a task stopped while writing the group.
+        (destination / "1.jsonl.zstd.tmp").write_bytes(b"partial")
+        (destination / "1.jsonl.zstd.tmp.index").write_text('{"end": 7}\n')
+        dedup(source, destination, DedupStage.filter)
+        assert read_group(destination, 1) == expected
+        assert sorted(path.name for path in destination.glob("1.*")) == ["1.jsonl.zstd"]
+
+    def test_band_parts(self, source, tmp_path):
+        dedup(source, tmp_path / "single", num_parts=1)
+        destination = tmp_path / "parts"
+        dedup(source, destination, num_parts=4)
+        params = json.loads((destination / "minhash" / "params.json").read_text())
+        assert (
+            len(list((destination / "minhash" / "bands").iterdir())) == 4 * params["num_bands"]
+        )
+        for group_idx in [0, 1, 3]:
+            assert read_group(destination, group_idx) == read_group(
+                tmp_path / "single", group_idx
+            )
+
+    def test_shards(self, source, tmp_path, small_frames):
+        texts = [f"document {i} " + "x" * i for i in range(20)]
+        write_group(source, 4, texts)
+        destination = tmp_path / "destination"
+        dedup(source, destination, shard_size=1)
+        assert not (destination / "4.jsonl.zstd").exists()
+        shards = group_shard_paths(destination / "4.manifest.json")
+        assert len(shards) > 1
+        lines = [line for path in shards for line in read_lines(path)]
+        assert [json.loads(line)["text"] for line in lines] == texts
+        assert list(destination.glob("*.tmp*")) == []
+
+    def test_stage_order(self, source, tmp_path):
+        with pytest.raises(ValueError):
+            dedup(source, tmp_path / "destination", DedupStage.bands)
+
+    def test_other_params(self, source, tmp_path):
+        destination = tmp_path / "destination"
+        dedup(source, destination, DedupStage.signatures)
+        with pytest.raises(ValueError):
+            dedup_dataset(source, destination, DedupStage.bands, 0.5, 64, 5, False)
+
+    def test_sharded_groups(self, source, tmp_path):
+        sharded = tmp_path / "sharded"
+        sharded.mkdir()
+        for group_idx in (0, 1, 3):
+            texts = [
+                json.loads(line)["text"]
+                for line in read_lines(source / f"{group_idx}.jsonl.zstd")
+            ]
+            write_shards(sharded, group_idx, [texts[:1], texts[1:]])
+        dedup(source, tmp_path / "single")
+        destination = tmp_path / "destination"
+        dedup(sharded, destination)
+        for group_idx in [0, 1, 3]:
+            assert read_group(destination, group_idx) == read_group(
+                tmp_path / "single", group_idx
+            )
+
+
+class TestReadGroup:
+    def deduplicator(self, source, tmp_path) -> CorpusDeduplicator:
+        params = DedupParams(
+            threshold=0.8,
+            num_perm=64,
+            ngram_size=5,
+            words=False,
+            num_bands=8,
+            rows=8,
+            num_parts=1,
+        )
+        return CorpusDeduplicator(source, tmp_path / "destination", params)
+
+    def test_shards_in_order(self, tmp_path):
+        source = tmp_path / "source"
+        source.mkdir()
+        write_shards(source, 0, [["a", "b"], [], ["c"]])
+        write_group(source, 1, ["d"])
+        # Shards without a manifest, left by an interrupted group.
+        write_group(source, 2, ["e"], "2.00000.jsonl.zstd")
+        deduplicator = self.deduplicator(source, tmp_path)
+        assert deduplicator.groups == [0, 1]
+        texts = [json.loads(line)["text"] for line in deduplicator.read_group(0)]
+        assert texts == ["a", "b", "c"]
+        assert [json.loads(line)["text"] for line in deduplicator.read_group(1)] == ["d"]
+
+
+class TestHashParts:
+    def test_ranges_in_order(self):
+        hashes = np.array([0, 2**62, 2**63, 2**64 - 1], dtype=np.uint64)
+        assert hash_parts(hashes, 4).tolist() == [0, 1, 2, 3]
+        assert hash_parts(hashes, 3).tolist() == [0, 0, 1, 2]
+        assert hash_parts(hashes, 1).tolist() == [0, 0, 0, 0]
@@ -0,0 +1,164 @@
+import io
+import threading
+
+import pytest
+from dactory.fetcher import (
+    READ_CHUNK_SIZE,
+    ConcurrencyLimiter,
+    PrefetchingReader,
+    SlowDown,
+    WarcFetcher,
+)
+from dactory.warc_cache import WarcCache
+from fastwarc.warc import ArchiveIterator
+
+from .conftest import RECORDS, WARC
+
+
+def record_ids(reader) -> list[str]:
+    return [record.record_id for record in ArchiveIterator(reader)]
+
+
+class TestPrefetchingReader:
+    def test_reads_everything(self):
+        data = bytes(range(256)) * (3 * READ_CHUNK_SIZE // 256 + 7)
+        reader = PrefetchingReader(io.BytesIO(data), 2 * READ_CHUNK_SIZE, None)
+        parts = []
+        while part := reader.read(100_000):
+            parts.append(part)
+        assert b"".join(parts) == data
+        assert reader.read() == b""
+        reader.close()
+
+    def test_errors_are_raised_by_read(self):
+        class Broken(io.RawIOBase):
+            def read(self, size=-1):
+                raise ConnectionError("connection reset")
+
+        reader = PrefetchingReader(Broken(), READ_CHUNK_SIZE, None)
+        with pytest.raises(ConnectionError):
+            reader.read()
+
+    def test_parsed_by_archive_iterator(self):
+        reader = PrefetchingReader(io.BytesIO(WARC), READ_CHUNK_SIZE, None)
+        assert record_ids(reader) == [f"<urn:uuid:{i}>" for i in range(100)]
+
+
+class TestConcurrencyLimiter:
+    def test_slow_down_halves(self):
+        limiter = ConcurrencyLimiter(8)
+        limiter.slow_down()
+        assert limiter.limit == 4
+        for _ in range(5):
+            limiter.slow_down()
+        assert limiter.limit == 1
+
+    def test_throughput(self):
+        limiter = ConcurrencyLimiter(8, initial_concurrency=2)
+        limiter.report(100, 1.0)
+        assert limiter.limit == 3
+        limiter.report(100, 1.0)
+        assert limiter.limit == 4
+        # Much slower than the best download, too many connections
+        limiter.report(10, 1.0)
+        assert limiter.limit == 3
+
+    def test_no_increase_after_slow_down(self):
+        limiter = ConcurrencyLimiter(8)
+        limiter.slow_down()
+        limiter.report(100, 1.0)
+        assert limiter.limit == 4
+
+    def test_acquire_blocks(self):
+        limiter = ConcurrencyLimiter(1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.acquire()
+            acquired.set()
+
+        threading.Thread(target=acquire, daemon=True).start()
+        assert not acquired.wait(0.2)
+        limiter.release()
+        assert acquired.wait(5)
+
+
+class TestWarcFetcher:
+    def test_full_file(self, server_url):
+        fetcher = WarcFetcher(max_concurrency=2, read_ahead=READ_CHUNK_SIZE)
+        with fetcher.open(f"{server_url}/sample.warc.gz") as stream:
+            assert stream.status_code == 200
+            assert record_ids(stream.reader) == [f"<urn:uuid:{i}>" for i in range(100)]
+
+    def test_range(self, server_url):
+        fetcher = WarcFetcher(max_concurrency=2, read_ahead=READ_CHUNK_SIZE)
+        offset = sum(len(record) for record in RECORDS[:40])
+        with fetcher.open(f"{server_url}/sample.warc.gz", offset) as stream:
+            assert stream.status_code == 206
+            records = list(ArchiveIterator(stream.reader))
+        assert [r.record_id for r in records] == [f"<urn:uuid:{i}>" for i in range(40, 100)]
+        assert records[1].stream_pos == offset + len(RECORDS[40])
+
+    def test_session_is_reused(self, server_url):
+        fetcher = WarcFetcher(max_concurrency=2, read_ahead=READ_CHUNK_SIZE)
+        session = fetcher.session()
+        for _ in range(2):
+            with fetcher.open(f"{server_url}/sample.warc.gz") as stream:
+                record_ids(stream.reader)
+        assert fetcher.session() is session
+
+    def test_slow_down(self, server_url):
+        fetcher = WarcFetcher(max_concurrency=16, read_ahead=READ_CHUNK_SIZE, retry_delay=0.0)
+        with pytest.raises(SlowDown):
+            with fetcher.open(f"{server_url}/busy"):
+                pass
+        # Halved for each of the 3 attempts
+        assert fetcher.limiter.limit == 2
+
+    def test_slot_released(self, server_url):
+        fetcher = WarcFetcher(max_concurrency=1, read_ahead=READ_CHUNK_SIZE)
+        with pytest.raises(RuntimeError):
+            with fetcher.open(f"{server_url}/sample.warc.gz"):
+                raise RuntimeError
+        with fetcher.open(f"{server_url}/sample.warc.gz") as stream:
+            assert stream.status_code == 200
+
+    def test_slot_released_once_downloaded(self, server_url):
+        # The file fits in the read ahead buffer, the next download starts while it is parsed.
+        fetcher = WarcFetcher(max_concurrency=1, read_ahead=4 * READ_CHUNK_SIZE)
+        url = f"{server_url}/sample.warc.gz"
+        with fetcher.open(url) as stream:
+            opened = threading.Event()
+
+            def open_next():
+                with fetcher.open(url):
+                    opened.set()
+
+            threading.Thread(target=open_next, daemon=True).start()
+            assert opened.wait(5)
+            assert record_ids(stream.reader) == [f"<urn:uuid:{i}>" for i in range(100)]
+
+    def test_cache(self, server_url, tmp_path):
+        cache = WarcCache(tmp_path, max_size=1 << 30)
+        fetcher = WarcFetcher(max_concurrency=2, read_ahead=READ_CHUNK_SIZE, cache=cache)
+        url = f"{server_url}/sample.warc.gz"
+        with fetcher.open(url) as stream:
+            record_ids(stream.reader)
+        assert cache.get(url).read_bytes() == WARC
+        offset = sum(len(record) for record in RECORDS[:40])
+        with fetcher.open(url, offset) as stream:
+            assert stream.status_code == 206
+            records = list(ArchiveIterator(stream.reader))
+        assert [r.record_id for r in records] == [f"<urn:uuid:{i}>" for i in range(40, 100)]
+        assert records[1].stream_pos == offset + len(RECORDS[40])
+
+    def test_incomplete_download_not_cached(self, server_url, tmp_path):
+        cache = WarcCache(tmp_path, max_size=1 << 30)
+        fetcher = WarcFetcher(max_concurrency=2, read_ahead=READ_CHUNK_SIZE, cache=cache)
+        url = f"{server_url}/truncated"
+        with pytest.raises(Exception):
+            with fetcher.open(url) as stream:
+                record_ids(stream.reader)
+        assert cache.get(url) is None
+        assert list(tmp_path.iterdir()) == []
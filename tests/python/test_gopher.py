@@ -0,0 +1,80 @@
+from dactory import gopher_metric_names, repetition_metric_names
+from dactory.create import filter_document
+from dactory.document import Document
+from dactory.gopher import (
+    GOPHER_REPETITION_THRESHOLDS,
+    GopherConfig,
+    check_gopher_metrics,
+    passes_gopher_filters,
+)
+
+PASSING_METRICS = {
+    "mean_word_length": 5.0,
+    "frac_words_with_alpha": 1.0,
+    "frac_lines_end_punctuation": 1.0,
+    "frac_lines_start_bullet": 0.0,
+    "frac_alphabetic_chars": 0.9,
+    "has_stop_words": 1.0,
+    "frac_duplicate_sentences": 0.0,
+    "frac_duplicate_paragraphs": 0.0,
+} | {name: 0.0 for name in repetition_metric_names()}
+
+
+class TestCheckGopherMetrics:
+    def test_passes(self):
+        assert check_gopher_metrics(PASSING_METRICS, GopherConfig())
+        assert check_gopher_metrics(
+            PASSING_METRICS, GopherConfig(**GOPHER_REPETITION_THRESHOLDS)
+        )
+
+    def test_repetitions_only_with_their_thresholds(self):
+        for name in ("top_2gram_char_frac", "duplicate_10gram_char_frac"):
+            metrics = PASSING_METRICS | {name: 0.5}
+            assert check_gopher_metrics(metrics, GopherConfig())
+            assert not check_gopher_metrics(
+                metrics, GopherConfig(**GOPHER_REPETITION_THRESHOLDS)
+            )
+
+    def test_without_repetition_metrics(self):
+        metrics = {name: PASSING_METRICS[name] for name in gopher_metric_names()}
+        assert check_gopher_metrics(metrics, GopherConfig())
+
+
+class TestPassesGopherFilters:
+    def test_repetition_metrics_only_with_their_thresholds(self):
+        text = "The cat sat on the mat, and the dog was with it.\n" * 3
+        _, metrics = passes_gopher_filters(text, "en", GopherConfig())
+        assert list(metrics) == gopher_metric_names()
+        config = GopherConfig(**GOPHER_REPETITION_THRESHOLDS)
+        _, metrics = passes_gopher_filters(text, "en", config)
+        assert list(metrics) == gopher_metric_names() + repetition_metric_names()
+
+
+class TestFilterDocument:
+    def make_document(self) -> Document:
+        return Document(
+            text="The cat sat on the mat, and the dog was with it.\n" * 3,
+            date="2024-01-01",
+            url="https://example.com/",
+            language="en",
+            language_score=0.9,
+            warc_id="id",
+            scores={},
+            group_idx=0,
+            warc_file="a",
+            record_idx=0,
+            repetitions=None,
+            long_words=None,
+        )
+
+    def test_gopher_metrics_stored(self, make_args):
+        document = self.make_document()
+        filter_document(make_args(enable_gopher_filters=True), document)
+        assert list(document.gopher_metrics) == gopher_metric_names()
+
+        document = self.make_document()
+        args = make_args(enable_gopher_filters=True, enable_gopher_repetition_filters=True)
+        filter_document(args, document)
+        assert (
+            list(document.gopher_metrics) == gopher_metric_names() + repetition_metric_names()
+        )
@@ -0,0 +1,12 @@
+from dactory.language_detector import LanguageSampling
+
+
+class TestLanguageSampling:
+    def test_chunks_evenly_spaced(self):
+        text = "".join(chr(ord("a") + i) for i in range(26))
+        sampling = LanguageSampling(num_chars=8, num_chunks=4)
+        assert sampling.sample(text) == "ab ij qr yz"
+
+    def test_single_chunk_is_a_prefix(self):
+        sampling = LanguageSampling(num_chars=5, num_chunks=1)
+        assert sampling.sample("hello world") == "hello"
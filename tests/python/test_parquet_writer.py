@@ -0,0 +1,60 @@
+import pytest
+from dactory.document import Document
+from dactory.parquet_writer import write_parquet
+from dactory.zstd_writer import zstd_writer
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+
+def make_document(record_idx: int, scores: dict[str, float], gopher_metrics=None) -> Document:
+    return Document(
+        text=f"text {record_idx}",
+        date="2024-01-01",
+        url=f"https://example.com/{record_idx}",
+        language="en",
+        language_score=0.9,
+        warc_id=f"id{record_idx}",
+        scores=scores,
+        group_idx=0,
+        warc_file="a",
+        record_idx=record_idx,
+        repetitions=0.1,
+        long_words=None,
+        gopher_metrics=gopher_metrics,
+    )
+
+
+def write_source(path, documents: list[Document]):
+    with zstd_writer(path) as out_f:
+        for document in documents:
+            out_f.write((document.model_dump_json(by_alias=True) + "\n").encode())
+
+
+class TestWriteParquet:
+    def test_scores_and_metrics_are_columns(self, tmp_path):
+        documents = [make_document(i, {"rand": i / 10}) for i in range(5)]
+        documents.append(make_document(5, {"rand": 0.5, "dclm_low": 0.2}, {"stop_words": 3.0}))
+        source, path = tmp_path / "0.jsonl.zstd.tmp", tmp_path / "0.parquet"
+        write_source(source, documents)
+
+        assert write_parquet(source, path, 3, row_group_size=4) == 6
+        assert pq.ParquetFile(path).metadata.num_row_groups == 2
+        table = pq.read_table(path)
+        assert table.column("text").to_pylist() == [d.text for d in documents]
+        assert table.column("warc-id").to_pylist() == [d.warc_id for d in documents]
+        assert table.column("long_words").to_pylist() == [None] * 6
+        assert table.column("score_rand").to_pylist() == [0.0, 0.1, 0.2, 0.3, 0.4, 0.5]
+        assert table.column("score_dclm_low").to_pylist() == [None] * 5 + [0.2]
+        assert table.column("gopher_stop_words").to_pylist() == [None] * 5 + [3.0]
+
+        selected = pq.read_table(
+            path, columns=["record_idx"], filters=[("score_rand", "<", 0.2)]
+        )
+        assert selected.column_names == ["record_idx"]
+        assert selected.column("record_idx").to_pylist() == [0, 1]
+
+    def test_empty_group(self, tmp_path):
+        source, path = tmp_path / "0.jsonl.zstd.tmp", tmp_path / "0.parquet"
+        write_source(source, [])
+        assert write_parquet(source, path, 3) == 0
+        assert pq.read_table(path).num_rows == 0
@@ -0,0 +1,84 @@
+import io
+
+from dactory.prefilter import HTML_CONTENT_TYPES, RecordPrefilter, load_domains, parent_domains
+from fastwarc.warc import ArchiveIterator, WarcRecord
+
+
+def make_record(
+    payload: bytes = b"<p>hello</p>",
+    status: int = 200,
+    content_type: str = "text/html; charset=utf-8",
+    url: str = "https://www.example.com/page",
+    warc_type: str = "response",
+) -> WarcRecord:
+    http = (
+        f"HTTP/1.1 {status} OK\r\nContent-Type: {content_type}\r\n"
+        f"Content-Length: {len(payload)}\r\n\r\n"
+    ).encode() + payload
+    warc = (
+        (
+            f"WARC/1.0\r\nWARC-Type: {warc_type}\r\nWARC-Target-URI: {url}\r\n"
+            "WARC-Date: 2024-12-01T00:00:00Z\r\nWARC-Record-ID: <urn:uuid:1>\r\n"
+            "Content-Type: application/http; msgtype=response\r\n"
+            f"Content-Length: {len(http)}\r\n\r\n"
+        ).encode()
+        + http
+        + b"\r\n\r\n"
+    )
+    return next(iter(ArchiveIterator(io.BytesIO(warc))))
+
+
+class TestRecordPrefilter:
+    def test_accepts_html(self):
+        assert RecordPrefilter().rejection_reason(make_record()) is None
+
+    def test_reasons(self):
+        prefilter = RecordPrefilter(
+            content_types=HTML_CONTENT_TYPES,
+            only_successful_responses=True,
+            min_payload_size=5,
+            max_payload_size=100,
+            blocked_domains=frozenset(["spam.com"]),
+        )
+        assert prefilter.rejection_reason(make_record(warc_type="request")) == "not_response"
+        assert prefilter.rejection_reason(make_record(status=404)) == "http_status"
+        assert (
+            prefilter.rejection_reason(make_record(content_type="application/pdf"))
+            == "content_type"
+        )
+        assert prefilter.rejection_reason(make_record(payload=b"<p>")) == "too_short"
+        assert prefilter.rejection_reason(make_record(payload=b"x" * 101)) == "payload_size"
+        assert (
+            prefilter.rejection_reason(make_record(url="http://a.spam.com/x"))
+            == "blocked_domain"
+        )
+
+    def test_defaults_keep_all_pages(self):
+        # Like without the prefilter, only the records that can't give a document are rejected.
+        prefilter = RecordPrefilter()
+        for record in (
+            make_record(content_type="application/pdf"),
+            make_record(status=404),
+            make_record(payload=b"x" * 10_000_000),
+        ):
+            assert prefilter.rejection_reason(record) is None
+        assert prefilter.rejection_reason(make_record(warc_type="request")) == "not_response"
+
+    def test_allowed_domains(self):
+        prefilter = RecordPrefilter(allowed_domains=frozenset(["example.com"]))
+        assert prefilter.rejection_reason(make_record()) is None
+        assert (
+            prefilter.rejection_reason(make_record(url="https://other.org/"))
+            == "domain_not_allowed"
+        )
+
+
+def test_parent_domains():
+    assert parent_domains("https://www.a.b.com:8080/x?y") == ["a.b.com", "b.com", "com"]
+
+
+def test_load_domains(tmp_path):
+    path = tmp_path / "domains.txt"
+    path.write_text("# comment\nWWW.Example.com\n\nspam.org\n")
+    assert load_domains(str(path)) == frozenset(["example.com", "spam.org"])
+    assert load_domains("none") is None
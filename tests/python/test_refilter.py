@@ -0,0 +1,162 @@
+import json
+
+import dactory.create
+import pytest
+from dactory.create import WarcResults, create_dataset
+from dactory.document import Document
+from dactory.refilter import read_documents, refilter_dataset, source_group_files
+from dactory.zstd_writer import OutputOptions
+
+from .conftest import Interrupted
+
+WARC_PATHS = [[f"{group_idx}/warc{i}" for i in range(3)] for group_idx in range(2)]
+
+
+def fake_generator(args, warc_url, group_idx, previous_work):
+    """Like `document_generator`, with documents of two languages and of several lengths."""
+    processed_records = failed_records = 0
+    if not previous_work.done:
+        for record_idx in range(previous_work.last_record_seen + 1, 40):
+            text = f"{warc_url} {record_idx}\n" + "word " * (record_idx % 5 * 4)
+            language = "fr" if record_idx % 3 == 0 else "en"
+            if len(text) <= args.min_length or language not in args.languages:
+                failed_records += 1
+                continue
+            processed_records += 1
+            yield Document(
+                text=text,
+                date="2024-01-01",
+                url=f"https://example.com/{record_idx}",
+                language=language,
+                language_score=0.9,
+                warc_id=f"id{record_idx}",
+                scores={},
+                group_idx=group_idx,
+                warc_file=warc_url,
+                record_idx=record_idx,
+                repetitions=None,
+                long_words=None,
+            )
+    yield WarcResults(
+        warc_url=warc_url,
+        group_idx=group_idx,
+        success=True,
+        processed_records=processed_records,
+        failed_records=failed_records,
+    )
+
+
+def written_documents(directory, group_idx: int) -> list[tuple[str, int]]:
+    documents = read_documents(directory / f"{group_idx}.jsonl.zstd")
+    return sorted((d.warc_file, d.record_idx) for d in documents)
+
+
+def extract(make_args, destination, output=OutputOptions()):
+    args = make_args(
+        destination_directory=destination,
+        workers=2,
+        groups=[0, 1],
+        warc_paths=WARC_PATHS,
+        languages=["en", "fr"],
+        extract_only=True,
+        output=output,
+    )
+    args.destination_directory.mkdir()
+    create_dataset(args, fake_generator)
+    return args.destination_directory
+
+
+@pytest.fixture
+def extracted(make_args, tmp_path):
+    return extract(make_args, tmp_path / "extracted")
+
+
+@pytest.fixture
+def extracted_shards(make_args, tmp_path, monkeypatch, small_frames):
+    # Several frames for each WARC, so that the shards are not cut between the WARCs.
+    monkeypatch.setattr(dactory.create, "TRANSPORT_BATCH_SIZE", 8)
+    return extract(make_args, tmp_path / "extracted", OutputOptions(shard_size=1000))
+
+
+def filter_args(make_args, destination, warc_paths):
+    args = make_args(
+        destination_directory=destination,
+        workers=2,
+        filter_workers=1,
+        groups=[0, 1],
+        warc_paths=warc_paths,
+        min_length=30,
+        languages=["en"],
+    )
+    destination.mkdir(exist_ok=True)
+    return args
+
+
+class TestRefilter:
+    def test_same_as_create(self, make_args, extracted, tmp_path):
+        direct = filter_args(make_args, tmp_path / "direct", WARC_PATHS)
+        create_dataset(direct, fake_generator)
+        refiltered = filter_args(
+            make_args, tmp_path / "refiltered", source_group_files(extracted)
+        )
+        refilter_dataset(refiltered)
+
+        for group_idx in range(2):
+            documents = written_documents(refiltered.destination_directory, group_idx)
+            assert documents == written_documents(direct.destination_directory, group_idx)
+            assert len(documents) < len(written_documents(extracted, group_idx))
+
+    def test_resume(self, make_args, extracted, tmp_path, interrupt_writes):
+        args = filter_args(make_args, tmp_path / "refiltered", source_group_files(extracted))
+        interrupt_writes(1)
+        with pytest.raises(Interrupted):
+            refilter_dataset(args)
+        assert not (args.destination_directory / "0.jsonl.zstd").exists()
+        interrupt_writes(None)
+        refilter_dataset(args)
+
+        direct = filter_args(make_args, tmp_path / "direct", WARC_PATHS)
+        create_dataset(direct, fake_generator)
+        for group_idx in range(2):
+            documents = written_documents(args.destination_directory, group_idx)
+            assert documents == written_documents(direct.destination_directory, group_idx)
+
+    def test_group_not_extracted(self, make_args, extracted, tmp_path):
+        args = filter_args(
+            make_args, tmp_path / "refiltered", [source_group_files(extracted)[0]]
+        )
+        with pytest.raises(ValueError):
+            refilter_dataset(args)
+
+    def test_sharded_source(self, make_args, extracted_shards, tmp_path, interrupt_writes):
+        group_files = source_group_files(extracted_shards)
+        assert group_files == [
+            [str(extracted_shards / f"{i}.manifest.json")] for i in range(2)
+        ]
+        # The documents of a WARC are in several shards.
+        shards = json.loads((extracted_shards / "0.manifest.json").read_text())["shards"]
+        warcs_of_shards = [
+            {d.warc_file for d in read_documents(extracted_shards / shard["path"])}
+            for shard in shards
+        ]
+        assert any(a & b for a, b in zip(warcs_of_shards, warcs_of_shards[1:]))
+
+        args = filter_args(make_args, tmp_path / "refiltered", group_files)
+        interrupt_writes(1)
+        with pytest.raises(Interrupted):
+            refilter_dataset(args)
+        interrupt_writes(None)
+        refilter_dataset(args)
+
+        direct = filter_args(make_args, tmp_path / "direct", WARC_PATHS)
+        create_dataset(direct, fake_generator)
+        for group_idx in range(2):
+            documents = written_documents(args.destination_directory, group_idx)
+            assert documents == written_documents(direct.destination_directory, group_idx)
+
+    def test_shards_without_manifest(self, extracted_shards):
+        # Group 2 was interrupted after writing its shards.
+        (extracted_shards / "2.00000.jsonl.zstd").write_bytes(
+            (extracted_shards / "0.00000.jsonl.zstd").read_bytes()
+        )
+        assert len(source_group_files(extracted_shards)) == 2
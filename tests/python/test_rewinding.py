@@ -0,0 +1,52 @@
+import dactory.rewinding
+from dactory.rewinding import GroupProgress
+
+
+class TestGroupProgress:
+    def test_journal_replayed(self, tmp_path):
+        path = tmp_path / "0.progress.json"
+        progress = GroupProgress.try_to_load(path)
+        progress.set_last_record_seen("a", 10)
+        progress["a"].done = True
+        progress.save("a")
+        progress.set_last_record_seen("b", 4)
+        progress["b"].resume_offset = 123
+        progress.save("b")
+        assert not path.exists()
+        assert len(progress.journal_path.read_text().splitlines()) == 2
+
+        loaded = GroupProgress.try_to_load(path)
+        assert loaded.warcs_progress == progress.warcs_progress
+        assert loaded.nb_records_seen() == 16
+        # Compacted when loaded.
+        assert path.exists()
+        assert not loaded.journal_path.exists()
+
+    def test_incomplete_line_ignored(self, tmp_path):
+        path = tmp_path / "0.progress.json"
+        progress = GroupProgress.try_to_load(path)
+        progress["a"].done = True
+        progress.save("a")
+        with progress.journal_path.open("a") as f:
+            f.write('{"warc_file": "b", "done": tr')
+        loaded = GroupProgress.try_to_load(path)
+        assert loaded.warcs_progress.keys() == {"a"}
+        assert loaded["a"].done
+
+    def test_compaction(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(dactory.rewinding, "JOURNAL_COMPACTION_LINES", 3)
+        path = tmp_path / "0.progress.json"
+        progress = GroupProgress.try_to_load(path)
+        for i in range(4):
+            progress.set_last_record_seen(f"w{i}", i)
+            progress.save(f"w{i}")
+        assert len(progress.journal_path.read_text().splitlines()) == 1
+        loaded = GroupProgress.try_to_load(path)
+        assert loaded.warcs_progress == progress.warcs_progress
+
+    def test_records_seen_counter(self, tmp_path):
+        progress = GroupProgress.try_to_load(tmp_path / "0.progress.json")
+        progress.set_last_record_seen("a", 9)
+        progress.set_last_record_seen("a", 19)
+        progress.set_last_record_seen("b", 0)
+        assert progress.nb_records_seen() == 21
@@ -0,0 +1,66 @@
+import dactory.scoring
+import pytest
+from dactory.scoring import ScoringModels
+
+
+class FakeModel:
+    def __init__(self, path: str):
+        self.path = path
+        self.cache_hits = 1
+        self.cache_misses = 2
+
+    @staticmethod
+    def load(path: str, cache_size: int = 0) -> "FakeModel":
+        return FakeModel(path)
+
+    def labels(self) -> list[str]:
+        return ["rand", "wiki"]
+
+    def get_doc_scores(self, text: str) -> list[float]:
+        return [0.25, 0.75]
+
+
+@pytest.fixture
+def models_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(dactory.scoring, "FastTextPyWrapper", FakeModel)
+    for lang in ["en", "fr", "de"]:
+        (tmp_path / f"filter_{lang}.bin").write_bytes(b"x" * 10)
+    return str(tmp_path)
+
+
+class TestScoringModels:
+    def test_lazy_loading(self, models_directory):
+        models = ScoringModels(models_directory, ["en", "fr", "de"], load_models_early=False)
+        assert list(models.models) == []
+        assert models.get_doc_scores("text", "fr") == {"rand": 0.25, "wiki": 0.75}
+        assert list(models.models) == ["fr"]
+
+    def test_unloads_least_recently_used(self, models_directory):
+        models = ScoringModels(
+            models_directory, ["en", "fr", "de"], load_models_early=False, max_memory=25
+        )
+        models.get_doc_scores("text", "en")
+        models.get_doc_scores("text", "fr")
+        models.get_doc_scores("text", "en")
+        models.get_doc_scores("text", "de")
+        assert list(models.models) == ["en", "de"]
+        assert models.memory_usage() == 20
+        # The statistics of the unloaded model are kept.
+        assert models.cache_stats() == (3, 6)
+
+    def test_early_loading_stops_at_the_limit(self, models_directory):
+        models = ScoringModels(
+            models_directory, ["en", "fr", "de"], load_models_early=True, max_memory=25
+        )
+        assert list(models.models) == ["en", "fr"]
+
+    def test_inherited_models_are_kept(self, models_directory):
+        models = ScoringModels(
+            models_directory, ["en", "fr", "de"], load_models_early=True, max_memory=25
+        )
+        # As in a forked filter worker.
+        models.loaded_by = {lang: (-1, size) for lang, (_, size) in models.loaded_by.items()}
+        assert models.memory_usage() == 0
+        models.get_doc_scores("text", "de")
+        assert list(models.models) == ["en", "fr", "de"]
+        assert models.memory_usage() == 10
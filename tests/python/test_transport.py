@@ -0,0 +1,42 @@
+from dactory.transport import DocumentBatch
+
+
+def make_batch(num_documents: int) -> DocumentBatch:
+    return DocumentBatch(
+        text=[f"text {i} é" * i for i in range(num_documents)],
+        date=["2024-01-01"] * num_documents,
+        url=[f"https://example.com/{i}" for i in range(num_documents)],
+        language=["fr"] * num_documents,
+        warc_id=[f"id{i}" for i in range(num_documents)],
+        warc_file=["a"] * num_documents,
+        language_score=[i / 10 for i in range(num_documents)],
+        group_idx=[3] * num_documents,
+        record_idx=list(range(num_documents)),
+    )
+
+
+class TestSharedDocumentBatch:
+    def test_round_trip(self):
+        batch = make_batch(5)
+        shared = batch.to_shared_memory()
+        assert shared.group_idx == 3
+        assert shared.load_text() == batch.text
+        assert shared.load() == batch
+
+    def test_replace_text(self):
+        batch = make_batch(5)
+        keep = [True, False, True, True, False]
+        text = [t.upper() for t in batch.text]
+        shared = batch.to_shared_memory().replace_text(text, keep)
+        loaded = shared.load()
+        assert loaded.text == [text[0], text[2], text[3]]
+        assert loaded.record_idx == [0, 2, 3]
+        assert loaded.url == [batch.url[i] for i in (0, 2, 3)]
+        assert loaded.language_score == [0.0, 0.2, 0.3]
+
+    def test_replace_only_keep(self):
+        batch = make_batch(3)
+        shared = batch.to_shared_memory()
+        replaced = shared.replace_text(None, [False, True, False])
+        assert replaced.name == shared.name
+        assert replaced.load() == batch.select([False, True, False])
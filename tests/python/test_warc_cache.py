@@ -0,0 +1,47 @@
+import os
+
+from dactory.warc_cache import WarcCache
+
+
+def add_file(cache: WarcCache, url: str, data: bytes, mtime: float):
+    part, f = cache.create_part(url)
+    with f:
+        f.write(data)
+    cache.commit(url, part)
+    os.utime(cache.path(url), (mtime, mtime))
+
+
+class TestWarcCache:
+    def test_miss(self, tmp_path):
+        cache = WarcCache(tmp_path, max_size=100)
+        assert cache.get("https://example.com/a.warc.gz") is None
+
+    def test_hit(self, tmp_path):
+        cache = WarcCache(tmp_path, max_size=100)
+        add_file(cache, "https://example.com/a.warc.gz", b"abc", 1000)
+        path = cache.get("https://example.com/a.warc.gz")
+        assert path.read_bytes() == b"abc"
+        # Marked as recently used
+        assert path.stat().st_mtime > 1000
+        assert list(tmp_path.glob("*.part")) == []
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache = WarcCache(tmp_path, max_size=25)
+        add_file(cache, "a", b"x" * 10, 1000)
+        add_file(cache, "b", b"x" * 10, 2000)
+        cache.get("a")
+        add_file(cache, "c", b"x" * 10, 3000)
+        assert cache.get("a") is not None
+        assert cache.get("b") is None
+        assert cache.get("c") is not None
+
+    def test_stale_parts_removed(self, tmp_path):
+        cache = WarcCache(tmp_path, max_size=100)
+        part, f = cache.create_part("a")
+        f.close()
+        fresh, f = cache.create_part("b")
+        f.close()
+        os.utime(part, (0, 0))
+        WarcCache(tmp_path, max_size=100)
+        assert not part.exists()
+        assert fresh.exists()
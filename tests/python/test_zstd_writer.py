@@ -0,0 +1,95 @@
+import json
+
+import pytest
+from dactory.dedup import read_lines
+from dactory.zstd_writer import FramedZstdWriter, OutputOptions, split_into_shards
+
+ALL_RECORDS = [("a", i) for i in range(10)] + [("b", i) for i in range(5)]
+
+
+def write_documents(writer: FramedZstdWriter, warc_file: str, record_indices: range):
+    for record_idx in record_indices:
+        line = json.dumps({"warc_file": warc_file, "record_idx": record_idx}) + "\n"
+        writer.write(line.encode(), warc_file, record_idx)
+
+
+def read_records(path) -> list[tuple[str, int]]:
+    return [(d["warc_file"], d["record_idx"]) for d in map(json.loads, read_lines(path))]
+
+
+class TestFramedZstdWriter:
+    def test_frames_are_one_file(self, tmp_path):
+        path, index_path = tmp_path / "0.jsonl.zstd", tmp_path / "0.index"
+        with FramedZstdWriter(path, index_path, frame_size=100) as writer:
+            write_documents(writer, "a", range(10))
+            write_documents(writer, "b", range(5))
+        assert read_records(path) == ALL_RECORDS
+        assert len(index_path.read_text().splitlines()) > 1
+
+    def test_recover_cuts_the_incomplete_frame(self, tmp_path):
+        path, index_path = tmp_path / "0.jsonl.zstd", tmp_path / "0.index"
+        with FramedZstdWriter(path, index_path, frame_size=1 << 20) as writer:
+            write_documents(writer, "a", range(10))
+            writer.flush()
+            write_documents(writer, "b", range(3))
+        size = path.stat().st_size
+        # Interrupted while writing the next frame and its line of the index.
+        with path.open("ab") as f:
+            f.write(b"\x28\xb5\x2f\xfd partial frame")
+        with index_path.open("a") as f:
+            f.write(f'{{"end": {size + 100}, "last_records": {{"b": 9}}}}\n{{"end":')
+
+        assert FramedZstdWriter.recover(path, index_path) == {"a": 9, "b": 2}
+        assert path.stat().st_size == size
+        with FramedZstdWriter(path, index_path) as writer:
+            write_documents(writer, "b", range(3, 5))
+        assert read_records(path) == ALL_RECORDS
+        assert FramedZstdWriter.recover(path, index_path) == {"a": 9, "b": 4}
+
+    def test_recover_index_ahead_of_data(self, tmp_path):
+        path, index_path = tmp_path / "0.jsonl.zstd", tmp_path / "0.index"
+        with FramedZstdWriter(path, index_path) as writer:
+            write_documents(writer, "a", range(2))
+        path.write_bytes(b"")
+        assert FramedZstdWriter.recover(path, index_path) == {}
+        assert index_path.read_text() == ""
+
+    @pytest.mark.parametrize(
+        "options",
+        [OutputOptions(level=19), OutputOptions(threads=2, long_distance_matching=True)],
+    )
+    def test_output_options(self, tmp_path, options):
+        path, index_path = tmp_path / "0.jsonl.zstd", tmp_path / "0.index"
+        with FramedZstdWriter(path, index_path, frame_size=100, options=options) as writer:
+            write_documents(writer, "a", range(10))
+            write_documents(writer, "b", range(5))
+        assert read_records(path) == ALL_RECORDS
+
+
+class TestSplitIntoShards:
+    def test_shards_are_cut_between_frames(self, tmp_path):
+        path, index_path = tmp_path / "0.jsonl.zstd.tmp", tmp_path / "0.index"
+        with FramedZstdWriter(path, index_path, frame_size=100) as writer:
+            write_documents(writer, "a", range(10))
+            write_documents(writer, "b", range(5))
+        shards = split_into_shards(
+            path, index_path, 150, lambda i: tmp_path / f"0.{i:05d}.jsonl.zstd"
+        )
+        assert len(shards) > 1
+        assert sum(shard["size"] for shard in shards) == path.stat().st_size
+        assert sum(shard["num_documents"] for shard in shards) == len(ALL_RECORDS)
+        records = [
+            record for shard in shards for record in read_records(tmp_path / shard["path"])
+        ]
+        assert records == ALL_RECORDS
+        for shard in shards:
+            assert len(read_records(tmp_path / shard["path"])) == shard["num_documents"]
+
+    def test_empty_group(self, tmp_path):
+        path, index_path = tmp_path / "0.jsonl.zstd.tmp", tmp_path / "0.index"
+        FramedZstdWriter(path, index_path).close()
+        shards = split_into_shards(
+            path, index_path, 150, lambda i: tmp_path / f"0.{i}.jsonl.zstd"
+        )
+        assert shards == [{"path": "0.0.jsonl.zstd", "size": 0, "num_documents": 0}]
+        assert read_records(tmp_path / "0.0.jsonl.zstd") == []
@@ -0,0 +1,123 @@
+import struct
+
+import pytest
+from dactory import BloomFilter, dedup_document
+
+
+@pytest.fixture
+def bloom_path(tmp_path):
+    path = tmp_path / "bloom.bin"
+    num_hashes, size = 2, 1 << 16
+    path.write_bytes(struct.pack("<iQ", num_hashes, size) + bytes(size))
+    return path
+
+
+class TestBloomFilter:
+    @pytest.mark.parametrize("mmap", [True, False])
+    def test_set_get(self, bloom_path, mmap):
+        bloom = BloomFilter.py_load(str(bloom_path), mmap=mmap)
+        assert not bloom.get("hello")
+        bloom.set("hello")
+        assert bloom.get("hello")
+        assert not bloom.get("world")
+
+    def test_mmap_does_not_modify_the_file(self, bloom_path):
+        content = bloom_path.read_bytes()
+        bloom = BloomFilter.py_load(str(bloom_path))
+        bloom.set("hello")
+        assert bloom_path.read_bytes() == content
+        assert not BloomFilter.py_load(str(bloom_path)).get("hello")
+
+    def test_same_results(self, bloom_path):
+        text = "first line\nsecond line\n\nanother paragraph\nfirst line"
+        results = []
+        for mmap in [True, False]:
+            bloom = BloomFilter.py_load(str(bloom_path), mmap=mmap)
+            results.append([dedup_document(text, bloom, 0.2) for _ in range(2)])
+        assert results[0] == results[1]
+
+    def test_truncated_file(self, bloom_path):
+        bloom_path.write_bytes(bloom_path.read_bytes()[:1000])
+        with pytest.raises(IOError):
+            BloomFilter.py_load(str(bloom_path))
+
+    def test_save_load(self, bloom_path, tmp_path):
+        bloom = BloomFilter.py_load(str(bloom_path))
+        bloom.set("hello")
+        saved_path = tmp_path / "saved.bin"
+        bloom.save(str(saved_path))
+        assert saved_path.stat().st_size == bloom_path.stat().st_size
+        assert BloomFilter.py_load(str(saved_path)).get("hello")
+
+    def test_save_over_mapped_file(self, bloom_path):
+        bloom = BloomFilter.py_load(str(bloom_path))
+        bloom.set("hello")
+        bloom.save(str(bloom_path))
+        bloom.set("world")
+        bloom.save(str(bloom_path))
+        reloaded = BloomFilter.py_load(str(bloom_path))
+        assert reloaded.get("hello") and reloaded.get("world")
+
+    def test_merge(self, bloom_path):
+        first = BloomFilter.py_load(str(bloom_path))
+        second = BloomFilter.py_load(str(bloom_path))
+        first.set("hello")
+        second.set("world")
+        first.merge(second)
+        assert first.get("hello") and first.get("world")
+        assert not second.get("hello")
+
+    def test_merge_different_shapes(self, bloom_path, tmp_path):
+        other_path = tmp_path / "other.bin"
+        other_path.write_bytes(struct.pack("<iQ", 2, 1024) + bytes(1024))
+        bloom = BloomFilter.py_load(str(bloom_path))
+        with pytest.raises(ValueError):
+            bloom.merge(BloomFilter.py_load(str(other_path)))
+
+    def test_test_and_set(self, bloom_path):
+        bloom = BloomFilter.py_load(str(bloom_path))
+        reference = BloomFilter.py_load(str(bloom_path))
+        for line in ["hello", "world", "hello", "", "world"]:
+            expected = reference.get(line)
+            reference.set(line)
+            assert bloom.test_and_set(line) == expected
+        assert bloom.get("hello") and bloom.get("")
+
+
+class TestBlockedBloomFilter:
+    def test_set_get(self):
+        bloom = BloomFilter.new_blocked(1 << 16, 7)
+        assert not bloom.test_and_set("hello")
+        assert bloom.test_and_set("hello")
+        assert bloom.get("hello")
+        assert not bloom.get("world")
+
+    @pytest.mark.parametrize("mmap", [True, False])
+    def test_save_load(self, tmp_path, mmap):
+        bloom = BloomFilter.new_blocked(1000, 7)
+        bloom.set("hello")
+        path = tmp_path / "blocked.bin"
+        bloom.save(str(path))
+        # The size is rounded up to whole blocks, and the header is one block.
+        assert path.read_bytes()[:4] == b"DBBF"
+        assert path.stat().st_size == 64 + 1024
+        loaded = BloomFilter.py_load(str(path), mmap=mmap)
+        assert loaded.get("hello")
+        assert not loaded.get("world")
+
+    def test_false_positives(self):
+        bloom = BloomFilter.new_blocked(1 << 16, 7)
+        for i in range(20_000):
+            bloom.set(f"line {i}")
+        assert all(bloom.get(f"line {i}") for i in range(20_000))
+        false_positives = sum(bloom.get(f"other {i}") for i in range(100_000))
+        assert false_positives < 100
+
+    def test_merge_different_layouts(self, bloom_path):
+        bloom = BloomFilter.py_load(str(bloom_path))
+        with pytest.raises(ValueError):
+            bloom.merge(BloomFilter.new_blocked(1 << 16, 2))
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            BloomFilter.new_blocked(1 << 16, 17)
@@ -1,4 +1,96 @@
-from dactory import compute_gopher_metrics
+import numpy as np
+import pytest
+from dactory import compute_gopher_metrics, compute_gopher_metrics_batch, gopher_metric_names
+
+# The stop words of the languages of the tests, from src/gopher.rs. "have" is there twice.
+STOP_WORDS = {
+    "en": [
+        "the", "be", "to", "of", "and", "that", "have", "with", "this", "will", "your", "from",
+        "they", "been", "have", "many", "some",
+    ],
+    "fr": [
+        "le", "de", "un", "être", "et", "en", "avoir", "que", "pour", "dans", "ce", "son",
+        "une", "sur", "avec",
+    ],
+    "el": [
+        "και", "του", "της", "για", "που", "από", "στο", "τον", "στη", "με", "δεν", "τα", "θα",
+        "ότι", "στην",
+    ],
+}  # fmt: skip
+END_PUNCTUATION = ".!?;:"
+ASCII_WHITESPACE = " \t\n\x0c\r"
+
+
+def ratio(numerator: int, denominator: int) -> float:
+    """Computed in f32, like in Rust."""
+    if denominator == 0:
+        return 0.0
+    return float(np.float32(numerator) / np.float32(denominator))
+
+
+def lines(text: str) -> list[str]:
+    """Same as `str::lines` in Rust: a lone "\r" doesn't end a line."""
+    *lines, last = text.split("\n")
+    lines = [line.removesuffix("\r") for line in lines]
+    return lines + [last] if last else lines
+
+
+def is_bullet_start(line: str) -> bool:
+    line = line.lstrip()
+    digits = len(line) - len(line.lstrip("0123456789"))
+    return line[:1] in ("-", "*", "+") or (digits > 0 and line[digits : digits + 1] == ".")
+
+
+def split_sentences(text: str) -> list[str]:
+    sentences = []
+    start = 0
+    for i, c in enumerate(text):
+        if c in END_PUNCTUATION and (i + 1 == len(text) or text[i + 1] in ASCII_WHITESPACE):
+            sentences.append(text[start : i + 1].strip())
+            start = i + 1
+    sentences.append(text[start:].strip())
+    return [sentence for sentence in sentences if sentence]
+
+
+def frac_duplicate(chunks: list[str]) -> float:
+    seen = set()
+    duplicate_bytes = 0
+    for chunk in chunks:
+        if chunk in seen:
+            duplicate_bytes += len(chunk.encode())
+        seen.add(chunk)
+    return ratio(duplicate_bytes, sum(len(chunk.encode()) for chunk in chunks))
+
+
+def reference_gopher_metrics(text: str, language: str) -> dict[str, float]:
+    """The first implementation of `compute_gopher_metrics`, which split the text once for
+    each metric, to check the single scan against it."""
+    words = text.split()
+    text_lines = lines(text)
+    if language in STOP_WORDS:
+        lower_words = set(text.lower().split())
+        found = sum(word in lower_words for word in STOP_WORDS[language])
+        has_stop_words = 1.0 if found >= 2 else 0.0
+    else:
+        has_stop_words = 1.0
+    paragraphs = [paragraph.strip() for paragraph in text.split("\n\n")]
+    return {
+        "mean_word_length": ratio(sum(len(w.encode()) for w in words), len(words)),
+        "frac_words_with_alpha": ratio(
+            sum(any(c.isalpha() for c in w) for w in words), len(words)
+        ),
+        "frac_lines_end_punctuation": ratio(
+            sum(line.rstrip()[-1:] in tuple(END_PUNCTUATION) for line in text_lines),
+            len(text_lines),
+        ),
+        "frac_lines_start_bullet": ratio(
+            sum(map(is_bullet_start, text_lines)), len(text_lines)
+        ),
+        "frac_alphabetic_chars": ratio(sum(c.isalpha() for c in text), len(text)),
+        "has_stop_words": has_stop_words,
+        "frac_duplicate_sentences": frac_duplicate(split_sentences(text)),
+        "frac_duplicate_paragraphs": frac_duplicate([p for p in paragraphs if p]),
+    }
 
 
 class TestComputeGopherMetrics:
@@ -76,8 +168,46 @@ class TestComputeGopherMetrics:
         # English text checked against French stop words should fail
         assert metrics["has_stop_words"] == 0.0
 
+    def test_same_as_reference(self):
+        texts = [
+            "",
+            "\n\n",
+            "Hello world. Hello world. Unique sentence.",
+            "- item one\n* item two\r\n12. item three\r\n\nParagraph.\n\nParagraph.\r",
+            "ΣΟΦΟΣ και σοφός του. İstanbul straße! 日本語のテキスト？ ok...  \t",
+            "have have the; The THE: 12345 67890\u00a0abc",
+        ]
+        for text in texts:
+            for language in ("en", "fr", "el", "xx"):
+                expected = reference_gopher_metrics(text, language)
+                assert compute_gopher_metrics(text, language) == expected
+
     def test_unknown_language_stop_words(self):
         text = "Some random text here."
         metrics = compute_gopher_metrics(text, "xx")
         # Unknown language defaults to passing
         assert metrics["has_stop_words"] == 1.0
+
+
+class TestComputeGopherMetricsBatch:
+    def test_same_as_single_document(self):
+        texts = [
+            "The quick brown fox jumps over the lazy dog. This is a test sentence.",
+            "",
+            "- item one\n- item two\n\nParagraph one.\n\nParagraph one.",
+            "Le chat est sur le tapis. Il a une belle couleur.",
+        ]
+        languages = ["en", "en", "en", "fr"]
+        metrics = compute_gopher_metrics_batch(texts, languages)
+        assert metrics.shape == (len(texts), len(gopher_metric_names()))
+        for row, text, language in zip(metrics, texts, languages):
+            expected = compute_gopher_metrics(text, language)
+            assert dict(zip(gopher_metric_names(), row.tolist())) == expected
+
+    def test_empty_batch(self):
+        metrics = compute_gopher_metrics_batch([], [])
+        assert metrics.shape == (0, len(gopher_metric_names()))
+
+    def test_mismatched_lengths(self):
+        with pytest.raises(ValueError):
+            compute_gopher_metrics_batch(["some text"], [])
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from dactory import LshIndex
+from dactory.minhash_dedup import MinHashDeduplicator, optimal_lsh_param
+
+
+def signatures(num_documents: int) -> np.ndarray:
+    """Unrelated documents, none of them are candidates."""
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 2**32, size=(num_documents, 16), dtype=np.uint64)
+
+
+class TestLshIndex:
+    def test_query_and_insert(self):
+        index = LshIndex(4, 4)
+        signature = [1] * 16
+        assert not index.query_and_insert(signature)
+        assert index.query_and_insert(signature)
+        # A single band in common is enough.
+        assert index.query_and_insert([1] * 4 + [2] * 12)
+        assert not index.query_and_insert([2] * 16)
+        assert index.num_documents == 2
+
+    def test_batch_same_as_single(self):
+        batch = signatures(100)
+        batch = np.concatenate([batch, batch[:10]])
+        single_index = LshIndex(4, 4)
+        expected = [single_index.query_and_insert(s.tolist()) for s in batch]
+        assert LshIndex(4, 4).query_and_insert_batch(batch) == expected
+        assert expected[-10:] == [True] * 10
+
+    def test_signature_too_short(self):
+        with pytest.raises(ValueError):
+            LshIndex(4, 4).query_and_insert([1] * 15)
+
+    def test_save_load(self, tmp_path):
+        index = LshIndex(4, 4)
+        index.query_and_insert_batch(signatures(5000))
+        path = tmp_path / "index.bin"
+        index.save(str(path))
+        loaded = LshIndex.load(str(path))
+        assert (loaded.num_bands, loaded.rows, loaded.num_documents) == (4, 4, 5000)
+        assert all(loaded.query_and_insert_batch(signatures(5000)))
+
+    def test_memory_limit(self):
+        index = LshIndex(4, 4, max_bytes=1 << 16)
+        batch = signatures(5000)
+        index.query_and_insert_batch(batch)
+        assert index.memory_usage <= 1 << 16
+        assert index.num_skipped > 0
+        assert index.num_documents + index.num_skipped == 5000
+        # The documents indexed before the limit are still found.
+        assert index.query_and_insert(batch[0].tolist())
+
+
+class TestMinHashDeduplicator:
+    def test_optimal_lsh_param(self):
+        # Same values as datasketch.
+        assert optimal_lsh_param(0.8, 128) == (9, 13)
+        assert optimal_lsh_param(0.5, 128) == (25, 5)
+
+    def test_are_duplicates(self):
+        dedup = MinHashDeduplicator(num_perm=64)
+        text = " ".join(f"word{i}" for i in range(200))
+        assert dedup.are_duplicates([text, "something else entirely", text + " end"]) == [
+            False,
+            False,
+            True,
+        ]
+
+    def test_snapshot(self, tmp_path):
+        dedup = MinHashDeduplicator(num_perm=64)
+        dedup.is_duplicate("a document long enough to have some shingles")
+        dedup.save(tmp_path / "minhash.bin")
+        resumed = MinHashDeduplicator(num_perm=64, snapshot=tmp_path / "minhash.bin")
+        assert resumed.is_duplicate("a document long enough to have some shingles")
+        with pytest.raises(ValueError):
+            MinHashDeduplicator(num_perm=128, snapshot=tmp_path / "minhash.bin")
@@ -0,0 +1,92 @@
+import math
+
+import pytest
+from dactory import (
+    compute_document_metrics,
+    compute_document_metrics_batch,
+    compute_long_words,
+    compute_repetition_metrics,
+    compute_repetitions_rolling,
+    document_metric_names,
+    gopher_metric_names,
+    repetition_metric_names,
+)
+
+from .test_gopher import reference_gopher_metrics
+
+TEXTS = [
+    "",
+    "The quick brown fox jumps over the lazy dog. This is a test sentence.",
+    "- item one\n- item two\n\nParagraph one.\n\nParagraph one.\n\n\nParagraph two.",
+    "1. First item\r\n2. Second item\r\nNormal line\r",
+    "Le chat est sur le tapis. Il a une belle couleur. Le chat est sur le tapis.",
+    "ΣΟΦΟΣ και σοφός του. İstanbul straße! 日本語のテキスト？ ok",
+    "abcabcabcabcabcabc abcabcabcabcabcabc abcabcabcabcabcabc longwordwithmanyletters",
+    "one two three four five six one two three four five six one two three four five six",
+]
+LANGUAGES = ["en", "en", "en", "en", "fr", "el", "xx", "en"]
+
+
+def expected_metrics(text: str, language: str, n: int, min_length: int) -> dict[str, float]:
+    return {
+        "repetitions": compute_repetitions_rolling(text, n),
+        "long_words": compute_long_words(text, min_length),
+        **reference_gopher_metrics(text, language),
+        **compute_repetition_metrics(text),
+    }
+
+
+class TestComputeDocumentMetrics:
+    def test_names(self):
+        assert document_metric_names() == [
+            "repetitions",
+            "long_words",
+            *gopher_metric_names(),
+            *repetition_metric_names(),
+        ]
+
+    @pytest.mark.parametrize("n, min_length", [(20, 15), (3, 5)])
+    def test_same_as_separate_functions(self, n, min_length):
+        for text, language in zip(TEXTS, LANGUAGES):
+            values = compute_document_metrics(text, language, n=n, min_length=min_length)
+            metrics = dict(zip(document_metric_names(), values))
+            assert metrics == expected_metrics(text, language, n, min_length)
+
+    def test_without_gopher(self):
+        for text, language in zip(TEXTS, LANGUAGES):
+            values = compute_document_metrics(text, language, gopher=False)
+            assert values[:2] == [
+                compute_repetitions_rolling(text, 20),
+                compute_long_words(text, 15),
+            ]
+            assert all(math.isnan(v) for v in values[2:])
+
+    def test_without_repetition_metrics(self):
+        num_metrics = 2 + len(gopher_metric_names())
+        for text, language in zip(TEXTS, LANGUAGES):
+            values = compute_document_metrics(text, language, repetition_metrics=False)
+            expected = compute_document_metrics(text, language)
+            assert values[:num_metrics] == expected[:num_metrics]
+            assert all(math.isnan(v) for v in values[num_metrics:])
+
+
+class TestComputeDocumentMetricsBatch:
+    def test_same_as_single_document(self):
+        metrics = compute_document_metrics_batch(TEXTS, LANGUAGES)
+        assert metrics.shape == (len(TEXTS), len(document_metric_names()))
+        for row, text, language in zip(metrics, TEXTS, LANGUAGES):
+            assert row.tolist() == compute_document_metrics(text, language)
+
+    def test_without_repetition_metrics(self):
+        metrics = compute_document_metrics_batch(TEXTS, LANGUAGES, repetition_metrics=False)
+        for row, text, language in zip(metrics, TEXTS, LANGUAGES):
+            expected = compute_document_metrics(text, language, repetition_metrics=False)
+            assert row.tolist() == pytest.approx(expected, nan_ok=True)
+
+    def test_empty_batch(self):
+        metrics = compute_document_metrics_batch([], [])
+        assert metrics.shape == (0, len(document_metric_names()))
+
+    def test_mismatched_lengths(self):
+        with pytest.raises(ValueError):
+            compute_document_metrics_batch(["some text"], [])
@@ -1,4 +1,4 @@
-from dactory import compute_minhash_signature
+from dactory import compute_minhash_signature, compute_minhash_signature_batch
 
 
 class TestComputeMinHashSignature:
@@ -35,7 +35,61 @@ class TestComputeMinHashSignature:
         assert len(sig) == 4
         assert all(v == 2**64 - 1 for v in sig)
 
+    def test_values_are_32_bits(self):
+        # A single shingle, each permutation gives it a value spread over the 32 bits.
+        sig = compute_minhash_signature("abcde", 64, 5)
+        assert all(v < 2**32 for v in sig)
+        assert any(v >= 2**31 for v in sig)
+
     def test_num_perm_respected(self):
         for n in [1, 4, 8, 16, 64]:
             sig = compute_minhash_signature("some longer text for testing", n, 5)
             assert len(sig) == n
+
+
+class TestComputeMinHashSignatureBatch:
+    def test_same_as_single_document(self):
+        texts = ["hello world this is a test", "hi", "", "The quick brown fox jumps"]
+        signatures = compute_minhash_signature_batch(texts, 16, 5)
+        assert signatures.shape == (len(texts), 16)
+        for signature, text in zip(signatures, texts):
+            assert signature.tolist() == compute_minhash_signature(text, 16, 5)
+
+    def test_jaccard_estimate(self):
+        words = [f"w{i}" for i in range(300)]
+        other = [f"x{i}" if i % 4 == 0 else w for i, w in enumerate(words)]
+        for ngram_size, words_mode in [(5, False), (3, True)]:
+            sig1 = compute_minhash_signature(" ".join(words), 512, ngram_size, words_mode)
+            sig2 = compute_minhash_signature(" ".join(other), 512, ngram_size, words_mode)
+            shingles = []
+            for tokens in [words, other]:
+                if words_mode:
+                    shingles.append({tuple(tokens[i : i + 3]) for i in range(len(tokens) - 2)})
+                else:
+                    text = " ".join(tokens)
+                    shingles.append({text[i : i + 5] for i in range(len(text) - 4)})
+            jaccard = len(shingles[0] & shingles[1]) / len(shingles[0] | shingles[1])
+            estimate = sum(a == b for a, b in zip(sig1, sig2)) / 512
+            assert abs(estimate - jaccard) < 0.1
+
+
+class TestWordShingles:
+    def test_whitespace_is_ignored(self):
+        sig1 = compute_minhash_signature("one two  three\nfour", 16, 2, True)
+        sig2 = compute_minhash_signature("one two three four", 16, 2, True)
+        assert sig1 == sig2
+
+    def test_word_order_matters(self):
+        sig1 = compute_minhash_signature("one two three four", 16, 2, True)
+        sig2 = compute_minhash_signature("two one four three", 16, 2, True)
+        assert sig1 != sig2
+
+    def test_fewer_words_than_ngram_size(self):
+        sig = compute_minhash_signature("a long sentence", 8, 5, True)
+        assert all(v == 2**64 - 1 for v in sig)
+
+    def test_batch(self):
+        texts = ["one two three four", "one", "five six seven"]
+        signatures = compute_minhash_signature_batch(texts, 16, 3, True)
+        for signature, text in zip(signatures, texts):
+            assert signature.tolist() == compute_minhash_signature(text, 16, 3, True)
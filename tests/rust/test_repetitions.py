@@ -1,4 +1,61 @@
-from dactory import compute_long_words
+import random
+
+from dactory import (
+    compute_long_words,
+    compute_long_words_batch,
+    compute_repetition_metrics,
+    compute_repetition_metrics_batch,
+    compute_repetitions_rolling,
+    compute_repetitions_rolling_batch,
+    repetition_metric_names,
+)
+
+
+def repetitions_rolling_reference(text: str, n: int) -> float:
+    """The rolling hash of `compute_repetitions_rolling`, with a set instead of its table."""
+    text = text.encode("utf-8")
+    if len(text) <= n:
+        return 0.0
+
+    def signed_mod(x: int) -> int:
+        # Like `%` on i64 in Rust, the result has the sign of x.
+        return abs(x) % 1_000_000_007 * (1 if x >= 0 else -1)
+
+    h, bn = 0, 1
+    for byte in text[:n]:
+        h = signed_mod(h * 33 + byte)
+        bn = signed_mod(bn * 33)
+    seen, n_repetitions = set(), 0
+    for i in range(n, len(text)):
+        h = signed_mod(h * 33 - bn * text[i - n] + text[i])
+        h32 = h % 2**32
+        if h32 == 0 or h32 in seen:
+            n_repetitions += 1
+        seen.add(h32)
+    return n_repetitions / len(text)
+
+
+class TestComputeRepetitionsRolling:
+    def test_short_text(self):
+        assert compute_repetitions_rolling("abc", 3) == 0.0
+
+    def test_no_repetitions(self):
+        assert compute_repetitions_rolling("abcdefghij", 3) == 0.0
+
+    def test_repeated_text(self):
+        text = "abcabcabcabcabcabc"
+        res = compute_repetitions_rolling(text, 3)
+        # The first window is not added, "bca", "cab" and "abc" are new the first time.
+        assert abs(res - 12 / len(text)) < 1e-6
+
+    def test_same_as_reference(self):
+        rng = random.Random(0)
+        texts = ["".join(rng.choices("ab cé\n", k=rng.randint(0, 3000))) for _ in range(50)]
+        # The table is reused between the calls, whatever the size of the texts.
+        for text in texts + texts[::-1]:
+            for n in (1, 5, 20):
+                expected = repetitions_rolling_reference(text, n)
+                assert abs(compute_repetitions_rolling(text, n) - expected) < 1e-6
 
 
 class TestComputeLongWords:
@@ -29,3 +86,62 @@ class TestComputeLongWords:
         res = compute_long_words(text, min_length=8)
         expected = 25 / len(text)
         assert abs(res - expected) < self.error_margin
+
+
+class TestComputeRepetitionMetrics:
+    error_margin = 1e-6
+
+    def test_names(self):
+        assert repetition_metric_names() == [
+            *(f"top_{n}gram_char_frac" for n in range(2, 5)),
+            *(f"duplicate_{n}gram_char_frac" for n in range(5, 11)),
+        ]
+        assert sorted(compute_repetition_metrics("a b")) == sorted(repetition_metric_names())
+
+    def test_empty_text(self):
+        assert all(v == 0.0 for v in compute_repetition_metrics("").values())
+
+    def test_no_repetitions(self):
+        text = "one two three four five six seven eight nine ten eleven twelve"
+        assert all(v == 0.0 for v in compute_repetition_metrics(text).values())
+
+    def test_top_ngram(self):
+        text = "the cat sat on the cat"
+        metrics = compute_repetition_metrics(text)
+        # "the cat" twice.
+        assert abs(metrics["top_2gram_char_frac"] - 14 / len(text)) < self.error_margin
+        assert metrics["top_3gram_char_frac"] == 0.0
+
+    def test_duplicate_ngrams(self):
+        sentence = "one two three four five six"
+        text = f"{sentence} {sentence} {sentence}"
+        metrics = compute_repetition_metrics(text)
+        # The second and the third sentences are counted once each, without the spaces.
+        expected = 2 * len(sentence.replace(" ", "")) / len(text)
+        assert abs(metrics["duplicate_6gram_char_frac"] - expected) < self.error_margin
+        assert abs(metrics["duplicate_5gram_char_frac"] - expected) < 0.1
+        assert metrics["duplicate_10gram_char_frac"] > 0.0
+
+    def test_fewer_words_than_ngram(self):
+        metrics = compute_repetition_metrics("a a a a")
+        assert metrics["top_2gram_char_frac"] > 0.0
+        assert metrics["duplicate_5gram_char_frac"] == 0.0
+
+
+class TestBatches:
+    texts = ["", "these are some longwords", "abcabcabcabcabcabc", "short"]
+
+    def test_long_words_batch(self):
+        res = compute_long_words_batch(self.texts, min_length=8)
+        assert res.tolist() == [compute_long_words(t, min_length=8) for t in self.texts]
+
+    def test_repetitions_rolling_batch(self):
+        res = compute_repetitions_rolling_batch(self.texts, 3)
+        assert res.tolist() == [compute_repetitions_rolling(t, 3) for t in self.texts]
+
+    def test_repetition_metrics_batch(self):
+        res = compute_repetition_metrics_batch(self.texts)
+        assert res.shape == (len(self.texts), len(repetition_metric_names()))
+        for row, text in zip(res.tolist(), self.texts):
+            metrics = compute_repetition_metrics(text)
+            assert row == [metrics[name] for name in repetition_metric_names()]